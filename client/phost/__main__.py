@@ -1,23 +1,66 @@
 import logging
 import traceback
 import json
-from typing import List
 import os
+import sys
 from time import sleep
+from urllib.parse import urlencode
 
 import click
 import requests
 from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.structures import CaseInsensitiveDict
 from terminaltables import SingleTable
+from terminaltables.width_and_alignment import visible_width
 import dateutil.parser
 
-from .config import load_conf, load_cookies, save_cookies, init_config
-from .upload import compress_dir
-from .util import compose, slugify, create_random_subdomain
+from .config import (
+    load_conf,
+    load_cookies,
+    save_cookies,
+    init_config,
+    load_cached_response,
+    save_cached_response,
+    CachedResponseWriter,
+)
+from .upload import (
+    ARCHIVE_SUFFIXES,
+    LEGACY_SERVER_CODECS,
+    archive_input_size,
+    create_archive,
+    build_manifest,
+    parse_compression,
+    supported_codecs,
+)
+from .stream import TransferProgress, build_multipart_stream, format_bytes, iter_archive_chunks
+from .resumable import RESUMABLE_UPLOAD_THRESHOLD, deploy_resumable
+from .util import compose, slugify, create_random_subdomain, parse_rate, PhostServerError
 
 
-class PhostServerError(Exception):
-    pass
+# Response headers that are stored along with cached response bodies
+CACHED_HEADERS = ["Content-Type", "ETag", "X-Next-Cursor"]
+
+# Deploy jobs are polled after this many seconds, backing off by `JOB_POLL_BACKOFF` each time
+JOB_POLL_INITIAL_DELAY = 0.25
+JOB_POLL_BACKOFF = 1.5
+JOB_POLL_MAX_DELAY = 5.0
+
+
+def build_cached_response(
+    not_modified_res: requests.Response, etag: str, headers: dict, body: bytes
+) -> requests.Response:
+    """ Builds a response out of a cached response body to stand in for a `304 Not Modified` """
+
+    res = requests.Response()
+    res.status_code = 200
+    res.url = not_modified_res.url
+    res.request = not_modified_res.request
+    res.headers = CaseInsensitiveDict({**headers, "ETag": etag})
+    res.encoding = "utf-8"
+    res._content = body  # pylint: disable=W0212
+    res._content_consumed = True  # pylint: disable=W0212
+    res.from_cache = True
+    return res
 
 
 class GlobalAppState(object):
@@ -29,8 +72,28 @@ class GlobalAppState(object):
         # Load cookies from previous session and construct a new session with them
         self.session = requests.Session()
         self.session.cookies.update(load_cookies())
+        self.capabilities = None
+
+    def make_request(
+        self,
+        method: str,
+        *args,
+        json_body=None,
+        form_data=None,
+        multipart_data=None,
+        stream=False,
+        headers=None,
+        stream_body=None,
+        body=None,
+    ):
+        # Streamed request bodies can only be sent once, so they're created by a factory
+        # function that returns the content type and a fresh body each time a request is made.
+        if stream_body is not None:
+            (content_type, body) = stream_body()
+            return self.session.post(
+                *args, data=body, headers={**(headers or {}), "Content-Type": content_type}
+            )
 
-    def make_request(self, method: str, *args, json_body=None, form_data=None, multipart_data=None):
         # If we are re-trying a request that has multipart file data, we need to reset the seek position
         # for all of those files to the beginning since it is advanced during request building.
         if multipart_data:
@@ -43,21 +106,40 @@ class GlobalAppState(object):
         (func, kwargs) = {
             "POST": (
                 self.session.post,
-                {"json": json_body, "files": multipart_data, "data": form_data},
+                {"json": json_body, "files": multipart_data, "data": form_data, "headers": headers},
             ),
-            "GET": (self.session.get, {}),
-            "PUT": (self.session.put, {"json": json_body}),
+            "GET": (self.session.get, {"stream": stream, "headers": headers}),
+            "PUT": (self.session.put, {"json": json_body, "data": body, "headers": headers}),
             "PATCH": (self.session.patch, {"json": json_body}),
             "DELETE": (self.session.delete, {}),
         }[method.upper()]
 
         return func(*args, **kwargs)
 
-    def api_call(self, resource_path: str, method="GET", **kwargs):
+    def api_call(
+        self, resource_path: str, method="GET", raw=False, raise_errors=False, **kwargs
+    ):
+        """ Makes a request to the API server, exiting with an error message if it fails.  Returns
+        the decoded JSON response body, or the response itself if `raw` is set.  If
+        `raise_errors` is set, error responses from the server and failures to reach it raise a
+        `PhostServerError` rather than exiting. """
+
         try:
-            res = self.make_request(
-                method, "{}/{}".format(self.conf["api_server_url"], resource_path), **kwargs
-            )
+            url = "{}/{}".format(self.conf["api_server_url"], resource_path)
+
+            # GET responses are cached on disk and revalidated using their `ETag`s
+            cached = load_cached_response(url) if method == "GET" else None
+            if cached is not None:
+                kwargs["headers"] = {"If-None-Match": cached[0]}
+
+            res = self.make_request(method, url, **kwargs)
+
+            if res.status_code == 304 and cached is not None:
+                res = build_cached_response(res, *cached)
+            elif res.status_code == 200 and method == "GET" and "ETag" in res.headers:
+                # Streamed responses are cached by their consumers as they're read
+                if not kwargs.get("stream"):
+                    self.cache_response(res, res.content)
 
             if res.status_code == 404:
                 raise PhostServerError("Resource not found")
@@ -68,19 +150,26 @@ class GlobalAppState(object):
                 if resource_path != "login/":
                     self.login()
                     sleep(0.2)
-                    return self.api_call(resource_path, method=method, **kwargs)
+                    return self.api_call(
+                        resource_path, method=method, raw=raw, raise_errors=raise_errors, **kwargs
+                    )
 
                 raise PhostServerError("Error logging in; invalid username/password?")
-            elif res.status_code != 200:
+            elif res.status_code not in [200, 202]:
                 raise PhostServerError(
                     "Received {} response code when making request: {}".format(
                         res.status_code, res.text
                     )
                 )
 
-            return res.json()
+            return res if raw else res.json()
 
         except Exception as e:
+            if raise_errors and isinstance(e, PhostServerError):
+                raise e
+            elif raise_errors and isinstance(e, RequestsConnectionError):
+                raise PhostServerError("Error while communicating with the server's API")
+
             show_stacktrace = True
             if isinstance(e, PhostServerError):
                 show_stacktrace = False
@@ -96,6 +185,37 @@ class GlobalAppState(object):
             save_cookies(self.session.cookies.get_dict())
             exit(1)
 
+    def get_capabilities(self) -> dict:
+        """ Returns the features supported by the server, fetching them the first time """
+
+        if self.capabilities is None:
+            try:
+                self.capabilities = self.api_call("capabilities/", raise_errors=True)
+            except PhostServerError:
+                # Servers from before capabilities were reported can read everything but zstd
+                self.capabilities = {"compression": LEGACY_SERVER_CODECS}
+
+        return self.capabilities
+
+    @staticmethod
+    def cache_response(res: requests.Response, body: bytes):
+        save_cached_response(
+            res.url,
+            res.headers["ETag"],
+            {key: res.headers[key] for key in CACHED_HEADERS if key in res.headers},
+            body,
+        )
+
+    @staticmethod
+    def open_response_cache(res: requests.Response) -> CachedResponseWriter:
+        """ Returns a writer that caches the body of the streamed response `res` as it's read """
+
+        return CachedResponseWriter(
+            res.url,
+            res.headers["ETag"],
+            {key: res.headers[key] for key in CACHED_HEADERS if key in res.headers},
+        )
+
     def login(self):
         res = self.api_call(
             "login/",
@@ -128,48 +248,166 @@ def print_table(rows):
     print(table.table)
 
 
-def list_deployments():
-    def process_versions(versions: List[dict]) -> (str, str):
-        active_version = "None"
-        versions_string = ""
+# Number of streamed deployments that are buffered up and printed together as a table
+DEPLOYMENTS_TABLE_CHUNK_SIZE = 100
 
-        for v in sorted(versions, key=lambda version: version["created_on"]):
-            if v["active"]:
-                active_version = v["version"]
+# Spaces between the columns of tables, matching the padding used by `print_table`
+TABLE_COLUMN_PADDING = 3
 
-            if versions_string:
-                versions_string += ", "
-            versions_string += v["version"]
 
-        return (active_version, versions_string)
+def fit_cell(cell: str, width: int) -> str:
+    """ Pads `cell` to `width` columns, truncating it with an ellipsis if it's wider than that """
 
-    deployments = STATE.api_call("deployments/")
-    table_headers = ["Name", "URL", "Creation Date", "Active Version", "All Versions", "Categories"]
-    table_data = map(
-        lambda datum: [
-            datum["name"],
-            "{}://{}.{}/".format(
-                STATE.conf["hosting_protocol"], datum["subdomain"], STATE.conf["hosting_base_url"]
-            ),
-            dateutil.parser.parse(datum["created_on"]).strftime("%Y-%m-%d"),
-            *process_versions(datum["versions"]),
-            ", ".join(
-                filter(None, map(lambda category: category["category"], datum["categories"]))
-            ),
-        ],
-        deployments,
-    )
+    if visible_width(cell) > width:
+        while cell and visible_width(cell) > width - len("..."):
+            cell = cell[:-1]
+        cell = (cell + "...")[:width]
 
-    table = SingleTable([table_headers, *table_data])
-    table.inner_column_border = False
-    table.inner_footing_row_border = False
-    table.inner_heading_row_border = False
-    table.inner_row_border = False
-    table.outer_border = False
-    table.padding_left = 0
-    table.padding_right = 3
+    return cell + " " * (width - visible_width(cell))
+
+
+def format_table_row(row: list, widths: list) -> str:
+    """ Formats a table row with fixed column widths, like `print_table` would if those were the
+    widths of the widest cells.  The last column is never truncated since nothing follows it. """
+
+    cells = [fit_cell(cell, width) for (cell, width) in zip(row[:-1], widths)]
+    return (" " * TABLE_COLUMN_PADDING).join([*cells, row[-1]]).rstrip()
+
+
+def iter_deployment_lines(**params):
+    """ Streams all deployments matching the supplied filters from the server as NDJSON, lazily
+    yielding one line of JSON per deployment as it arrives. """
+
+    params = {"format": "ndjson", **{k: v for (k, v) in params.items() if v}}
+    res = STATE.api_call("deployments/?{}".format(urlencode(params)), raw=True, stream=True)
+    # The response is cached as it arrives, but only kept once it has been read to the end
+    cache = None
+    if "ETag" in res.headers and not getattr(res, "from_cache", False):
+        cache = STATE.open_response_cache(res)
+    try:
+        for line in res.iter_lines():
+            if line:
+                if cache is not None:
+                    cache.write(line + b"\n")
+                yield line.decode("utf-8")
+
+        if cache is not None:
+            cache.commit()
+            cache = None
+    finally:
+        if cache is not None:
+            cache.discard()
+        res.close()
+
+
+def iter_deployment_chunks(lines, chunk_size=DEPLOYMENTS_TABLE_CHUNK_SIZE):
+    chunk = []
+    for line in lines:
+        chunk.append(json.loads(line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def format_versions(datum: dict) -> str:
+    versions = sorted(datum["versions"], key=lambda version: version["created_on"])
+    return ", ".join(version["version"] for version in versions)
+
+
+def format_categories(datum: dict) -> str:
+    return ", ".join(filter(None, map(lambda category: category["category"], datum["categories"])))
 
-    print(table.table)
+
+# Table column header and formatter for each field that can be requested for `phost ls`
+LIST_COLUMNS = {
+    "id": ("ID", lambda datum: datum["id"]),
+    "name": ("Name", lambda datum: datum["name"]),
+    "subdomain": (
+        "URL",
+        lambda datum: "{}://{}.{}/".format(
+            STATE.conf["hosting_protocol"], datum["subdomain"], STATE.conf["hosting_base_url"]
+        ),
+    ),
+    "created_on": (
+        "Creation Date",
+        lambda datum: dateutil.parser.parse(datum["created_on"]).strftime("%Y-%m-%d"),
+    ),
+    "not_found_document": ("404 Document", lambda datum: datum["not_found_document"] or ""),
+    "active_version": ("Active Version", lambda datum: datum["active_version"] or "None"),
+    "versions": ("All Versions", format_versions),
+    "categories": ("Categories", format_categories),
+    "total_bytes": ("Size", lambda datum: format_bytes(datum["total_bytes"])),
+}
+
+DEFAULT_LIST_FIELDS = [
+    "name",
+    "subdomain",
+    "created_on",
+    "active_version",
+    "versions",
+    "categories",
+    "total_bytes",
+]
+
+# Field and direction (whether to sort in descending order) for each `phost ls --sort` key
+LIST_SORT_KEYS = {
+    "name": ("name", False),
+    "created": ("created_on", False),
+    "size": ("total_bytes", True),
+}
+
+
+def sort_deployment_lines(lines, sort: str) -> list:
+    (field, descending) = LIST_SORT_KEYS[sort]
+    deployments = [(json.loads(line), line) for line in lines]
+    deployments.sort(key=lambda deployment: deployment[0][field], reverse=descending)
+    return [line for (_, line) in deployments]
+
+
+def list_deployments(fields=None, as_json=False, sort=None, **filters):
+    """ Prints all deployments matching `filters`, ordered by the `sort` key if supplied.  Only
+    the fields that are rendered or sorted by are requested from the server. """
+
+    if fields is None:
+        fields = DEFAULT_LIST_FIELDS
+    invalid_fields = [field for field in fields if field not in LIST_COLUMNS]
+    if invalid_fields:
+        print("Invalid fields: {}".format(", ".join(invalid_fields)))
+        exit(1)
+
+    table_headers = [LIST_COLUMNS[field][0] for field in fields]
+
+    requested_fields = list(fields)
+    if sort is not None and LIST_SORT_KEYS[sort][0] not in requested_fields:
+        requested_fields.append(LIST_SORT_KEYS[sort][0])
+
+    lines = iter_deployment_lines(fields=",".join(requested_fields), **filters)
+    # Sorting needs the full list, so sorted lists can't be printed as they arrive
+    if sort is not None:
+        lines = sort_deployment_lines(lines, sort)
+    if as_json:
+        try:
+            for line in lines:
+                print(line, flush=True)
+        except BrokenPipeError:
+            # Output was piped into something like `head` which has stopped reading
+            sys.stderr.close()
+        return
+
+    # Deployments are printed in chunks as they arrive rather than waiting for the full list.  The
+    # column widths are fixed by the headers and the first chunk so that later chunks line up.
+    widths = None
+    for deployments in iter_deployment_chunks(lines):
+        rows = [[LIST_COLUMNS[field][1](datum) for field in fields] for datum in deployments]
+        if widths is None:
+            rows.insert(0, table_headers)
+            widths = [max(visible_width(row[i]) for row in rows) for i in range(len(fields))]
+
+        for row in rows:
+            print(format_table_row(row, widths), flush=True)
 
 
 def list_proxies():
@@ -265,23 +503,101 @@ delete_deployment_decorators = compose(
 )
 
 
+def parse_fields_option(fields):
+    return [field.strip() for field in fields.split(",")] if fields else None
+
+
+list_deployments_decorators = compose(
+    click.option("--category", default=None, help="Only list deployments in this category"),
+    click.option(
+        "--name-prefix", default=None, help="Only list deployments whose names start with this"
+    ),
+    click.option(
+        "--created-after",
+        default=None,
+        help="Only list deployments created on or after this ISO-8601 date",
+    ),
+    click.option(
+        "--created-before", default=None, help="Only list deployments created before this date"
+    ),
+    click.option(
+        "--fields",
+        default=None,
+        help="Comma-separated list of fields to display; valid fields are: {}".format(
+            ", ".join(LIST_COLUMNS.keys())
+        ),
+    ),
+    click.option(
+        "--json",
+        "as_json",
+        default=False,
+        is_flag=True,
+        help="Print each deployment as a line of JSON instead of as a table",
+    ),
+    click.option(
+        "--sort",
+        type=click.Choice(list(LIST_SORT_KEYS.keys())),
+        default=None,
+        help="Sort deployments by name, creation date or size (largest first)",
+    ),
+)
+
+
 @deployment.command("ls")
-def list_deployments_deployment():
-    list_deployments()
+@list_deployments_decorators
+def list_deployments_deployment(
+    category, name_prefix, created_after, created_before, fields, as_json, sort
+):
+    list_deployments(
+        fields=parse_fields_option(fields),
+        as_json=as_json,
+        sort=sort,
+        category=category,
+        name_prefix=name_prefix,
+        created_after=created_after,
+        created_before=created_before,
+    )
 
 
 @main.command("ls", help="Shorthand for `phost deployment ls`")
-def list_deployments_main():
-    list_deployments()
+@list_deployments_decorators
+def list_deployments_main(
+    category, name_prefix, created_after, created_before, fields, as_json, sort
+):
+    list_deployments(
+        fields=parse_fields_option(fields),
+        as_json=as_json,
+        sort=sort,
+        category=category,
+        name_prefix=name_prefix,
+        created_after=created_after,
+        created_before=created_before,
+    )
 
 
-@with_query_lookup_decorators
-@main.command("show", help="Shorthand for `phost deployment show`")
-def show_deployment_main(query, lookup_field):
-    deployment_data = STATE.api_call("deployments/{}/?lookupField={}".format(query, lookup_field))
+def show_deployment(query, lookup_field, fields):
+    params = {"lookupField": lookup_field}
+    if fields:
+        params["fields"] = fields
+
+    deployment_data = STATE.api_call("deployments/{}/?{}".format(query, urlencode(params)))
     print(json.dumps(deployment_data, indent=4))
 
 
+show_deployment_decorators = compose(
+    with_query_lookup_decorators,
+    click.option(
+        "--fields", default=None, help="Comma-separated list of fields to show (default all)"
+    ),
+)
+
+
+@show_deployment_decorators
+@main.command("show", help="Shorthand for `phost deployment show`")
+def show_deployment_main(query, lookup_field, fields):
+    show_deployment(query, lookup_field, fields)
+
+
 @deployment.command("rm")
 @delete_deployment_decorators
 def delete_deployment_deployment(query, lookup_field, version):
@@ -294,8 +610,238 @@ def delete_deployment_main(query, lookup_field, version):
     delete_deployment(query, lookup_field, version)
 
 
+def activate_version(query, lookup_field, version):
+    version_data = STATE.api_call(
+        "deployments/{}/{}/activate/?lookupField={}".format(query, version, lookup_field),
+        method="POST",
+    )
+
+    print("Version {} is now active".format(version_data["version"]))
+
+
+activate_version_decorators = compose(with_query_lookup_decorators, click.argument("version"))
+
+
+@deployment.command(
+    "activate", help="Make an existing version of a deployment the active one; useful for rollbacks"
+)
+@activate_version_decorators
+def activate_version_deployment(query, lookup_field, version):
+    activate_version(query, lookup_field, version)
+
+
+@main.command("activate", help="Shorthand for `phost deployment activate`")
+@activate_version_decorators
+def activate_version_main(query, lookup_field, version):
+    activate_version(query, lookup_field, version)
+
+
+def parse_retention_limit(_ctx, _param, value):
+    if value is None or value == "default":
+        return value
+    try:
+        limit = int(value)
+        if limit >= 0:
+            return limit
+    except ValueError:
+        pass
+
+    raise click.BadParameter("must be a non-negative number or `default`")
+
+
+def set_retention(query, lookup_field, keep_versions, keep_days):
+    """ Updates the retention policy of a deployment, printing the resulting policy """
+
+    policy = {}
+    for (field, value) in [("retain_versions", keep_versions), ("retain_days", keep_days)]:
+        if value is not None:
+            policy[field] = None if value == "default" else value
+
+    if policy:
+        deployment_data = STATE.api_call(
+            "deployments/{}/?lookupField={}".format(query, lookup_field),
+            method="PATCH",
+            json_body=policy,
+        )
+    else:
+        deployment_data = STATE.api_call(
+            "deployments/{}/?lookupField={}".format(query, lookup_field)
+        )
+
+    def describe(value) -> str:
+        return {None: "server default", 0: "no limit"}.get(value, str(value))
+
+    print("Most recent versions kept: {}".format(describe(deployment_data["retain_versions"])))
+    print("Days that versions are kept: {}".format(describe(deployment_data["retain_days"])))
+    print("The active version is always kept")
+
+
+retention_decorators = compose(
+    with_query_lookup_decorators,
+    click.option(
+        "--keep-versions",
+        default=None,
+        callback=parse_retention_limit,
+        help="Number of most recent versions to keep (0 for no limit, `default` for the server's)",
+    ),
+    click.option(
+        "--keep-days",
+        default=None,
+        callback=parse_retention_limit,
+        help="Keep versions newer than this many days (0 for no limit, `default` for the server's)",
+    ),
+)
+
+
+@deployment.command(
+    "retention", help="Show or set how many old versions of a deployment are kept around"
+)
+@retention_decorators
+def set_retention_deployment(query, lookup_field, keep_versions, keep_days):
+    set_retention(query, lookup_field, keep_versions, keep_days)
+
+
+@main.command("retention", help="Shorthand for `phost deployment retention`")
+@retention_decorators
+def set_retention_main(query, lookup_field, keep_versions, keep_days):
+    set_retention(query, lookup_field, keep_versions, keep_days)
+
+
+def negotiate_compression(compression=None) -> str:
+    """ Picks the compression to create archives with out of the codecs supported both locally and
+    by the server, preferring the explicitly requested one if the server supports it. """
+
+    server_codecs = STATE.get_capabilities()["compression"]
+    if compression is not None:
+        try:
+            (codec, _) = parse_compression(compression)
+        except ValueError as e:
+            print("Error: {}".format(e))
+            exit(1)
+
+        if codec not in supported_codecs():
+            print("Error: {} compression isn't supported by this Python installation".format(codec))
+            exit(1)
+        if codec in server_codecs:
+            return compression
+
+        print("The server doesn't support {} compression; negotiating another codec".format(codec))
+
+    return next(codec for codec in supported_codecs() if codec in server_codecs)
+
+
+def wait_for_job(job: dict, raise_errors=False) -> dict:
+    """ Polls the status of a deploy job with increasing delays until it has finished, printing
+    the stages that it goes through, and returns its result.  If the job fails, the error is
+    printed and the program exits, or a `PhostServerError` is raised if `raise_errors` is set. """
+
+    delay = JOB_POLL_INITIAL_DELAY
+    stage = None
+    while job["state"] not in ["succeeded", "failed"]:
+        if job["stage"] is not None and job["stage"] != stage:
+            stage = job["stage"]
+            print("Deploy job {}: {}...".format(job["id"], stage))
+
+        sleep(delay)
+        delay = min(delay * JOB_POLL_BACKOFF, JOB_POLL_MAX_DELAY)
+        job = STATE.api_call("jobs/{}/".format(job["id"]), raise_errors=raise_errors)
+
+    if job["state"] == "failed":
+        if raise_errors:
+            raise PhostServerError(job["error"])
+
+        print("Error: deploy job {} failed: {}".format(job["id"], job["error"]))
+        exit(1)
+
+    return job["result"]
+
+
+def upload_archive(
+    resource_path: str,
+    directory: str,
+    compression: str,
+    fields: dict,
+    file_paths=None,
+    max_rate=None,
+    **kwargs
+):
+    """ Uploads an archive of `directory` (or only the files at `file_paths` within it) in the
+    `file` field of a multipart request along with the text `fields` (`None` fields are left
+    out) and returns the response.  If the server runs deploy jobs, the archive is processed
+    asynchronously and the job is polled until it has finished. """
+
+    if not STATE.get_capabilities().get("deploy_jobs"):
+        return post_archive(
+            resource_path, directory, compression, fields, file_paths, max_rate, **kwargs
+        )
+
+    job = post_archive(
+        resource_path,
+        directory,
+        compression,
+        fields,
+        file_paths,
+        max_rate,
+        headers={"Prefer": "respond-async"},
+        **kwargs
+    )
+    return wait_for_job(job, raise_errors=kwargs.get("raise_errors", False))
+
+
+def post_archive(
+    resource_path: str,
+    directory: str,
+    compression: str,
+    fields: dict,
+    file_paths=None,
+    max_rate=None,
+    **kwargs
+):
+    """ Posts an archive of `directory` along with `fields` (see `upload_archive`).  Archives of
+    large directories are uploaded through a resumable upload session.  Otherwise, if the server
+    accepts chunked requests, the archive is streamed into the request while it's being created,
+    and if it doesn't, it's written to a temporary file first. """
+
+    fields = {name: value for (name, value) in fields.items() if value is not None}
+    (codec, _) = parse_compression(compression)
+    file_name = "directory{}".format(ARCHIVE_SUFFIXES[codec])
+
+    # Large archives are uploaded through resumable upload sessions, which need the archive to be
+    # on disk so that chunks can be re-read when they're retried or resumed
+    threshold = STATE.conf.get("resumable_upload_threshold", RESUMABLE_UPLOAD_THRESHOLD)
+    if STATE.get_capabilities().get("upload_sessions") and (
+        archive_input_size(directory, file_paths) >= threshold
+    ):
+        with create_archive(directory, file_paths, compression) as archive:
+            return deploy_resumable(STATE, resource_path, archive, fields, max_rate, **kwargs)
+
+    if not STATE.get_capabilities().get("chunked_uploads"):
+        if max_rate is not None:
+            print("The server doesn't accept streamed uploads; ignoring `--max-rate`")
+
+        multipart_data = {name: ("", value) for (name, value) in fields.items()}
+        multipart_data["file"] = (file_name, create_archive(directory, file_paths, compression))
+        return STATE.api_call(resource_path, method="POST", multipart_data=multipart_data, **kwargs)
+
+    def stream_body():
+        progress = TransferProgress(max_rate)
+        chunks = iter_archive_chunks(directory, file_paths, compression)
+        return build_multipart_stream(fields, file_name, progress.wrap(chunks))
+
+    return STATE.api_call(resource_path, method="POST", stream_body=stream_body, **kwargs)
+
+
 def create_deployment(
-    name, subdomain, directory, version, random_subdomain, categories, spa, not_found_document
+    name,
+    subdomain,
+    directory,
+    version,
+    random_subdomain,
+    categories,
+    spa,
+    not_found_document,
+    compression,
+    max_rate,
 ):
     if spa and not_found_document is None:
         not_found_document = "./index.html"
@@ -309,19 +855,17 @@ def create_deployment(
     elif not subdomain:
         subdomain = slugify(name)
 
-    # Compress the target directory into a tempfile .tgz archive
-    tgz_file = compress_dir(directory)
-
-    multipart_data = {
-        "name": ("", name),
-        "subdomain": ("", subdomain),
-        "file": ("directory.tgz", tgz_file),
-        "version": ("", version),
-        "categories": ("", ",".join(categories)),
-        "not_found_document": ("", not_found_document),
+    fields = {
+        "name": name,
+        "subdomain": subdomain,
+        "version": version,
+        "categories": ",".join(categories),
+        "not_found_document": not_found_document,
     }
 
-    res = STATE.api_call("deployments/", method="POST", multipart_data=multipart_data)
+    res = upload_archive(
+        "deployments/", directory, negotiate_compression(compression), fields, max_rate=max_rate
+    )
     print("Deployment successfully created: {}".format(res["url"]))
 
 
@@ -346,7 +890,27 @@ def create_proxy(name, target_url, subdomain, random_subdomain, enable_cors):
     print("Proxy successfully created: {}".format(res["url"]))
 
 
+compression_option = click.option(
+    "--compression",
+    default=None,
+    help=(
+        "How to compress the uploaded archive: one of zstd, gzip, xz, bz2, or none, optionally"
+        " followed by a level (`gzip:9`).  Defaults to the best codec supported by the server."
+    ),
+)
+
+
+max_rate_option = click.option(
+    "--max-rate",
+    default=None,
+    callback=lambda _ctx, _param, value: None if value is None else parse_rate(value),
+    help="Limit the upload to this many bytes per second; accepts K, M, and G suffixes",
+)
+
+
 create_deployment_decorators = compose(
+    compression_option,
+    max_rate_option,
     click.argument("name"),
     click.argument("directory"),
     click.option(
@@ -398,36 +962,132 @@ create_deployment_decorators = compose(
 @main.command("create", help="Shorthand for `phost deployment create`")
 @create_deployment_decorators
 def create_deployment_main(
-    name, subdomain, directory, version, private, category, spa, not_found_document
+    name,
+    subdomain,
+    directory,
+    version,
+    private,
+    category,
+    spa,
+    not_found_document,
+    compression,
+    max_rate,
 ):
     create_deployment(
-        name, subdomain, directory, version, private, category, spa, not_found_document
+        name,
+        subdomain,
+        directory,
+        version,
+        private,
+        category,
+        spa,
+        not_found_document,
+        compression,
+        max_rate,
     )
 
 
 @deployment.command("create")
 @create_deployment_decorators
 def create_deployment_deployment(
-    name, subdomain, directory, version, private, category, spa, not_found_document
+    name,
+    subdomain,
+    directory,
+    version,
+    private,
+    category,
+    spa,
+    not_found_document,
+    compression,
+    max_rate,
 ):
     create_deployment(
-        name, subdomain, directory, version, private, category, spa, not_found_document
+        name,
+        subdomain,
+        directory,
+        version,
+        private,
+        category,
+        spa,
+        not_found_document,
+        compression,
+        max_rate,
     )
 
 
 with_update_deployment_decorators = compose(
-    with_query_lookup_decorators, click.argument("version"), click.argument("directory")
+    with_query_lookup_decorators,
+    click.argument("version"),
+    click.argument("directory"),
+    click.option(
+        "--full",
+        default=False,
+        is_flag=True,
+        help="Upload the entire directory rather than only the files that changed",
+    ),
+    compression_option,
+    max_rate_option,
 )
 
 
-def update_deployment(query, lookup_field, version, directory):
+def push_delta(query, lookup_field, version, directory, compression, max_rate):
+    """ Uploads only the files in `directory` that the server doesn't already have, along with
+    the manifest of the full directory which the server uses to build the new version. """
+
+    manifest = build_manifest(directory)
+    diff = STATE.api_call(
+        "deployments/{}/{}/diff/?lookupField={}".format(query, version, lookup_field),
+        method="POST",
+        json_body={"files": manifest},
+        raise_errors=True,
+    )
+
+    # Only one file is uploaded for each missing digest
+    missing = set(diff["missing"])
+    file_paths = []
+    for (file_path, entry) in manifest.items():
+        if entry["sha256"] in missing:
+            missing.remove(entry["sha256"])
+            file_paths.append(file_path)
+
+    print(
+        "Uploading {} of {} files ({} bytes)".format(
+            len(file_paths), len(manifest), sum(manifest[path]["size"] for path in file_paths)
+        )
+    )
+
+    fields = {"manifest": json.dumps({"files": manifest})}
+    if diff["base_version"] is not None:
+        fields["base_version"] = diff["base_version"]
+    upload_archive(
+        "deployments/{}/{}/?lookupField={}".format(query, version, lookup_field),
+        directory,
+        compression,
+        fields,
+        file_paths=file_paths,
+        max_rate=max_rate,
+        raise_errors=True,
+    )
+
+
+def update_deployment(query, lookup_field, version, directory, full, compression, max_rate):
     """ Pushes a new version for an existing deployment """
 
-    multipart_data = {"file": compress_dir(directory)}
-    STATE.api_call(
+    compression = negotiate_compression(compression)
+    if not full:
+        try:
+            push_delta(query, lookup_field, version, directory, compression, max_rate)
+            print("Deployment successfully updated")
+            return
+        except PhostServerError as e:
+            print("Delta upload failed ({}); falling back to a full upload".format(e))
+
+    upload_archive(
         "deployments/{}/{}/?lookupField={}".format(query, version, lookup_field),
-        multipart_data=multipart_data,
-        method="POST",
+        directory,
+        compression,
+        {},
+        max_rate=max_rate,
     )
 
     print("Deployment successfully updated")
@@ -443,21 +1103,24 @@ update_help = (
 
 @deployment.command("update", help=update_help)
 @with_update_deployment_decorators
-def update_deployment_deployment(query, lookup_field, version, directory):
-    update_deployment(query, lookup_field, version, directory)
+def update_deployment_deployment(
+    query, lookup_field, version, directory, full, compression, max_rate
+):
+    update_deployment(query, lookup_field, version, directory, full, compression, max_rate)
 
 
 @main.command("update", help="Shorthand for `phost deployment update`\n\n" + update_help)
 @with_update_deployment_decorators
-def update_deployment_main(query, lookup_field, version, directory):
-    update_deployment(query, lookup_field, version, directory)
+def update_deployment_main(
+    query, lookup_field, version, directory, full, compression, max_rate
+):
+    update_deployment(query, lookup_field, version, directory, full, compression, max_rate)
 
 
-@with_query_lookup_decorators
+@show_deployment_decorators
 @deployment.command("show")
-def show_deployment(query, lookup_field):
-    deployment_data = STATE.api_call("deployments/{}/?lookupField={}".format(query, lookup_field))
-    print(json.dumps(deployment_data, indent=4))
+def show_deployment_deployment(query, lookup_field, fields):
+    show_deployment(query, lookup_field, fields)
 
 
 @proxy.command("ls")
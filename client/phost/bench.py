@@ -0,0 +1,104 @@
+""" Benchmarks the compression codecs that deployments can be uploaded with.  Run with
+`python -m phost.bench [DIRECTORY]`; a sample tree of text assets and already-compressed images is
+generated if no directory is supplied. """
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import click
+from terminaltables import SingleTable
+
+from .upload import supported_codecs, write_archive
+
+
+class CountingWriter(object):
+    """ Discards everything written to it, only keeping track of how many bytes were written """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.size += len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+
+def create_sample_tree(dir_path: str, file_count: int):
+    words = ["function", "return", "const", "div", "class", "span", "margin", "color", "export"]
+    rng = random.Random(0)
+
+    for i in range(file_count):
+        sub_dir = os.path.join(dir_path, "dir-{}".format(i % 10))
+        os.makedirs(sub_dir, exist_ok=True)
+        extension = [".js", ".css", ".html", ".png"][i % 4]
+        with open(os.path.join(sub_dir, "file-{}{}".format(i, extension)), "wb") as f:
+            if extension == ".png":
+                f.write(os.urandom(rng.randint(1024, 64 * 1024)))
+            else:
+                word_count = rng.randint(100, 10000)
+                f.write(" ".join(rng.choice(words) for _ in range(word_count)).encode("utf-8"))
+
+
+def tree_size(dir_path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(parent_dir, file_name))
+        for (parent_dir, _, file_names) in os.walk(dir_path)
+        for file_name in file_names
+    )
+
+
+@click.command()
+@click.argument("directory", required=False)
+@click.option("--files", default=400, help="Number of files in the generated sample tree")
+@click.option(
+    "--compression",
+    "-c",
+    multiple=True,
+    help="Compression to benchmark (`codec[:level]`); may be provided multiple times",
+)
+def main(directory, files, compression):
+    temp_dir = None
+    if directory is None:
+        temp_dir = tempfile.mkdtemp()
+        directory = temp_dir
+        create_sample_tree(directory, files)
+
+    if not compression:
+        compression = ["none", "gzip:1", "gzip", "gzip:9", "bz2", "xz"]
+        if "zstd" in supported_codecs():
+            compression += ["zstd", "zstd:19"]
+
+    try:
+        size = tree_size(directory)
+        rows = [["Compression", "Time", "Size", "Ratio", "Throughput"]]
+        for spec in compression:
+            out = CountingWriter()
+            start = time.perf_counter()
+            write_archive(out, directory, compression=spec)
+            elapsed = time.perf_counter() - start
+
+            rows.append(
+                [
+                    spec,
+                    "{:.3f}s".format(elapsed),
+                    "{:,}".format(out.size),
+                    "{:.3f}".format(out.size / size) if size else "-",
+                    "{:.1f} MB/s".format(size / elapsed / 1024 / 1024),
+                ]
+            )
+
+        print("{:,} bytes of input".format(size))
+        table = SingleTable(rows)
+        table.outer_border = False
+        print(table.table)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=E1120
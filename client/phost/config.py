@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import pathlib
 import toml
@@ -13,6 +15,8 @@ DEFAULT_CONF = {
 CONFIG_DIR_PATH = os.path.join(os.path.expanduser("~"), ".phost")
 CONF_FILE_PATH = os.path.join(CONFIG_DIR_PATH, "conf.toml")
 COOKIE_FILE_PATH = os.path.join(CONFIG_DIR_PATH, "cookies.toml")
+RESPONSE_CACHE_DIR_PATH = os.path.join(CONFIG_DIR_PATH, "response-cache")
+UPLOAD_SESSIONS_FILE_PATH = os.path.join(CONFIG_DIR_PATH, "upload-sessions.toml")
 
 
 def load_cookies() -> dict:
@@ -28,6 +32,95 @@ def save_cookies(cookies: dict):
         f.write(toml.dumps(cookies))
 
 
+def get_cached_response_path(url: str) -> str:
+    return os.path.join(RESPONSE_CACHE_DIR_PATH, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+
+def load_cached_response(url: str):
+    """ Returns a `(etag, headers, body)` tuple for the cached response for `url`, or `None` if
+    no response has been cached for it. """
+
+    try:
+        with open(get_cached_response_path(url), "rb") as f:
+            metadata = json.loads(f.readline().decode("utf-8"))
+            body = f.read()
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if metadata.get("url") != url:
+        return None
+
+    return (metadata["etag"], metadata["headers"], body)
+
+
+class CachedResponseWriter(object):
+    """ Caches a response body that is written piece by piece as it's read from the server.  The
+    body goes into a temporary file that only replaces the cached response for `url` once
+    `commit` is called, so responses that weren't read to the end are never cached.  The metadata
+    is stored as a line of JSON followed by the raw body. """
+
+    def __init__(self, url: str, etag: str, headers: dict):
+        pathlib.Path(RESPONSE_CACHE_DIR_PATH).mkdir(parents=True, exist_ok=True)
+        self.path = get_cached_response_path(url)
+        self.tmp_path = "{}.{}".format(self.path, os.getpid())
+        self.file = open(self.tmp_path, "wb")
+
+        metadata = {"url": url, "etag": etag, "headers": headers}
+        self.file.write(json.dumps(metadata).encode("utf-8") + b"\n")
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+def save_cached_response(url: str, etag: str, headers: dict, body: bytes):
+    """ Caches the body and headers of a response along with the `ETag` used to revalidate it """
+
+    writer = CachedResponseWriter(url, etag, headers)
+    writer.write(body)
+    writer.commit()
+
+
+def load_upload_sessions() -> dict:
+    if not os.path.isfile(UPLOAD_SESSIONS_FILE_PATH):
+        return {}
+
+    with open(UPLOAD_SESSIONS_FILE_PATH) as f:
+        try:
+            return toml.loads(f.read())
+        except toml.TomlDecodeError:
+            return {}
+
+
+def load_upload_session(archive_digest: str):
+    """ Returns the resumable upload session that the archive with the given digest was last
+    being uploaded through, or `None` if there isn't one. """
+
+    return load_upload_sessions().get(archive_digest)
+
+
+def save_upload_session(archive_digest: str, upload_session):
+    """ Records the upload session that an archive is being uploaded through so that the upload
+    can be resumed by a later run, or forgets it if `upload_session` is `None`. """
+
+    upload_sessions = load_upload_sessions()
+    if upload_session is None:
+        upload_sessions.pop(archive_digest, None)
+    else:
+        upload_sessions[archive_digest] = upload_session
+
+    with open(UPLOAD_SESSIONS_FILE_PATH, "w") as f:
+        f.write(toml.dumps(upload_sessions))
+
+
 def init_config(conf_file_path):
     if not os.path.isfile(conf_file_path):
         pathlib.Path(os.path.dirname(conf_file_path)).mkdir(parents=False, exist_ok=True)
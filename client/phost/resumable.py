@@ -0,0 +1,142 @@
+""" Uploads large archives through resumable upload sessions.  The archive is sent in numbered,
+checksummed chunks which are retried individually when they fail.  The session used for each
+archive is remembered, so running the same command again after an interrupted upload only sends
+the chunks that the server doesn't have yet; archives are created deterministically, so an
+unchanged directory produces the same archive and picks up the same session. """
+
+import hashlib
+import math
+import os
+import sys
+from time import sleep
+
+from .config import load_upload_session, save_upload_session
+from .stream import TransferProgress, format_bytes
+from .upload import hash_file
+from .util import PhostServerError
+
+
+# Archives of directories larger than this are uploaded through resumable upload sessions
+RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024
+
+# Chunk size used if the server doesn't suggest one
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Number of times that each chunk is attempted before the upload is abandoned, and the delay
+# before the first retry, which doubles with every attempt
+CHUNK_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+
+class UploadInterrupted(Exception):
+    pass
+
+
+def is_received(ranges: list, start: int, end: int) -> bool:
+    return any(
+        received_start <= start and end <= received_end
+        for (received_start, received_end) in ranges
+    )
+
+
+def open_session(state, archive_digest: str, size: int) -> dict:
+    """ Returns the session that an earlier upload of the same archive went through if it still
+    exists on the server, or creates a new one. """
+
+    upload_session = load_upload_session(archive_digest)
+    if upload_session is not None:
+        try:
+            status = state.api_call("uploads/{}/".format(upload_session["id"]), raise_errors=True)
+            return {**upload_session, **status}
+        except PhostServerError:
+            # The session has expired or was already deployed
+            save_upload_session(archive_digest, None)
+
+    status = state.api_call(
+        "uploads/", method="POST", json_body={"size": size, "sha256": archive_digest}
+    )
+    upload_session = {
+        "id": status["id"],
+        "chunk_size": status.get("chunk_size") or DEFAULT_CHUNK_SIZE,
+    }
+    save_upload_session(archive_digest, upload_session)
+    return {**upload_session, **status}
+
+
+def send_chunk(state, upload_id: str, index: int, offset: int, data: bytes):
+    headers = {
+        "Content-Type": "application/octet-stream",
+        "X-Content-SHA256": hashlib.sha256(data).hexdigest(),
+    }
+    for attempt in range(CHUNK_ATTEMPTS):
+        try:
+            state.api_call(
+                "uploads/{}/{}/?offset={}".format(upload_id, index, offset),
+                method="PUT",
+                body=data,
+                headers=headers,
+                raise_errors=True,
+            )
+            return
+        except PhostServerError as e:
+            if attempt == CHUNK_ATTEMPTS - 1:
+                raise UploadInterrupted(str(e))
+
+            delay = RETRY_DELAY * 2 ** attempt
+            sys.stderr.write("\nChunk {} failed ({}); retrying in {}s\n".format(index, e, delay))
+            sleep(delay)
+
+
+def upload_resumable(state, archive, max_rate=None) -> tuple:
+    """ Uploads `archive` (a file on disk) through a resumable upload session, sending only the
+    chunks that the server hasn't received yet, and finalizes it.  Returns the ID of the session
+    and the digest of the archive. """
+
+    size = os.fstat(archive.fileno()).st_size
+    archive_digest = hash_file(archive.name)
+    upload_session = open_session(state, archive_digest, size)
+    upload_id = upload_session["id"]
+    chunk_size = upload_session["chunk_size"]
+
+    if upload_session["received_bytes"]:
+        print(
+            "Resuming upload; {} of {} already uploaded".format(
+                format_bytes(upload_session["received_bytes"]), format_bytes(size)
+            )
+        )
+
+    progress = TransferProgress(max_rate)
+    for index in range(math.ceil(size / chunk_size)):
+        offset = index * chunk_size
+        end = min(size, offset + chunk_size)
+        if is_received(upload_session["received"], offset, end):
+            continue
+
+        archive.seek(offset)
+        send_chunk(state, upload_id, index, offset, archive.read(end - offset))
+        progress.update(end - offset)
+
+    if progress.start is not None:
+        progress.report(done=True)
+
+    state.api_call("uploads/{}/finalize/".format(upload_id), method="POST")
+    return (upload_id, archive_digest)
+
+
+def deploy_resumable(state, resource_path: str, archive, fields: dict, max_rate=None, **kwargs):
+    """ Uploads `archive` through a resumable upload session and then deploys it by posting the
+    text `fields` along with the session's ID to `resource_path`. """
+
+    try:
+        (upload_id, archive_digest) = upload_resumable(state, archive, max_rate)
+    except UploadInterrupted as e:
+        print("\nError: the upload was interrupted ({})".format(e))
+        print("Run the same command again to resume it")
+        exit(1)
+
+    res = state.api_call(
+        resource_path, method="POST", form_data={**fields, "upload_id": upload_id}, **kwargs
+    )
+    # The server deletes sessions once they've been deployed
+    save_upload_session(archive_digest, None)
+    return res
@@ -0,0 +1,179 @@
+""" Streams archives of deployment directories directly into request bodies as they're created,
+without writing them to disk first. """
+
+import queue
+import sys
+import threading
+import time
+import uuid
+
+from .upload import write_archive
+
+
+# Size of the chunks that the archive is sent in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of chunks buffered between the compression thread and the request
+STREAM_QUEUE_SIZE = 16
+
+# Minimum number of seconds between progress updates
+PROGRESS_INTERVAL = 0.5
+
+
+class QueueWriter(object):
+    """ File-like object that buffers everything written to it into fixed-size chunks and puts
+    them into a bounded queue, blocking while the queue is full. """
+
+    def __init__(self, chunk_queue: queue.Queue, cancelled: threading.Event):
+        self.queue = chunk_queue
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+        self.size = 0
+
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+        raise IOError("The archive stream was closed")
+
+    def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self.put(bytes(self.buffer[:STREAM_CHUNK_SIZE]))
+            del self.buffer[:STREAM_CHUNK_SIZE]
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer = bytearray()
+
+
+def iter_archive_chunks(dir_path: str, file_paths=None, compression="gzip"):
+    """ Lazily yields the chunks of a compressed archive of `dir_path` (see `write_archive`).  The
+    archive is created on a separate thread so that compression overlaps with sending the chunks,
+    and only a bounded number of chunks is ever held in memory. """
+
+    chunk_queue = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    cancelled = threading.Event()
+    writer = QueueWriter(chunk_queue, cancelled)
+
+    def produce():
+        try:
+            write_archive(writer, dir_path, file_paths, compression)
+            writer.flush()
+            writer.put(None)
+        except Exception as e:  # pylint: disable=W0703
+            if not cancelled.is_set():
+                writer.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                return
+            elif isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        cancelled.set()
+
+
+def iter_multipart(boundary: str, fields: dict, file_name: str, file_chunks):
+    """ Yields a `multipart/form-data` body containing the text fields in `fields` followed by a
+    file named `file` whose contents are streamed from `file_chunks` """
+
+    for (name, value) in fields.items():
+        yield (
+            '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                boundary, name, value
+            ).encode("utf-8")
+        )
+
+    yield (
+        "--{}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="{}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).format(boundary, file_name).encode("utf-8")
+    yield from file_chunks
+    yield "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+
+
+def build_multipart_stream(fields: dict, file_name: str, file_chunks) -> tuple:
+    """ Returns the content type and a lazily generated body for a multipart upload of a file
+    along with some text fields """
+
+    boundary = uuid.uuid4().hex
+    content_type = "multipart/form-data; boundary={}".format(boundary)
+    return (content_type, iter_multipart(boundary, fields, file_name, file_chunks))
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+
+    return "{:.1f} GB".format(size)
+
+
+class TransferProgress(object):
+    """ Tracks the progress of an upload, periodically reporting the amount of data sent and the
+    throughput, and optionally limits the rate at which data is sent. """
+
+    def __init__(self, max_rate=None, out=sys.stderr):
+        self.max_rate = max_rate
+        self.out = out
+        self.sent = 0
+        self.start = None
+        self.last_report = 0
+
+    def report(self, done=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.sent / elapsed if elapsed > 0 else 0
+        self.out.write(
+            "\rUploaded {} ({}/s){}".format(
+                format_bytes(self.sent), format_bytes(rate), "\n" if done else "  "
+            )
+        )
+        self.out.flush()
+        self.last_report = time.perf_counter()
+
+    def update(self, size: int):
+        """ Records that `size` more bytes have been sent, sleeping if that puts the transfer over
+        the rate limit. """
+
+        if self.start is None:
+            self.start = time.perf_counter()
+        self.sent += size
+
+        now = time.perf_counter()
+        if self.max_rate is not None:
+            # Sleep until the average rate since the start is back under the limit
+            delay = self.sent / self.max_rate - (now - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.report()
+
+    def wrap(self, chunks):
+        """ Yields all chunks from `chunks`, recording and throttling their transfer """
+
+        self.start = time.perf_counter()
+        for chunk in chunks:
+            yield chunk
+            self.update(len(chunk))
+
+        self.report(done=True)
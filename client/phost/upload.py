@@ -1,16 +1,247 @@
 """ Contains functions for compressing and uploaded directories to be served. """
 
+import hashlib
 import os
+import struct
 import tarfile
 import tempfile
+import zlib
 
 
-def compress_dir(dir_path: str):
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Compression codecs that archives can be created with, in order of preference
+COMPRESSION_CODECS = ["zstd", "gzip", "xz", "bz2", "none"]
+
+# Codecs that are assumed to be supported by servers that don't report their capabilities
+LEGACY_SERVER_CODECS = ["gzip", "xz", "bz2", "none"]
+
+DEFAULT_COMPRESSION_LEVELS = {"zstd": 3, "gzip": 6, "xz": 6, "bz2": 9}
+COMPRESSION_LEVEL_RANGES = {"zstd": (1, 22), "gzip": (0, 9), "xz": (0, 9), "bz2": (1, 9)}
+
+ARCHIVE_SUFFIXES = {
+    "zstd": ".tar.zst",
+    "gzip": ".tgz",
+    "xz": ".tar.xz",
+    "bz2": ".tar.bz2",
+    "none": ".tar",
+}
+
+# Files with these extensions are already compressed, so they're stored as-is in gzip archives
+# rather than being compressed again.
+PRECOMPRESSED_EXTENSIONS = {
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+    ".avif",
+    ".ico",
+    ".woff",
+    ".woff2",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".webm",
+    ".zip",
+    ".gz",
+    ".br",
+    ".zst",
+    ".xz",
+    ".bz2",
+    ".7z",
+}
+
+
+def supported_codecs() -> list:
+    """ Returns the compression codecs that the local Python runtime can create archives with """
+
+    zstd_supported = "zst" in tarfile.TarFile.OPEN_METH
+    return [codec for codec in COMPRESSION_CODECS if codec != "zstd" or zstd_supported]
+
+
+def parse_compression(compression: str) -> tuple:
+    """ Parses a compression option of the form `codec[:level]` into a `(codec, level)` tuple,
+    raising a `ValueError` if it is invalid. """
+
+    (codec, _, level) = compression.partition(":")
+    if codec not in COMPRESSION_CODECS:
+        raise ValueError(
+            "Compression must be one of {}, optionally followed by `:<level>`".format(
+                ", ".join(COMPRESSION_CODECS)
+            )
+        )
+
+    if not level:
+        return (codec, DEFAULT_COMPRESSION_LEVELS.get(codec))
+    if codec == "none":
+        raise ValueError("A compression level can't be supplied without a codec")
+
+    (min_level, max_level) = COMPRESSION_LEVEL_RANGES[codec]
+    try:
+        level = int(level)
+    except ValueError:
+        level = None
+    if level is None or level < min_level or level > max_level:
+        raise ValueError(
+            "The {} compression level must be between {} and {}".format(codec, min_level, max_level)
+        )
+
+    return (codec, level)
+
+
+def is_precompressed(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in PRECOMPRESSED_EXTENSIONS
+
+
+class SegmentedGzipWriter(object):
+    """ Writes a single gzip member whose deflate stream is made up of segments that can each be
+    compressed at a different level.  Each segment is ended with a full flush so that the next
+    one can be started with a fresh compressor; the result is a regular gzip stream that can be
+    read by any decompressor, including the server's streaming tar reader. """
+
+    def __init__(self, fileobj, level: int):
+        self.fileobj = fileobj
+        self.level = level
+        self.compressor = self.create_compressor(level)
+        self.crc = zlib.crc32(b"")
+        self.size = 0
+
+        # Magic, deflate method, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    @staticmethod
+    def create_compressor(level: int):
+        return zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def set_level(self, level: int):
+        if level == self.level:
+            return
+
+        self.fileobj.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.compressor = self.create_compressor(level)
+        self.level = level
+
+    def write(self, data: bytes):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fileobj.write(self.compressor.compress(data))
+
+    def tell(self) -> int:
+        return self.size
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush(zlib.Z_FINISH))
+        self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+
+
+def iter_archive_members(dir_path: str, file_paths=None):
+    """ Yields `(path, arcname)` tuples for all entries of the directory (including the directory
+    itself), or only for the files at `file_paths` (relative to `dir_path`) if supplied. """
+
+    if file_paths is not None:
+        for file_path in file_paths:
+            yield (os.path.join(dir_path, file_path), file_path)
+        return
+
+    yield (dir_path, ".")
+    for (parent_dir, dir_names, file_names) in os.walk(dir_path):
+        dir_names.sort()
+        for name in sorted(dir_names + file_names):
+            path = os.path.join(parent_dir, name)
+            yield (path, os.path.join(".", os.path.relpath(path, dir_path)))
+
+
+def archive_input_size(dir_path: str, file_paths=None) -> int:
+    """ Returns the total size of the files that an archive of `dir_path` would contain """
+
     target_dir_path = os.path.join(os.getcwd(), dir_path)
-    temp_file = tempfile.NamedTemporaryFile(suffix=".tgz")
-    temp_filename = temp_file.name
+    return sum(
+        os.path.getsize(path)
+        for (path, _) in iter_archive_members(target_dir_path, file_paths)
+        if os.path.isfile(path)
+    )
+
+
+def open_archive(fileobj, codec: str, level):
+    if codec == "gzip":
+        return tarfile.open(fileobj=SegmentedGzipWriter(fileobj, level), mode="w")
+    elif codec == "zstd":
+        return tarfile.open(fileobj=fileobj, mode="w:zst", level=level)
+    elif codec == "xz":
+        return tarfile.open(fileobj=fileobj, mode="w:xz", preset=level)
+    elif codec == "bz2":
+        return tarfile.open(fileobj=fileobj, mode="w:bz2", compresslevel=level)
+    else:
+        return tarfile.open(fileobj=fileobj, mode="w")
 
-    with tarfile.open(temp_filename, mode="w:bz2") as out:
-        out.add(target_dir_path, arcname=".")
+
+def write_archive(fileobj, dir_path: str, file_paths=None, compression="gzip"):
+    """ Writes a tar archive of `dir_path` (or only the files at `file_paths` within it) to
+    `fileobj`, compressed as specified by `compression` (`codec[:level]`).  Symlinks are stored
+    as links when archiving the whole directory and followed otherwise. """
+
+    (codec, level) = parse_compression(compression)
+    out = open_archive(fileobj, codec, level)
+    out.dereference = file_paths is not None
+    gzip_writer = out.fileobj if codec == "gzip" else None
+
+    with out:
+        for (path, arcname) in iter_archive_members(dir_path, file_paths):
+            tarinfo = out.gettarinfo(path, arcname)
+            if not tarinfo.isreg():
+                out.addfile(tarinfo)
+                continue
+
+            if gzip_writer is not None:
+                gzip_writer.set_level(0 if is_precompressed(path) else level)
+            with open(path, "rb") as f:
+                out.addfile(tarinfo, f)
+
+    if gzip_writer is not None:
+        gzip_writer.close()
+
+
+def create_archive(dir_path: str, file_paths=None, compression="gzip"):
+    target_dir_path = os.path.join(os.getcwd(), dir_path)
+    (codec, _) = parse_compression(compression)
+    temp_file = tempfile.NamedTemporaryFile(suffix=ARCHIVE_SUFFIXES[codec])
+
+    write_archive(temp_file, target_dir_path, file_paths, compression)
+    temp_file.flush()
+    temp_file.seek(0)
 
     return temp_file
+
+
+def compress_dir(dir_path: str, compression="gzip"):
+    return create_archive(dir_path, compression=compression)
+
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def build_manifest(dir_path: str) -> dict:
+    """ Builds the manifest of a directory to be deployed, a mapping of the relative path of each
+    file in it to its SHA-256 digest and size. """
+
+    target_dir_path = os.path.join(os.getcwd(), dir_path)
+    files = {}
+    for (parent_dir, _, file_names) in os.walk(target_dir_path):
+        for file_name in file_names:
+            path = os.path.join(parent_dir, file_name)
+            if not os.path.isfile(path):
+                continue
+
+            files[os.path.relpath(path, target_dir_path)] = {
+                "sha256": hash_file(path),
+                "size": os.path.getsize(path),
+            }
+
+    return files
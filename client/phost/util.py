@@ -4,6 +4,12 @@
 from functools import reduce
 import uuid
 
+import click
+
+
+class PhostServerError(Exception):
+    pass
+
 
 class Composition(object):
     def __init__(self, inner_function, wrappers):
@@ -59,6 +65,23 @@ def create_random_subdomain() -> str:
     return uuid.uuid4().hex[:16]
 
 
+RATE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_rate(rate: str) -> float:
+    """ Parses a rate in bytes per second such as `500K` or `2M` """
+
+    suffix = rate[-1:].upper() if rate[-1:].isalpha() else ""
+    try:
+        value = float(rate[: len(rate) - len(suffix)]) * RATE_SUFFIXES[suffix]
+    except (KeyError, ValueError):
+        value = 0
+
+    if value <= 0:
+        raise click.BadParameter("`{}` is not a valid rate".format(rate))
+    return value
+
+
 def test_compose():
     def wrap(i: int):
         def wrapper(func):
@@ -50,11 +50,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First so that its timings include all other middleware
+    "serversite.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     # "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # After `AuthenticationMiddleware`, since only logged-in users can profile requests
+    "serversite.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -94,6 +98,78 @@ DATABASES = {
     }
 }
 
+# Maximum number of deployment lookups cached by each server process
+DEPLOYMENT_CACHE_SIZE = int(os.environ.get("DEPLOYMENT_CACHE_SIZE", 1024))
+
+# Maximum number of lookups of nonexistent deployments cached by each server process, kept apart
+# from the deployments so that requests for random subdomains don't evict them
+MISSING_DEPLOYMENT_CACHE_SIZE = int(os.environ.get("MISSING_DEPLOYMENT_CACHE_SIZE", 256))
+
+# Number of threads used to write out files when extracting uploaded archives
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", 8))
+
+# Store deployed files in a content-addressed blob store, hardlinking identical files between
+# versions and deployments rather than storing them multiple times
+DEDUPLICATE_DEPLOYMENTS = os.environ.get("DEDUPLICATE_DEPLOYMENTS", "").lower() in ("1", "true")
+
+# Whether the web server in front of Django decodes chunked request bodies, letting clients stream
+# uploads without knowing their size up front.  mod_wsgi does with `WSGIChunkedRequest On`; the
+# development server doesn't.
+CHUNKED_UPLOADS = os.environ.get("CHUNKED_UPLOADS", "true").lower() in ("1", "true")
+
+# Staging directories that haven't been touched in this many seconds are assumed to have been
+# abandoned by a server process that died mid-upload and are deleted
+STALE_STAGING_DIR_AGE = int(os.environ.get("STALE_STAGING_DIR_AGE", 24 * 60 * 60))
+
+# Maximum number of files per second that the trash reaper deletes from deleted versions and
+# deployments, so that large deletions don't starve requests of disk I/O; 0 means no limit
+TRASH_REAP_RATE = int(os.environ.get("TRASH_REAP_RATE", 5000))
+
+# Default retention policy for old versions of deployments that don't set their own: versions
+# are kept if they're active, among the `VERSION_RETENTION_COUNT` most recent versions or less
+# than `VERSION_RETENTION_DAYS` days old.  0 disables a rule, and all versions are kept if both
+# are disabled.
+VERSION_RETENTION_COUNT = int(os.environ.get("VERSION_RETENTION_COUNT", 0))
+VERSION_RETENTION_DAYS = int(os.environ.get("VERSION_RETENTION_DAYS", 0))
+
+# Minimum number of seconds between background collections of expired versions, which are
+# triggered by new versions being pushed; 0 leaves collection to `manage.py gc_versions`
+VERSION_GC_INTERVAL = int(os.environ.get("VERSION_GC_INTERVAL", 0))
+
+# Resumable upload sessions expire this many seconds after they were last written to
+UPLOAD_SESSION_TTL = int(os.environ.get("UPLOAD_SESSION_TTL", 24 * 60 * 60))
+
+# Chunk size suggested to clients uploading through a resumable session, and the most that a
+# single chunk may contain
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024))
+MAX_UPLOAD_CHUNK_SIZE = int(os.environ.get("MAX_UPLOAD_CHUNK_SIZE", 64 * 1024 * 1024))
+
+# Number of threads in each server process that run asynchronous deploy jobs.  Set this to 0 when
+# jobs are run by a separate `manage.py run_deploy_jobs` process pool instead.
+DEPLOY_JOB_WORKERS = int(os.environ.get("DEPLOY_JOB_WORKERS", 2))
+
+# Deploy jobs that have been running for longer than this many seconds are assumed to have been
+# interrupted and are marked as failed
+DEPLOY_JOB_TIMEOUT = int(os.environ.get("DEPLOY_JOB_TIMEOUT", 60 * 60))
+
+# Store gzipped copies of deployed text assets next to them for the web server to send as-is
+PRECOMPRESS_DEPLOYMENTS = os.environ.get("PRECOMPRESS_DEPLOYMENTS", "true").lower() in ("1", "true")
+
+# Custom 404 documents larger than this are refused rather than streamed
+MAX_NOT_FOUND_DOCUMENT_SIZE = int(os.environ.get("MAX_NOT_FOUND_DOCUMENT_SIZE", 128 * 1024 * 1024))
+
+# In-memory cache of small files used by the built-in static file server (`manage.py
+# serve_deployments`): its total size in bytes and the largest file that it holds
+STATIC_CACHE_SIZE = int(os.environ.get("STATIC_CACHE_SIZE", 32 * 1024 * 1024))
+STATIC_CACHE_MAX_FILE_SIZE = int(os.environ.get("STATIC_CACHE_MAX_FILE_SIZE", 64 * 1024))
+
+# Maximum total size in bytes of stored request profiles; the oldest are deleted to make room
+PROFILE_DIR_SIZE = int(os.environ.get("PROFILE_DIR_SIZE", 64 * 1024 * 1024))
+
+# Bearer token that Prometheus has to supply to scrape `/metrics/`.  If it's empty, metrics are only
+# available to logged-in users.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
 PROXY_SERVER_LOG_FILE = os.environ.get("PROXY_SERVER_LOG_FILE") or "/tmp/phost-proxy.log"
 
 
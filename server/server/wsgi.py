@@ -9,11 +9,48 @@ https://docs.djangoproject.com/en/2.1/howto/deployment/wsgi/
 
 import os
 
-from django.core.wsgi import get_wsgi_application
+import django
+from django.core.handlers.wsgi import LimitedStream, WSGIHandler, WSGIRequest
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "server.settings")
 
-inner_application = get_wsgi_application()
+# Limit of the stream that chunked request bodies are read from; they end where the input does
+UNBOUNDED_LENGTH = 2 ** 63 - 1
+
+
+def is_chunked(environ) -> bool:
+    chunked = "chunked" in environ.get("HTTP_TRANSFER_ENCODING", "").lower()
+    return chunked and not environ.get("CONTENT_LENGTH")
+
+
+class ChunkedWSGIRequest(WSGIRequest):
+    """ Request that reads the bodies of chunked requests, which have no `Content-Length`, until
+    the end of the input stream.  Django otherwise reads nothing at all from them.  The web server
+    has already decoded the chunks and signals the end of the body with EOF.
+
+    `CONTENT_LENGTH` is left unset, so `request.body` is still limited to
+    `DATA_UPLOAD_MAX_MEMORY_SIZE` and views that need the length up front (such as the one that
+    receives the chunks of resumable uploads) reject chunked requests. """
+
+    def __init__(self, environ):
+        super(ChunkedWSGIRequest, self).__init__(environ)
+        self.is_chunked = is_chunked(environ)
+        if self.is_chunked:
+            self._stream = LimitedStream(environ["wsgi.input"], UNBOUNDED_LENGTH)
+
+    def parse_file_upload(self, META, post_data):
+        # The multipart parser treats bodies without a length as empty
+        if self.is_chunked:
+            META = {**META, "CONTENT_LENGTH": str(UNBOUNDED_LENGTH)}
+        return super(ChunkedWSGIRequest, self).parse_file_upload(META, post_data)
+
+
+class ChunkedWSGIHandler(WSGIHandler):
+    request_class = ChunkedWSGIRequest
+
+
+django.setup(set_prefix=False)
+inner_application = ChunkedWSGIHandler()
 
 
 def application(environ, start_response):
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class ServersiteConfig(AppConfig):
     name = 'serversite'
+
+    def ready(self):
+        # Registers the signal handlers that bump the change generation
+        from . import generation  # pylint: disable=W0611
+
+        # Registers the signal handlers that keep the web server's rewrite maps up to date
+        from . import rewrite_maps  # pylint: disable=W0611
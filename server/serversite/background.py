@@ -0,0 +1,65 @@
+"""
+Runs housekeeping work, like deleting the files of failed uploads, on a background thread so that
+it doesn't hold up the requests that produce it.  Each server process has a single worker thread
+that runs tasks in the order that they were scheduled.
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+
+TASK_QUEUE = queue.Queue()
+
+WORKER_LOCK = threading.Lock()
+WORKER = None
+
+# Last time that each throttled task was scheduled, keyed by name
+LAST_RUN = {}
+
+
+def run_worker():
+    while True:
+        (func, args) = TASK_QUEUE.get()
+        try:
+            func(*args)
+        except Exception as e:
+            print("Error in background task {}: {}".format(func.__name__, e))
+            traceback.print_exc()
+        finally:
+            TASK_QUEUE.task_done()
+
+
+def run_in_background(func, *args):
+    """ Schedules `func(*args)` to be run on the background worker thread """
+
+    global WORKER
+
+    with WORKER_LOCK:
+        if WORKER is None:
+            WORKER = threading.Thread(target=run_worker, name="phost-background", daemon=True)
+            WORKER.start()
+
+    TASK_QUEUE.put((func, args))
+
+
+def run_throttled(name: str, interval: float, func, *args):
+    """ Schedules `func(*args)` to be run in the background unless the task called `name` has
+    already been scheduled within the last `interval` seconds.  This is used for periodic sweeps
+    that are triggered by incoming requests. """
+
+    now = time.monotonic()
+    with WORKER_LOCK:
+        last_run = LAST_RUN.get(name)
+        if last_run is not None and now - last_run < interval:
+            return
+        LAST_RUN[name] = now
+
+    run_in_background(func, *args)
+
+
+def wait_for_background_tasks():
+    """ Blocks until all tasks scheduled so far have been run """
+
+    TASK_QUEUE.join()
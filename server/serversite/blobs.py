@@ -0,0 +1,116 @@
+"""
+Content-addressed store of deployed files, enabled with `settings.DEDUPLICATE_DEPLOYMENTS`.
+
+Every file extracted into a version tree is hashed and stored once under
+`HOST_PATH/.blobs/<first two hex digits>/<SHA-256 digest>`; version trees are made up of hardlinks
+to these blobs, so identical files shared between versions or deployments only take up space and
+get written to disk once.  The link count of each blob acts as its reference count: a blob with a
+link count of 1 is only referenced by the store itself and is freed when a version referencing it
+is deleted.
+
+Since all links to a blob share a single inode, deduplicated files also share the permissions and
+modification time of the first copy that was stored.
+"""
+
+import os
+
+from django.conf import settings
+
+
+BLOB_DIR = os.path.join(settings.HOST_PATH, ".blobs")
+
+
+class BlobStore(object):
+    def __init__(self, root=BLOB_DIR):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def link(self, digest: str, path: str) -> bool:
+        """ Creates `path` as a link to the blob with the given digest, replacing any existing
+        file.  Returns `False` if there is no such blob. """
+
+        if os.path.lexists(path):
+            os.unlink(path)
+
+        try:
+            os.link(self.path(digest), path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def add(self, path: str, digest: str):
+        """ Adds the file at `path`, the contents of which have the given digest, to the store.
+        If an identical blob was stored concurrently, `path` is simply left as a separate copy. """
+
+        blob_path = self.path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(path, blob_path)
+        except FileExistsError:
+            pass
+
+    def release(self, digests) -> tuple:
+        """ Deletes all blobs out of `digests` that are no longer linked into any version tree.
+        Returns the number of blobs deleted and the number of bytes freed. """
+
+        (freed_count, freed_bytes) = (0, 0)
+        for digest in digests:
+            blob_path = self.path(digest)
+            try:
+                stat = os.lstat(blob_path)
+                if stat.st_nlink == 1:
+                    os.unlink(blob_path)
+                    freed_count += 1
+                    freed_bytes += stat.st_size
+            except FileNotFoundError:
+                pass
+
+        return (freed_count, freed_bytes)
+
+    def iter_digests(self):
+        try:
+            prefixes = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+
+        for prefix in prefixes:
+            for entry in os.scandir(os.path.join(self.root, prefix)):
+                yield entry.name
+
+    def sweep(self) -> tuple:
+        """ Deletes all unreferenced blobs, such as those left behind by failed uploads """
+
+        return self.release(list(self.iter_digests()))
+
+    def stats(self) -> dict:
+        blob_count = 0
+        stored_bytes = 0
+        referenced_bytes = 0
+        unreferenced_count = 0
+
+        for digest in self.iter_digests():
+            try:
+                stat = os.lstat(self.path(digest))
+            except FileNotFoundError:
+                continue
+
+            blob_count += 1
+            stored_bytes += stat.st_size
+            references = stat.st_nlink - 1
+            referenced_bytes += stat.st_size * references
+            if references == 0:
+                unreferenced_count += 1
+
+        return {
+            "enabled": settings.DEDUPLICATE_DEPLOYMENTS,
+            "blob_count": blob_count,
+            "unreferenced_blob_count": unreferenced_count,
+            "stored_bytes": stored_bytes,
+            "referenced_bytes": referenced_bytes,
+            "dedup_ratio": referenced_bytes / stored_bytes if stored_bytes else 1.0,
+        }
+
+
+BLOB_STORE = BlobStore()
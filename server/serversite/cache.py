@@ -0,0 +1,167 @@
+"""
+Read-through cache of deployment lookups used by the 404 handler and the public read endpoints.
+
+Each WSGI process keeps its own bounded LRU cache of deployments keyed by the lookup field and
+value that they were requested with (`id`, `subdomain` or `name`).  Lookups of deployments that
+don't exist are remembered in a separate, smaller LRU so that requests for random subdomains can't
+evict the deployments that are actually being served.  Any change to a deployment or
+one of its versions bumps the global change generation (see `generation.py`); every process checks
+the generation before each lookup and flushes its cache when it has changed.  Writes are rare
+compared to reads, so flushing everything keeps this simple.
+"""
+
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+from .models import StaticDeployment, DeploymentVersion
+from .serialize import serialize
+from .validation import NotFound
+from .generation import current_generation, bump_generation
+
+
+class CachedDeployment(object):
+    """ Serialized snapshot of a deployment along with all of its versions """
+
+    def __init__(self, data: dict, versions: list):
+        self.data = data
+        self.versions = versions
+
+    @property
+    def subdomain(self) -> str:
+        return self.data["subdomain"]
+
+    @property
+    def not_found_document(self):
+        return self.data["not_found_document"]
+
+    @property
+    def active_version(self):
+        return next((v for v in self.versions if v["active"]), None)
+
+    def get_version(self, version: str):
+        version = version.lower()
+        return next((v for v in self.versions if v["version"] == version), None)
+
+
+class DeploymentCache(object):
+    def __init__(self, max_size: int, max_missing_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # Keys of lookups that didn't match any deployment
+        self.max_missing_size = max_missing_size
+        self.missing = OrderedDict()
+        self.lock = threading.Lock()
+        # Incremented every time that the cache is flushed so that lookups which raced with an
+        # invalidation don't insert stale data afterwards.
+        self.epoch = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _flush(self):
+        self.entries.clear()
+        self.missing.clear()
+        self.epoch += 1
+        self.invalidations += 1
+
+    def get(self, lookup_field: str, value: str) -> CachedDeployment:
+        key = (lookup_field, str(value))
+        generation = current_generation()
+
+        with self.lock:
+            if generation != self.generation:
+                self._flush()
+                self.generation = generation
+
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            if key in self.missing:
+                self.missing.move_to_end(key)
+                self.hits += 1
+                raise NotFound()
+
+            self.misses += 1
+            epoch = self.epoch
+
+        entry = load_deployment(lookup_field, value)
+
+        with self.lock:
+            if epoch == self.epoch and entry is None:
+                self.missing[key] = None
+                if len(self.missing) > self.max_missing_size:
+                    self.missing.popitem(last=False)
+            elif epoch == self.epoch:
+                self.entries[key] = entry
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        if entry is None:
+            raise NotFound()
+        return entry
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "missing_size": len(self.missing),
+                "max_missing_size": self.max_missing_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def load_deployment(lookup_field: str, value: str):
+    """ Loads a deployment and its versions from the database, returning `None` if it doesn't
+    exist.  Missing deployments are cached as well so that the 404 handler doesn't hit the
+    database for subdomains that don't exist.  The deployment is joined onto its versions, so
+    this takes two queries including the one for its categories. """
+
+    versions = list(
+        DeploymentVersion.objects.filter(**{"deployment__{}".format(lookup_field): value})
+        .select_related("deployment")
+        .prefetch_related("deployment__categories")
+    )
+    if versions:
+        deployment = versions[0].deployment
+    else:
+        # Deployments normally always have at least one version, but aren't required to
+        try:
+            deployment = StaticDeployment.objects.prefetch_related("categories").get(
+                **{lookup_field: value}
+            )
+        except StaticDeployment.DoesNotExist:
+            return None
+
+    return CachedDeployment(serialize(deployment, json=False), serialize(versions, json=False))
+
+
+DEPLOYMENT_CACHE = DeploymentCache(
+    settings.DEPLOYMENT_CACHE_SIZE, settings.MISSING_DEPLOYMENT_CACHE_SIZE
+)
+
+
+def get_deployment(lookup_field: str, value: str) -> CachedDeployment:
+    """ Returns the cached deployment matching `lookup_field=value`, raising `NotFound` if no such
+    deployment exists. """
+
+    return DEPLOYMENT_CACHE.get(lookup_field, value)
+
+
+def invalidate():
+    """ Flushes the deployment cache in all processes """
+
+    bump_generation()
+
+
+def stats() -> dict:
+    return DEPLOYMENT_CACHE.stats()
@@ -0,0 +1,166 @@
+"""
+Delta uploads.  Clients send the manifest of the directory that they want to deploy and are told
+which of its files the server doesn't have yet; they then upload an archive containing only those
+files along with the full manifest.  The new version tree is assembled out of the uploaded files
+and links to identical files in the version that the delta was computed against (or in the blob
+store, if deduplication is enabled).  Files that aren't in the manifest don't make it into the new
+version, so deletions carry over as well.
+"""
+
+import json
+import os
+import re
+import shutil
+
+from django.conf import settings
+
+from .blobs import BLOB_STORE
+from .extract import UnsafeArchiveMember, resolve_member_path
+from .manifest import build_manifest, hash_file, load_manifest, manifest_digests, save_manifest
+from .validation import BadInputException
+
+
+SHA256_RGX = re.compile("^[0-9a-f]{64}$")
+
+
+def parse_manifest(raw) -> dict:
+    """ Parses and validates a JSON manifest supplied by a client, returning the files in it """
+
+    try:
+        files = json.loads(raw)["files"]
+    except (ValueError, TypeError, KeyError):
+        raise BadInputException("The supplied manifest is not valid JSON of the form `{files}`")
+
+    if not isinstance(files, dict):
+        raise BadInputException("The `files` of the supplied manifest must be an object")
+
+    for (path, entry) in files.items():
+        valid = (
+            isinstance(entry, dict)
+            and isinstance(entry.get("sha256"), str)
+            and SHA256_RGX.match(entry["sha256"])
+            and isinstance(entry.get("size"), int)
+            and entry["size"] >= 0
+        )
+        if not valid:
+            raise BadInputException("Invalid manifest entry for `{}`".format(path))
+
+        try:
+            resolve_member_path("/", path)
+        except UnsafeArchiveMember as e:
+            raise BadInputException(str(e))
+
+    return files
+
+
+def get_version_manifest(subdomain: str, version: str) -> dict:
+    """ Returns the files in the manifest of a version, building and saving it if the version was
+    deployed without one. """
+
+    if version is None:
+        return {}
+
+    manifest = load_manifest(subdomain, version)
+    if manifest is None:
+        version_dir = os.path.join(settings.HOST_PATH, subdomain, version)
+        if not os.path.isdir(version_dir):
+            return {}
+
+        manifest = build_manifest(version_dir)
+        save_manifest(subdomain, version, manifest)
+
+    return manifest
+
+
+def find_missing(subdomain: str, base_version: str, files: dict) -> list:
+    """ Returns the digests of all files in `files` that aren't in `base_version` of the
+    deployment or, if deduplication is enabled, in the blob store. """
+
+    available = manifest_digests(get_version_manifest(subdomain, base_version))
+    missing = set()
+    for entry in files.values():
+        digest = entry["sha256"]
+        if digest in available or digest in missing:
+            continue
+        if settings.DEDUPLICATE_DEPLOYMENTS and os.path.exists(BLOB_STORE.path(digest)):
+            continue
+
+        missing.add(digest)
+
+    return sorted(missing)
+
+
+def link_or_copy(src_path: str, dst_path: str):
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+
+
+def check_size(path: str, relative_path: str, entry: dict):
+    """ Raises `BadInputException` unless the file at `path` has the size in its manifest `entry`.
+    The contents of the file already match the entry's digest, so only a manifest that lies about
+    sizes can fail this. """
+
+    if os.stat(path).st_size != entry["size"]:
+        raise BadInputException(
+            "The size of `{}` doesn't match its manifest entry".format(relative_path)
+        )
+
+
+class Delta(object):
+    """ A delta upload of the files in `files` against `base_version` of a deployment """
+
+    def __init__(self, base_version: str, files: dict):
+        self.base_version = base_version
+        self.files = files
+
+    def apply(self, tree_dir: str, subdomain: str):
+        """ Completes the version tree in `tree_dir`, into which the delta archive was extracted,
+        by linking in all files that weren't uploaded.  Raises `BadInputException` if a file was
+        neither uploaded nor available on the server or if any file doesn't match its manifest
+        entry, so that the sizes in the manifest can be trusted once the delta was applied. """
+
+        base_dir = os.path.join(settings.HOST_PATH, subdomain, self.base_version or "")
+        sources = {
+            entry["sha256"]: os.path.join(base_dir, path)
+            for (path, entry) in get_version_manifest(subdomain, self.base_version).items()
+        }
+
+        for (parent_dir, _, file_names) in os.walk(tree_dir):
+            for file_name in file_names:
+                path = os.path.join(parent_dir, file_name)
+                entry = self.files.get(os.path.relpath(path, tree_dir))
+                if entry is None:
+                    # Uploaded files that aren't in the manifest are dropped
+                    os.unlink(path)
+                elif os.path.islink(path) or hash_file(path) != entry["sha256"]:
+                    raise BadInputException(
+                        "The uploaded contents of `{}` don't match its manifest entry".format(
+                            os.path.relpath(path, tree_dir)
+                        )
+                    )
+                else:
+                    check_size(path, os.path.relpath(path, tree_dir), entry)
+                    sources[entry["sha256"]] = path
+
+        for (relative_path, entry) in self.files.items():
+            path = resolve_member_path(tree_dir, relative_path)
+            if os.path.lexists(path):
+                continue
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            digest = entry["sha256"]
+            if settings.DEDUPLICATE_DEPLOYMENTS and BLOB_STORE.link(digest, path):
+                check_size(path, relative_path, entry)
+                continue
+
+            source = sources.get(digest)
+            if source is None or not os.path.exists(source):
+                raise BadInputException(
+                    "`{}` was neither uploaded nor found in version {}".format(
+                        relative_path, self.base_version
+                    )
+                )
+            link_or_copy(source, path)
+            check_size(path, relative_path, entry)
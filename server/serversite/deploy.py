@@ -0,0 +1,156 @@
+"""
+Records new deployments and versions in the database and moves their staged files (see
+`upload.StagedVersion`) into place.  Each of these runs as a single short transaction, which is
+shared by the upload views and deploy jobs.
+"""
+
+from django.db import transaction
+from django.db.utils import IntegrityError
+import semver
+
+from .models import StaticDeployment, DeploymentVersion, DeploymentCategory
+from .profiling import span
+from .retention import schedule_version_gc
+from .serialize import serialize
+from .upload import update_symlink, get_linked_version, restore_symlink
+from .validation import BadInputException
+
+
+def is_version_special(version: str) -> bool:
+    return version in ["minor", "m", "patch", "p", "major", "M"]
+
+
+def transform_special_version(special_version: str, previous_version: str) -> str:
+    if special_version in ["patch", "p"]:
+        return semver.bump_patch(previous_version)
+    elif special_version in ["minor", "m"]:
+        return semver.bump_minor(previous_version)
+    elif special_version in ["major", "M"]:
+        return semver.bump_major(previous_version)
+    else:
+        raise "Unreachable: `transform_special_version` should never be called with invalid special version"
+
+
+def add_categories(deployment: StaticDeployment, categories: list):
+    """ Adds `deployment` to `categories`, creating any that don't exist yet.  This takes the same
+    four queries no matter how many categories there are. """
+
+    categories = set(categories)
+    DeploymentCategory.objects.bulk_create(
+        [DeploymentCategory(category=category) for category in categories], ignore_conflicts=True
+    )
+    # Re-selected since the primary keys of bulk created rows aren't known on all databases
+    deployment.categories.add(*DeploymentCategory.objects.filter(category__in=categories))
+
+
+def create_deployment(
+    staged, name: str, subdomain: str, version: str, categories: list, not_found_document
+) -> dict:
+    """ Creates a deployment whose first version is made up of the files of `staged`, returning
+    the description of the new deployment that is sent back to the client.  The staged files are
+    discarded if the deployment can't be created. """
+
+    linked = False
+    try:
+        with span("transaction.atomic"), transaction.atomic():
+            # Create the new deployment descriptor
+            deployment_descriptor = StaticDeployment(
+                name=name, subdomain=subdomain, not_found_document=not_found_document
+            )
+            deployment_descriptor.save()
+
+            add_categories(deployment_descriptor, categories)
+
+            # Create the new version and set it as active
+            (file_count, total_bytes) = staged.usage()
+            version_model = DeploymentVersion(
+                version=version,
+                deployment=deployment_descriptor,
+                active=True,
+                file_count=file_count,
+                total_bytes=total_bytes,
+            )
+            version_model.save()
+
+            staged.install(subdomain, version)
+            linked = True
+            update_symlink(subdomain, version)
+    except IntegrityError as e:
+        if linked:
+            restore_symlink(subdomain, None)
+        staged.discard()
+        if "Duplicate entry" in str(e):
+            raise BadInputException("`name` and `subdomain` must be unique!")
+        else:
+            raise e
+    except Exception as e:
+        if linked:
+            restore_symlink(subdomain, None)
+        staged.discard()
+        raise e
+
+    return {
+        "name": name,
+        "subdomain": subdomain,
+        "version": version,
+        "url": deployment_descriptor.get_url(),
+    }
+
+
+def create_version(staged, deployment: StaticDeployment, version: str) -> dict:
+    """ Creates a new version of `deployment` made up of the files of `staged` and makes it the
+    active version, returning the serialized version.  `version` may be one of the special
+    versions that bump the previous version.  The staged files are discarded and `latest` is
+    pointed back at the previous version if the version can't be created. """
+
+    linked = False
+    try:
+        with span("transaction.atomic"), transaction.atomic():
+            # Serializes version creation per deployment so that the uniqueness check below can't
+            # race with another upload or deploy job
+            StaticDeployment.objects.select_for_update().filter(pk=deployment.pk).exists()
+            previous_version = get_linked_version(deployment.subdomain)
+            active_versions = DeploymentVersion.objects.filter(deployment=deployment, active=True)
+
+            # Transform special versions by bumping the previous semver version
+            if is_version_special(version):
+                old_version = (
+                    active_versions.select_for_update().values_list("version", flat=True).first()
+                )
+                if old_version is None:
+                    raise BadInputException("The deployment has no active version to bump")
+                try:
+                    version = transform_special_version(version, old_version)
+                except Exception as e:
+                    raise BadInputException(e)
+            # Versions are stored lowercased, and their directories have to match
+            version = version.lower()
+            if DeploymentVersion.objects.filter(deployment=deployment, version=version).exists():
+                raise BadInputException("Version {} already exists".format(version))
+
+            # Set any old active version as inactive in a single update, which also locks it
+            active_versions.update(active=False)
+
+            # Create the new version and set it active
+            (file_count, total_bytes) = staged.usage()
+            version_model = DeploymentVersion(
+                version=version,
+                deployment=deployment,
+                active=True,
+                file_count=file_count,
+                total_bytes=total_bytes,
+            )
+            version_model.save()
+
+            # Move the staged files into place and update the `latest` version to point to them
+            staged.install(deployment.subdomain, version)
+            linked = True
+            update_symlink(deployment.subdomain, version)
+    except Exception as e:
+        if linked:
+            restore_symlink(deployment.subdomain, previous_version)
+        staged.discard()
+        raise e
+
+    schedule_version_gc()
+    return serialize(version_model, json=False)
@@ -0,0 +1,328 @@
+"""
+Extraction engine for uploaded deployment archives.
+
+Members are read (and decompressed) sequentially from the tar stream on the calling thread.
+Small files are read into memory and handed off in batches to a bounded pool of writer threads,
+so the open/write/close latency of archives made up of many small files is overlapped with
+decompression and with each other.  Large files are written directly from the stream on the
+calling thread.  Directories are created at most once per extraction.
+
+When deduplication is enabled, every file is hashed as it's extracted and files that already exist
+in the blob store (see `blobs.py`) are linked into place rather than written out again.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import errno
+import hashlib
+import os
+import shutil
+import tarfile
+import threading
+
+from django.conf import settings
+
+from . import metrics
+from .blobs import BLOB_STORE
+
+
+# Files larger than this are written inline rather than buffered in memory for the pool
+MAX_POOLED_FILE_SIZE = 1024 * 1024
+
+# Small files are handed off to the pool in batches of up to this many files or bytes so that the
+# cost of dispatching work to another thread is amortized over many files.
+MAX_BATCH_FILES = 64
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+# Maximum number of batches waiting to be written, per worker
+MAX_PENDING_BATCHES_PER_WORKER = 2
+
+FILE_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0)
+
+
+class UnsafeArchiveMember(Exception):
+    pass
+
+
+class ExtractionStats(object):
+    def __init__(self):
+        self.file_count = 0
+        self.dir_count = 0
+        self.total_bytes = 0
+        self.deduplicated_count = 0
+        self.deduplicated_bytes = 0
+        # Mapping of relative path to `{"sha256", "size"}` for all extracted files, if they were
+        # deduplicated
+        self.manifest = None
+
+    def __repr__(self):
+        return "ExtractionStats(file_count={}, dir_count={}, total_bytes={})".format(
+            self.file_count, self.dir_count, self.total_bytes
+        )
+
+
+def resolve_member_path(dst_dir: str, name: str) -> str:
+    """ Returns the path that the archive member `name` should be extracted to, raising
+    `UnsafeArchiveMember` if it would end up outside of `dst_dir`. """
+
+    normalized = os.path.normpath(name)
+    if os.path.isabs(normalized) or normalized == ".." or normalized.startswith(".." + os.sep):
+        raise UnsafeArchiveMember("Archive member {} is outside of the archive root".format(name))
+
+    return os.path.normpath(os.path.join(dst_dir, normalized))
+
+
+def check_link_target(dst_dir: str, member_path: str, link_target: str):
+    target_path = os.path.normpath(os.path.join(os.path.dirname(member_path), link_target))
+    if os.path.isabs(link_target) or os.path.commonpath([dst_dir, target_path]) != dst_dir:
+        raise UnsafeArchiveMember(
+            "Archive link {} points outside of the archive root".format(member_path)
+        )
+
+
+class HashingReader(object):
+    """ Wraps a file-like object, hashing everything that is read from it """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+def write_file(path: str, src, mode: int, mtime: float):
+    """ Writes `src` (either `bytes` or a file-like object) to `path`, replacing any symlink that
+    already exists there rather than following it. """
+
+    try:
+        fd = os.open(path, FILE_OPEN_FLAGS, mode)
+    except OSError as e:
+        if e.errno != errno.ELOOP:
+            raise
+        os.unlink(path)
+        fd = os.open(path, FILE_OPEN_FLAGS, mode)
+
+    with os.fdopen(fd, "wb") as f:
+        if isinstance(src, bytes):
+            f.write(src)
+        else:
+            shutil.copyfileobj(src, f)
+
+    os.utime(path, (mtime, mtime))
+
+
+class Extractor(object):
+    def __init__(self, dst_dir: str, workers: int, blob_store=None):
+        self.dst_dir = os.path.abspath(dst_dir)
+        self.blob_store = blob_store
+        self.stats = ExtractionStats()
+        if blob_store is not None:
+            self.stats.manifest = {}
+        # Guards the deduplication stats, which are updated from the pool
+        self.stats_lock = threading.Lock()
+        self.created_dirs = {self.dst_dir}
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = workers * MAX_PENDING_BATCHES_PER_WORKER
+        self.pending = deque()
+        self.batch = []
+        self.batch_bytes = 0
+        # Paths that have been queued up for writing but may not have been written yet
+        self.unsettled_paths = set()
+        # Paths of all symlinks that have been extracted
+        self.link_paths = set()
+
+    def check_parents(self, path: str):
+        """ Raises `UnsafeArchiveMember` if `path` is inside of a symlink extracted earlier.  The
+        lexical checks done on member names can't see through symlinks, so a file written through
+        one could otherwise end up anywhere that the link points to. """
+
+        parent = os.path.dirname(path)
+        while parent != self.dst_dir:
+            if parent in self.link_paths:
+                raise UnsafeArchiveMember(
+                    "Archive member {} is inside of the symlink {}".format(
+                        os.path.relpath(path, self.dst_dir), os.path.relpath(parent, self.dst_dir)
+                    )
+                )
+            parent = os.path.dirname(parent)
+
+    def check_links(self):
+        """ Raises `UnsafeArchiveMember` if any extracted symlink resolves to outside of the
+        destination directory.  This is checked once all members have been extracted since links
+        can point through other links that are only extracted later. """
+
+        real_dst_dir = os.path.realpath(self.dst_dir)
+        for path in self.link_paths:
+            if os.path.commonpath([real_dst_dir, os.path.realpath(path)]) != real_dst_dir:
+                raise UnsafeArchiveMember(
+                    "Archive link {} points outside of the archive root".format(
+                        os.path.relpath(path, self.dst_dir)
+                    )
+                )
+
+    def ensure_dir(self, dir_path: str):
+        if dir_path in self.created_dirs:
+            return
+
+        os.makedirs(dir_path, exist_ok=True)
+        # Record the directory and all of its parents so that they're never created again
+        while dir_path not in self.created_dirs:
+            self.created_dirs.add(dir_path)
+            self.stats.dir_count += 1
+            dir_path = os.path.dirname(dir_path)
+
+    def submit_batch(self):
+        if not self.batch:
+            return
+
+        # Wait for the oldest batch if too many are already queued up so that memory usage stays
+        # bounded when the pool can't keep up with the archive stream.  This is also where errors
+        # from the pool are raised.
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+
+        self.pending.append(self.pool.submit(self.write_batch, self.batch))
+        self.batch = []
+        self.batch_bytes = 0
+
+    def settle(self, *paths):
+        """ Waits until all files queued up for writing have been written if any of `paths` is
+        one of them, so that they're never written to concurrently or linked to before they
+        exist. """
+
+        if not any(path in self.unsettled_paths for path in paths):
+            return
+
+        self.submit_batch()
+        while self.pending:
+            self.pending.popleft().result()
+        self.unsettled_paths.clear()
+
+    def record(self, path: str, digest: str, size: int, deduplicated=False):
+        with self.stats_lock:
+            self.stats.manifest[os.path.relpath(path, self.dst_dir)] = {
+                "sha256": digest,
+                "size": size,
+            }
+            if deduplicated:
+                self.stats.deduplicated_count += 1
+                self.stats.deduplicated_bytes += size
+
+    def write_deduplicated(self, path: str, data: bytes, mode: int, mtime: float):
+        digest = hashlib.sha256(data).hexdigest()
+        deduplicated = self.blob_store.link(digest, path)
+        if not deduplicated:
+            write_file(path, data, mode, mtime)
+            self.blob_store.add(path, digest)
+
+        self.record(path, digest, len(data), deduplicated)
+
+    def write_batch(self, batch: list):
+        for args in batch:
+            if self.blob_store is None:
+                write_file(*args)
+            else:
+                self.write_deduplicated(*args)
+
+    def extract_file(self, t: tarfile.TarFile, member: tarfile.TarInfo, path: str):
+        self.ensure_dir(os.path.dirname(path))
+        self.settle(path)
+
+        mode = (member.mode & 0o777) or 0o644
+        src = t.extractfile(member)
+        if member.size > MAX_POOLED_FILE_SIZE and self.blob_store is None:
+            write_file(path, src, mode, member.mtime)
+        elif member.size > MAX_POOLED_FILE_SIZE:
+            # Large files are hashed while they're being written since their digest isn't known
+            # up front; they're linked to an existing blob afterwards if there is one.
+            if os.path.lexists(path):
+                os.unlink(path)
+            src = HashingReader(src)
+            write_file(path, src, mode, member.mtime)
+            digest = src.hash.hexdigest()
+            deduplicated = self.blob_store.link(digest, path)
+            if not deduplicated:
+                self.blob_store.add(path, digest)
+            self.record(path, digest, member.size, deduplicated)
+        else:
+            self.batch.append((path, src.read(), mode, member.mtime))
+            self.batch_bytes += member.size
+            self.unsettled_paths.add(path)
+            if len(self.batch) >= MAX_BATCH_FILES or self.batch_bytes >= MAX_BATCH_BYTES:
+                self.submit_batch()
+
+        self.stats.file_count += 1
+        self.stats.total_bytes += member.size
+
+    def extract_member(self, t: tarfile.TarFile, member: tarfile.TarInfo):
+        path = resolve_member_path(self.dst_dir, member.name)
+        self.check_parents(path)
+
+        if member.isdir():
+            self.ensure_dir(path)
+        elif member.isfile():
+            self.extract_file(t, member, path)
+        elif member.issym():
+            check_link_target(self.dst_dir, path, member.linkname)
+            self.ensure_dir(os.path.dirname(path))
+            self.settle(path)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(member.linkname, path)
+            self.link_paths.add(path)
+        elif member.islnk():
+            target_path = resolve_member_path(self.dst_dir, member.linkname)
+            self.check_parents(target_path)
+            self.ensure_dir(os.path.dirname(path))
+            self.settle(path, target_path)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.link(target_path, path)
+            # Hard links to symlinks are symlinks themselves
+            if target_path in self.link_paths:
+                self.link_paths.add(path)
+            self.stats.file_count += 1
+            if self.blob_store is not None:
+                target = self.stats.manifest.get(os.path.relpath(target_path, self.dst_dir))
+                if target is not None:
+                    self.record(path, target["sha256"], target["size"])
+        # Devices, FIFOs, and other special files are never extracted
+
+    def extract(self, fileobj, mode: str) -> ExtractionStats:
+        try:
+            with tarfile.open(mode=mode, fileobj=fileobj) as t:
+                for member in t:
+                    self.extract_member(t, member)
+
+            self.submit_batch()
+            while self.pending:
+                self.pending.popleft().result()
+            self.check_links()
+        finally:
+            self.pool.shutdown(wait=True)
+
+        return self.stats
+
+
+def extract_archive(
+    fileobj, dst_dir: str, mode="r|*", workers=None, deduplicate=None
+) -> ExtractionStats:
+    """ Extracts the tar archive read from `fileobj` into `dst_dir`, writing files with a pool of
+    `workers` threads (`settings.EXTRACTION_WORKERS` by default).  Members that would be
+    extracted outside of `dst_dir` cause an `UnsafeArchiveMember` exception to be raised.  Files
+    are stored in the blob store if `deduplicate` (`settings.DEDUPLICATE_DEPLOYMENTS` by default)
+    is set. """
+
+    if workers is None:
+        workers = settings.EXTRACTION_WORKERS
+    if deduplicate is None:
+        deduplicate = settings.DEDUPLICATE_DEPLOYMENTS
+
+    blob_store = BLOB_STORE if deduplicate else None
+    with metrics.timed("phost_extraction_duration_seconds"):
+        stats = Extractor(dst_dir, workers, blob_store).extract(fileobj, mode)
+    metrics.increment("phost_extracted_bytes_total", stats.total_bytes)
+    return stats
@@ -0,0 +1,158 @@
+"""
+Utilities for serving files out of the hosting directory.  Full responses are handed to the WSGI
+server as file objects so that Apache can use `sendfile` for them; partial responses are streamed
+out in fixed-size chunks.
+"""
+
+import mimetypes
+import os
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+
+RANGE_RGX = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def make_etag(stat_result) -> str:
+    """ Builds a strong ETag for a file out of its modification time and size.  Files in the
+    hosting directory are never modified in place (new versions get new directories), so this is
+    enough to uniquely identify a file's contents. """
+
+    return '"{:x}-{:x}"'.format(stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def parse_range(range_header: str, size: int):
+    """ Parses the value of a `Range` header for a file of `size` bytes.  Returns an inclusive
+    `(start, end)` tuple, or `None` if the header is malformed or requests multiple ranges, in
+    which case it should be ignored and the full file served.  Raises `RangeNotSatisfiable` if
+    the requested range lies entirely outside of the file. """
+
+    match = RANGE_RGX.match(range_header.strip())
+    if match is None or size == 0:
+        return None
+
+    (start, end) = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:
+        # Suffix range; the last `end` bytes of the file
+        suffix_length = int(end)
+        if suffix_length == 0:
+            raise RangeNotSatisfiable()
+        return (max(0, size - suffix_length), size - 1)
+
+    start = int(start)
+    end = size - 1 if not end else min(int(end), size - 1)
+    if start > end:
+        if start >= size:
+            raise RangeNotSatisfiable()
+        return None
+
+    return (start, end)
+
+
+def if_range_matches(if_range, etag: str, last_modified: int) -> bool:
+    """ Returns `True` if the request's `If-Range` header is either missing or its validator
+    matches the current version of the file, meaning that the `Range` header should be
+    honored. """
+
+    if not if_range:
+        return True
+
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+
+    return parse_http_date_safe(if_range) == last_modified
+
+
+class FileRangeIterator(object):
+    """ Yields `length` bytes from the current position of `file` and closes it once exhausted
+    or once the response is closed, whichever comes first. """
+
+    def __init__(self, file, length: int):
+        self.file = file
+        self.remaining = length
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.file.read(min(STREAM_CHUNK_SIZE, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+
+def set_validator_headers(response, etag: str, last_modified: int):
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    response["Accept-Ranges"] = "bytes"
+
+
+def serve_file(req, path: str, content_type=None):
+    """ Creates a response that streams the file at `path` without reading it into memory.
+    Supports conditional requests (`If-None-Match`, `If-Modified-Since` and friends) as well as
+    single-range `Range` requests. """
+
+    if content_type is None:
+        (content_type, _encoding) = mimetypes.guess_type(path)
+
+    file = open(path, "rb")
+    try:
+        stat_result = os.fstat(file.fileno())
+        size = stat_result.st_size
+        etag = make_etag(stat_result)
+        last_modified = int(stat_result.st_mtime)
+
+        conditional_response = get_conditional_response(
+            req, etag=etag, last_modified=last_modified
+        )
+        if conditional_response is not None:
+            file.close()
+            set_validator_headers(conditional_response, etag, last_modified)
+            return conditional_response
+
+        byte_range = None
+        range_header = req.META.get("HTTP_RANGE")
+        if_range = req.META.get("HTTP_IF_RANGE")
+        if range_header and if_range_matches(if_range, etag, last_modified):
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                file.close()
+                response = HttpResponse(status=416)
+                response["Content-Range"] = "bytes */{}".format(size)
+                set_validator_headers(response, etag, last_modified)
+                return response
+    except Exception:
+        file.close()
+        raise
+
+    if byte_range is None:
+        response = FileResponse(file, content_type=content_type)
+        response["Content-Length"] = size
+    else:
+        (start, end) = byte_range
+        file.seek(start)
+        response = StreamingHttpResponse(
+            FileRangeIterator(file, end - start + 1), status=206, content_type=content_type
+        )
+        response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        response["Content-Length"] = end - start + 1
+
+    set_validator_headers(response, etag, last_modified)
+    return response
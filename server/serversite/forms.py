@@ -5,7 +5,9 @@ class StaticDeploymentForm(forms.Form):
     name = forms.CharField(max_length=255)
     subdomain = forms.CharField(max_length=255)
     version = forms.CharField(max_length=32)
-    file = forms.FileField(allow_empty_file=False)
+    # Either an archive or the ID of a finalized resumable upload session must be supplied
+    file = forms.FileField(allow_empty_file=False, required=False)
+    upload_id = forms.CharField(required=False)
     categories = forms.CharField(required=False)  # Comma-separated list of categories
     not_found_document = forms.CharField(required=False)
 
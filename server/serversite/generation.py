@@ -0,0 +1,75 @@
+"""
+Global, monotonically increasing change generation.  It is bumped every time that a deployment,
+one of its versions or a proxy is created, updated or deleted.  Read endpoints use it as their
+ETag, and it is what the deployment cache uses to detect that it has gone stale.
+
+The generation is stored in a file in the hosting directory rather than the database so that it
+is shared between all server processes and can be checked without running any queries.
+"""
+
+import fcntl
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .models import StaticDeployment, DeploymentVersion, ProxyDeployment
+
+
+GENERATION_FILE_NAME = ".generation"
+
+
+def generation_path() -> str:
+    return os.path.join(settings.HOST_PATH, GENERATION_FILE_NAME)
+
+
+def current_generation() -> int:
+    try:
+        with open(generation_path(), "r") as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def bump_generation_now() -> int:
+    """ Atomically increments the generation, returning the new value.  A lock file serializes
+    concurrent bumps from different processes, and the new value is written to a temporary file
+    which is then renamed over the old one so that readers never see a partial write. """
+
+    path = generation_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            generation = current_generation() + 1
+            tmp_path = "{}.{}".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                f.write(str(generation))
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return generation
+
+
+def bump_generation():
+    """ Bumps the generation both immediately and once the current transaction (if any) commits
+    so that concurrent readers can't cache data from before the change under the new
+    generation. """
+
+    bump_generation_now()
+    transaction.on_commit(bump_generation_now)
+
+
+@receiver(post_save, sender=StaticDeployment)
+@receiver(post_delete, sender=StaticDeployment)
+@receiver(post_save, sender=DeploymentVersion)
+@receiver(post_delete, sender=DeploymentVersion)
+@receiver(post_save, sender=ProxyDeployment)
+@receiver(post_delete, sender=ProxyDeployment)
+@receiver(m2m_changed, sender=StaticDeployment.categories.through)
+def bump_generation_on_change(**_kwargs):
+    bump_generation()
@@ -0,0 +1,317 @@
+"""
+Deploy jobs run the expensive part of a deployment (extraction, applying deltas, precompression
+and activation) outside of the request that uploaded it.  Clients opt in by sending
+`Prefer: respond-async`, in which case the upload is answered with `202 Accepted` as soon as the
+archive has been received, and the job's progress can be followed at `GET jobs/<id>/`.
+
+Jobs are queued in the database, so they can be claimed by the worker threads that every server
+process starts (`settings.DEPLOY_JOB_WORKERS`) or by a dedicated pool of worker processes started
+with `manage.py run_deploy_jobs`.
+"""
+
+from contextlib import contextmanager
+from datetime import timedelta
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.utils import timezone
+
+from .delta import Delta
+from .deploy import create_deployment, create_version
+from .extract import ExtractionStats
+from .models import DeployJob, StaticDeployment
+from .upload import (
+    StagedArchive,
+    discard_staging_dir,
+    stage_extracted_archive,
+    stage_uploaded_archive,
+)
+
+
+# Uploaded archives wait here until their job extracts them
+JOB_ARCHIVE_DIR = os.path.join(settings.HOST_PATH, ".jobs")
+
+# Number of seconds that idle workers wait between checks for jobs queued by other processes
+IDLE_POLL_INTERVAL = 5.0
+
+# Minimum number of seconds between checks for jobs whose worker died
+INTERRUPTED_JOB_SWEEP_INTERVAL = 60.0
+
+WORKER_LOCK = threading.Lock()
+WORKERS = []
+# Released once for every job queued by this process so that an idle worker picks it up
+WORKER_WAKEUP = threading.Semaphore(0)
+
+LAST_INTERRUPTED_JOB_SWEEP = None
+
+
+def wants_async(req) -> bool:
+    """ Returns whether the client asked for the request to be processed asynchronously """
+
+    preferences = req.META.get("HTTP_PREFER", "").split(",")
+    return "respond-async" in (preference.strip().lower() for preference in preferences)
+
+
+def enqueue_job(kind: str, subdomain: str, version: str, archive, upload_session=None, **params):
+    """ Queues up a job deploying `archive`, which is either an archive that was extracted while
+    it was uploaded or a file containing the archive.  The file is moved (for resumable uploads)
+    or copied out of the request so that it outlives it.  `params` are passed on to
+    `deploy.create_deployment` or `deploy.create_version`, depending on `kind`. """
+
+    stats = None
+    if isinstance(archive, StagedArchive):
+        if archive.error is not None:
+            raise archive.error
+
+        params["staging_dir"] = archive.staging_dir
+        stats = archive.stats
+        params["extracted_manifest"] = stats.manifest
+    else:
+        os.makedirs(JOB_ARCHIVE_DIR, exist_ok=True)
+        archive_path = os.path.join(JOB_ARCHIVE_DIR, uuid.uuid4().hex)
+        if upload_session is not None:
+            archive.close()
+            os.rename(upload_session.data_path, archive_path)
+            upload_session.delete()
+        else:
+            with open(archive_path, "wb") as f:
+                shutil.copyfileobj(archive, f)
+        params["archive_path"] = archive_path
+
+    job = DeployJob.objects.create(
+        kind=kind,
+        subdomain=subdomain,
+        version=version,
+        params=json.dumps(params),
+        file_count=stats.file_count if stats else None,
+        total_bytes=stats.total_bytes if stats else None,
+    )
+    if stats is not None:
+        # The staging directory is owned by the job from here on
+        archive.staging_dir = None
+    notify_job_workers()
+    return job
+
+
+def delete_job_archive(params: dict):
+    """ Deletes the uploaded archive of a job if it hasn't been extracted yet.  Staging directories
+    are cleaned up by whatever failed to stage them, or eventually by `sweep_staging_dirs`. """
+
+    archive_path = params.get("archive_path")
+    if archive_path is not None and os.path.exists(archive_path):
+        os.unlink(archive_path)
+
+
+def claim_job():
+    """ Marks the oldest pending job as running and returns it, or returns `None` if there are no
+    pending jobs.  Jobs are claimed with a conditional update so that every job is run by exactly
+    one worker, no matter how many processes are looking for jobs. """
+
+    pending_job_ids = DeployJob.objects.filter(state=DeployJob.PENDING).values_list("id", flat=True)
+    for job_id in pending_job_ids[:10]:
+        claimed = DeployJob.objects.filter(id=job_id, state=DeployJob.PENDING).update(
+            state=DeployJob.RUNNING, started_on=timezone.now()
+        )
+        if claimed:
+            return DeployJob.objects.get(id=job_id)
+
+    return None
+
+
+@contextmanager
+def job_stage(job: DeployJob, stage: str, timings: dict):
+    """ Records that `job` is running `stage` and how long it took """
+
+    job.stage = stage
+    job.save(update_fields=["stage"])
+
+    start = time.perf_counter()
+    yield
+    timings[stage] = round(time.perf_counter() - start, 3)
+    job.timings = json.dumps(timings)
+    job.save(update_fields=["timings"])
+
+
+def run_job(job: DeployJob):
+    params = json.loads(job.params)
+    timings = {}
+    delta = None
+    if "manifest" in params:
+        delta = Delta(params["base_version"], params["manifest"])
+
+    staged = None
+    # Set once `create_deployment` or `create_version` has taken ownership of `staged`
+    handed_off = False
+    try:
+        deployment = None
+        if job.kind == DeployJob.VERSION:
+            # Fail before staging anything if the deployment was deleted while the job was queued
+            deployment = StaticDeployment.objects.get(id=params["deployment_id"])
+
+        with job_stage(job, "extracting", timings):
+            if "staging_dir" in params:
+                stats = ExtractionStats()
+                stats.file_count = job.file_count
+                stats.total_bytes = job.total_bytes
+                stats.manifest = params["extracted_manifest"]
+                # `stage_extracted_archive` cleans up the directory itself if it fails
+                staging_dir = params.pop("staging_dir")
+                staged = stage_extracted_archive(staging_dir, job.subdomain, delta, stats)
+            else:
+                with open(params["archive_path"], "rb") as f:
+                    staged = stage_uploaded_archive(f, job.subdomain, delta)
+                os.unlink(params["archive_path"])
+                job.file_count = staged.stats.file_count
+                job.total_bytes = staged.stats.total_bytes
+
+        with job_stage(job, "precompressing", timings):
+            job.precompressed_count = staged.precompress()
+
+        with job_stage(job, "activating", timings):
+            handed_off = True
+            if job.kind == DeployJob.CREATE:
+                result = create_deployment(
+                    staged,
+                    params["name"],
+                    job.subdomain,
+                    job.version,
+                    params["categories"],
+                    params["not_found_document"],
+                )
+            else:
+                result = create_version(staged, deployment, job.version)
+
+        state = DeployJob.SUCCEEDED
+        job.result = json.dumps(result, cls=DjangoJSONEncoder)
+    except Exception as e:
+        print("Deploy job {} failed: {}".format(job.id, e))
+        traceback.print_exc()
+
+        if staged is not None and not handed_off:
+            staged.discard()
+        elif "staging_dir" in params:
+            discard_staging_dir(params["staging_dir"], params["extracted_manifest"])
+        delete_job_archive(params)
+        state = DeployJob.FAILED
+        job.error = str(e)
+
+    # The job may have been marked as failed by `fail_interrupted_jobs` while it was running, in
+    # which case that outcome is kept, just like `claim_job` only claims jobs that are pending
+    finished = DeployJob.objects.filter(id=job.id, state=DeployJob.RUNNING).update(
+        state=state,
+        stage="",
+        result=job.result,
+        error=job.error,
+        file_count=job.file_count,
+        total_bytes=job.total_bytes,
+        precompressed_count=job.precompressed_count,
+        finished_on=timezone.now(),
+    )
+    if not finished:
+        print("Deploy job {} was marked as failed before it finished".format(job.id))
+
+
+def fail_interrupted_jobs():
+    """ Marks jobs that have been running for longer than `settings.DEPLOY_JOB_TIMEOUT` as failed,
+    since the worker running them must have died. """
+
+    cutoff = timezone.now() - timedelta(seconds=settings.DEPLOY_JOB_TIMEOUT)
+    for job in DeployJob.objects.filter(state=DeployJob.RUNNING, started_on__lt=cutoff):
+        delete_job_archive(json.loads(job.params))
+        DeployJob.objects.filter(id=job.id, state=DeployJob.RUNNING).update(
+            state=DeployJob.FAILED, error="The job was interrupted", finished_on=timezone.now()
+        )
+
+
+def run_pending_jobs() -> int:
+    """ Runs jobs until there are none left to claim, returning the number that were run """
+
+    global LAST_INTERRUPTED_JOB_SWEEP
+
+    # This runs on job workers rather than the background thread, whose database connection is
+    # never closed
+    now = time.monotonic()
+    with WORKER_LOCK:
+        sweep = (
+            LAST_INTERRUPTED_JOB_SWEEP is None
+            or now - LAST_INTERRUPTED_JOB_SWEEP >= INTERRUPTED_JOB_SWEEP_INTERVAL
+        )
+        if sweep:
+            LAST_INTERRUPTED_JOB_SWEEP = now
+    if sweep:
+        fail_interrupted_jobs()
+
+    count = 0
+    job = claim_job()
+    while job is not None:
+        run_job(job)
+        count += 1
+        job = claim_job()
+
+    return count
+
+
+def run_job_worker():
+    while True:
+        WORKER_WAKEUP.acquire(timeout=IDLE_POLL_INTERVAL)
+        try:
+            run_pending_jobs()
+        except Exception as e:
+            print("Error in deploy job worker: {}".format(e))
+            traceback.print_exc()
+        finally:
+            # Worker threads get their own database connections, which are never closed by
+            # Django's request handling
+            connection.close()
+
+
+def notify_job_workers():
+    """ Wakes up one of this process's job workers, starting them if they aren't running yet """
+
+    if settings.DEPLOY_JOB_WORKERS <= 0:
+        return
+
+    with WORKER_LOCK:
+        while len(WORKERS) < settings.DEPLOY_JOB_WORKERS:
+            worker = threading.Thread(
+                target=run_job_worker, name="phost-deploy-job-{}".format(len(WORKERS)), daemon=True
+            )
+            worker.start()
+            WORKERS.append(worker)
+
+    WORKER_WAKEUP.release()
+
+
+def serialize_job(job: DeployJob) -> dict:
+    def elapsed(start, end):
+        return None if start is None or end is None else (end - start).total_seconds()
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "state": job.state,
+        "stage": job.stage or None,
+        "subdomain": job.subdomain,
+        "version": job.version,
+        "file_count": job.file_count,
+        "total_bytes": job.total_bytes,
+        "precompressed_count": job.precompressed_count,
+        "error": job.error,
+        "result": None if job.result is None else json.loads(job.result),
+        "created_on": job.created_on,
+        "started_on": job.started_on,
+        "finished_on": job.finished_on,
+        "timings": {
+            "queued": elapsed(job.created_on, job.started_on or timezone.now()),
+            **json.loads(job.timings),
+            "total": elapsed(job.created_on, job.finished_on),
+        },
+    }
@@ -0,0 +1,48 @@
+""" Records the file count and size of versions that were deployed before these were recorded """
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from serversite.models import DeploymentVersion
+
+
+def measure_version(version_dir: str) -> tuple:
+    (file_count, total_bytes) = (0, 0)
+    for (parent_dir, _, file_names) in os.walk(version_dir):
+        for file_name in file_names:
+            path = os.path.join(parent_dir, file_name)
+            # Precompressed copies aren't counted, just like for newly deployed versions
+            if file_name.endswith(".gz") and os.path.exists(path[: -len(".gz")]):
+                continue
+            if os.path.isfile(path) and not os.path.islink(path):
+                file_count += 1
+                total_bytes += os.lstat(path).st_size
+
+    return (file_count, total_bytes)
+
+
+class Command(BaseCommand):
+    help = "Measures the files of all versions whose size hasn't been recorded yet"
+
+    def handle(self, *args, **options):
+        versions = DeploymentVersion.objects.filter(total_bytes=None).select_related("deployment")
+        for version in versions.iterator():
+            version_dir = os.path.join(
+                settings.HOST_PATH, version.deployment.subdomain, version.version
+            )
+            if not os.path.isdir(version_dir):
+                self.stdout.write("Skipping {}: {} is missing".format(version.version, version_dir))
+                continue
+
+            (version.file_count, version.total_bytes) = measure_version(version_dir)
+            version.save(update_fields=["file_count", "total_bytes"])
+            self.stdout.write(
+                "{} {}: {} files, {:,} bytes".format(
+                    version.deployment.subdomain,
+                    version.version,
+                    version.file_count,
+                    version.total_bytes,
+                )
+            )
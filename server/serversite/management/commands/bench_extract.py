@@ -0,0 +1,85 @@
+""" Benchmarks the archive extraction engine against `tarfile.extractall`, which it replaced, using
+a generated archive made up of many small files. """
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from serversite.extract import extract_archive
+
+
+class Command(BaseCommand):
+    help = "Benchmarks extraction of an archive made up of many small files"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=50000)
+        parser.add_argument("--file-size", type=int, default=2048)
+        parser.add_argument("--files-per-dir", type=int, default=100)
+        parser.add_argument("--compression", default="gz", choices=["", "gz", "bz2", "xz"])
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16])
+        parser.add_argument(
+            "--dir", default=None, help="Directory to extract into (a temporary one by default)"
+        )
+
+    def build_archive(self, options) -> bytes:
+        buf = io.BytesIO()
+        mode = "w:{}".format(options["compression"]) if options["compression"] else "w"
+        with tarfile.open(fileobj=buf, mode=mode) as t:
+            for i in range(options["files"]):
+                content = os.urandom(options["file_size"] // 2).hex().encode("ascii")
+                info = tarfile.TarInfo(
+                    "./dir-{}/file-{}.txt".format(i // options["files_per_dir"], i)
+                )
+                info.size = len(content)
+                info.mtime = int(time.time())
+                t.addfile(info, io.BytesIO(content))
+
+        return buf.getvalue()
+
+    def time_extraction(self, name: str, extract_fn, archive: bytes, work_dir: str, file_count):
+        dst_dir = os.path.join(work_dir, "out")
+        os.makedirs(dst_dir)
+        try:
+            start = time.perf_counter()
+            extract_fn(io.BytesIO(archive), dst_dir)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(dst_dir)
+
+        self.stdout.write(
+            "{:<20} {:>9.3f}s {:>12,.0f} files/sec".format(name, elapsed, file_count / elapsed)
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            "Building archive with {} files of {} bytes...".format(
+                options["files"], options["file_size"]
+            )
+        )
+        archive = self.build_archive(options)
+        self.stdout.write("Archive size: {:,} bytes".format(len(archive)))
+
+        def extractall(fileobj, dst_dir):
+            with tarfile.open(mode="r|*", fileobj=fileobj) as t:
+                t.extractall(dst_dir)
+
+        work_dir = tempfile.mkdtemp(dir=options["dir"])
+        try:
+            self.time_extraction(
+                "tarfile.extractall", extractall, archive, work_dir, options["files"]
+            )
+            for workers in options["workers"]:
+                self.time_extraction(
+                    "engine ({} workers)".format(workers),
+                    lambda fileobj, dst_dir: extract_archive(fileobj, dst_dir, workers=workers),
+                    archive,
+                    work_dir,
+                    options["files"],
+                )
+        finally:
+            shutil.rmtree(work_dir)
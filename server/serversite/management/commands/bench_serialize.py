@@ -0,0 +1,119 @@
+""" Benchmarks the deployment list serializer against the `django.core.serializers` pipeline that
+it replaced.  All rows are created inside of a transaction that is rolled back afterwards. """
+
+import time
+
+from django.core import serializers
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from serversite.models import StaticDeployment, DeploymentVersion, DeploymentCategory
+from serversite.serialize import serialize_deployments
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_serialize(model) -> dict:
+    data = serializers.serialize("python", [model])[0]
+    return {"id": data["pk"], **data["fields"]}
+
+
+def legacy_serialize_deployments() -> list:
+    all_deployments = StaticDeployment.objects.prefetch_related(
+        "deploymentversion_set", "categories"
+    ).all()
+    return [
+        {
+            **legacy_serialize(deployment),
+            "versions": list(map(legacy_serialize, deployment.deploymentversion_set.all())),
+            "categories": list(map(legacy_serialize, deployment.categories.all())),
+        }
+        for deployment in all_deployments
+    ]
+
+
+class Command(BaseCommand):
+    help = "Benchmarks serialization of the deployment list"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--deployments", type=int, default=10000)
+        parser.add_argument("--versions", type=int, default=20)
+        parser.add_argument(
+            "--skip-legacy",
+            action="store_true",
+            help="Don't benchmark the old serializer, which is very slow for large fleets",
+        )
+
+    def create_rows(self, deployment_count: int, version_count: int):
+        DeploymentCategory.objects.bulk_create(
+            [DeploymentCategory(category="__bench-{}".format(i)) for i in range(4)]
+        )
+        deployments = StaticDeployment.objects.bulk_create(
+            [
+                StaticDeployment(name="__bench-{}".format(i), subdomain="bench-{}".format(i))
+                for i in range(deployment_count)
+            ]
+        )
+        # `bulk_create` doesn't return primary keys for auto-incrementing fields on MySQL
+        categories = list(DeploymentCategory.objects.filter(category__startswith="__bench-"))
+
+        Through = StaticDeployment.categories.through
+        Through.objects.bulk_create(
+            [
+                Through(staticdeployment_id=deployment.id, deploymentcategory_id=category.id)
+                for (i, deployment) in enumerate(deployments)
+                for category in categories[: i % len(categories)]
+            ],
+            batch_size=5000,
+        )
+        DeploymentVersion.objects.bulk_create(
+            [
+                DeploymentVersion(
+                    version="0.{}.0".format(v), deployment=deployment, active=v == version_count - 1
+                )
+                for deployment in deployments
+                for v in range(version_count)
+            ],
+            batch_size=5000,
+        )
+
+    def time_serializer(self, name: str, serialize_fn, row_count: int):
+        start = time.perf_counter()
+        serialized = serialize_fn()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            "{:<12} {:>10.3f}s {:>14,.0f} rows/sec".format(name, elapsed, row_count / elapsed)
+        )
+        return serialized
+
+    def handle(self, *args, **options):
+        deployment_count = options["deployments"]
+        version_count = options["versions"]
+
+        try:
+            with transaction.atomic():
+                self.stdout.write(
+                    "Creating {} deployments with {} versions each...".format(
+                        deployment_count, version_count
+                    )
+                )
+                self.create_rows(deployment_count, version_count)
+                row_count = StaticDeployment.objects.count() + DeploymentVersion.objects.count()
+
+                serialized = self.time_serializer(
+                    "projection",
+                    lambda: serialize_deployments(StaticDeployment.objects.all()),
+                    row_count,
+                )
+                if not options["skip_legacy"]:
+                    legacy_serialized = self.time_serializer(
+                        "legacy", legacy_serialize_deployments, row_count
+                    )
+                    if serialized != legacy_serialized:
+                        self.stderr.write("Serializer outputs differ!")
+
+                raise Rollback()
+        except Rollback:
+            pass
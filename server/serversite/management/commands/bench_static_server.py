@@ -0,0 +1,163 @@
+""" Load tests a static file server.  By default a sample deployment is served by the built-in
+server (see `static_server.py`) running in a child process; pass `--url` to send the same load to
+another server, such as the Apache container, to compare them.  The load generator is a Python
+thread pool, so very fast servers can saturate it before they saturate themselves. """
+
+import http.client
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+from serversite.precompress import precompress_dir
+from serversite.static_server import StaticServer, make_static_server
+
+
+SAMPLE_SUBDOMAIN = "bench"
+
+# Name and size of each file in the sample deployment
+SAMPLE_FILES = [("index.html", 4 * 1024), ("app.js", 256 * 1024), ("image.png", 4 * 1024 * 1024)]
+
+
+def create_sample_deployment(host_path: str):
+    rng = random.Random(0)
+    version_dir = os.path.join(host_path, SAMPLE_SUBDOMAIN, "1")
+    os.makedirs(version_dir)
+    for (name, size) in SAMPLE_FILES:
+        with open(os.path.join(version_dir, name), "wb") as f:
+            if name.endswith(".png"):
+                f.write(os.urandom(size))
+            else:
+                words = [rng.choice([b"const ", b"return ", b"div ", b"{}\n"]) for _ in range(size)]
+                f.write(b"".join(words)[:size])
+
+    precompress_dir(version_dir)
+    os.symlink(version_dir, os.path.join(host_path, SAMPLE_SUBDOMAIN, "latest"))
+
+
+def run_load(url: str, headers: dict, concurrency: int, duration: float) -> dict:
+    """ Requests `url` over `concurrency` keep-alive connections for `duration` seconds """
+
+    parsed = urlsplit(url)
+    path = parsed.path + ("?" + parsed.query if parsed.query else "")
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    totals = {"latencies": [], "bytes": 0, "errors": 0}
+
+    def worker():
+        (connection, latencies, received, errors) = (None, [], 0, 0)
+        while time.perf_counter() < deadline:
+            if connection is None:
+                connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers)
+                res = connection.getresponse()
+                body = res.read()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = None
+                continue
+
+            latencies.append(time.perf_counter() - start)
+            received += len(body)
+            if res.status >= 400:
+                errors += 1
+            if res.will_close:
+                connection.close()
+                connection = None
+
+        if connection is not None:
+            connection.close()
+        with lock:
+            totals["latencies"].extend(latencies)
+            totals["bytes"] += received
+            totals["errors"] += errors
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = sorted(totals["latencies"]) or [0]
+    return {
+        "requests_per_sec": len(totals["latencies"]) / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "mb_per_sec": totals["bytes"] / duration / (1024 * 1024),
+        "errors": totals["errors"],
+    }
+
+
+class Command(BaseCommand):
+    help = "Measures the throughput and latency of serving static files"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--url",
+            action="append",
+            help="URL to request; may be repeated.  Defaults to the files of a sample deployment "
+            "served by the built-in server.",
+        )
+        parser.add_argument("--host-header", help="`Host` header to send with every request")
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--duration", type=float, default=5, help="Seconds per URL")
+        parser.add_argument(
+            "--gzip", action="store_true", help="Accept gzipped responses like a browser would"
+        )
+
+    def run_benchmarks(self, urls: list, headers: dict, options: dict):
+        self.stdout.write(
+            "{:<40} {:>10} {:>9} {:>9} {:>9} {:>7}".format(
+                "URL", "req/sec", "p50 ms", "p99 ms", "MB/sec", "errors"
+            )
+        )
+        for url in urls:
+            result = run_load(url, headers, options["concurrency"], options["duration"])
+            self.stdout.write(
+                "{:<40} {requests_per_sec:>10,.0f} {p50_ms:>9.2f} {p99_ms:>9.2f} "
+                "{mb_per_sec:>9.1f} {errors:>7}".format(url, **result)
+            )
+
+    def handle(self, *args, **options):
+        headers = {}
+        if options["gzip"]:
+            headers["Accept-Encoding"] = "gzip"
+        if options["host_header"]:
+            headers["Host"] = options["host_header"]
+
+        if options["url"]:
+            self.run_benchmarks(options["url"], headers, options)
+            return
+
+        with tempfile.TemporaryDirectory() as host_path:
+            create_sample_deployment(host_path)
+            server = make_static_server(
+                "127.0.0.1", 0, app=StaticServer(host_path=host_path, root_url="localhost")
+            )
+            port = server.server_address[1]
+            # The server runs in its own process so that it doesn't compete with the load
+            # generator for the GIL
+            server_process = multiprocessing.get_context("fork").Process(
+                target=server.serve_forever, daemon=True
+            )
+            server_process.start()
+            server.server_close()
+
+            try:
+                headers.setdefault("Host", "{}.localhost".format(SAMPLE_SUBDOMAIN))
+                urls = [
+                    "http://127.0.0.1:{}/{}".format(port, name) for (name, _size) in SAMPLE_FILES
+                ]
+                self.run_benchmarks(urls, headers, options)
+            finally:
+                server_process.terminate()
+                server_process.join()
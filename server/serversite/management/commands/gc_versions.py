@@ -0,0 +1,49 @@
+""" Deletes versions of deployments that are expired by their retention policies """
+
+from django.core.management.base import BaseCommand
+
+from serversite.models import StaticDeployment
+from serversite.retention import collect_expired_versions
+
+
+class Command(BaseCommand):
+    help = "Deletes old versions according to the configured retention policies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="List the versions that would be deleted without deleting them",
+        )
+        parser.add_argument(
+            "--subdomain", help="Only collect versions of the deployment with this subdomain"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of deployments whose versions are loaded at a time",
+        )
+
+    def handle(self, *args, **options):
+        deployments = StaticDeployment.objects.all()
+        if options["subdomain"]:
+            deployments = deployments.filter(subdomain=options["subdomain"])
+
+        report = collect_expired_versions(
+            deployments, dry_run=options["dry_run"], batch_size=options["batch_size"]
+        )
+        for entry in report:
+            self.stdout.write(
+                "{subdomain} {version} (created {created_on:%Y-%m-%d}): {bytes:,} bytes".format(
+                    **entry
+                )
+            )
+
+        self.stdout.write(
+            "{} {} expired versions, reclaiming {:,} bytes".format(
+                "Would delete" if options["dry_run"] else "Deleted",
+                len(report),
+                sum(entry["bytes"] for entry in report),
+            )
+        )
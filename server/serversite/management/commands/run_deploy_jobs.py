@@ -0,0 +1,44 @@
+""" Runs queued deploy jobs in a pool of worker processes, separately from the web server """
+
+from multiprocessing import Process
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from serversite.jobs import IDLE_POLL_INTERVAL, run_pending_jobs
+
+
+def run_worker():
+    while True:
+        if not run_pending_jobs():
+            time.sleep(IDLE_POLL_INTERVAL)
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = "Runs deploy jobs queued by uploads with `Prefer: respond-async`"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=2, help="Number of worker processes to run jobs in"
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Run all pending jobs and exit instead of polling"
+        )
+
+    def handle(self, *args, **options):
+        if options["once"]:
+            count = run_pending_jobs()
+            self.stdout.write("Ran {} deploy jobs".format(count))
+            return
+
+        # Database connections can't be shared with forked processes
+        connections.close_all()
+        workers = [Process(target=run_worker, daemon=True) for _ in range(options["workers"])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write("Running deploy jobs in {} worker processes".format(len(workers)))
+
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,30 @@
+""" Serves hosted deployments with the built-in static file server, for running without Apache """
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from serversite.static_server import make_static_server
+
+
+class Command(BaseCommand):
+    help = "Serves the files of hosted deployments at <subdomain>.ROOT_URL"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+        parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+
+    def handle(self, *args, **options):
+        server = make_static_server(
+            options["host"], options["port"], log_requests=options["verbosity"] > 1
+        )
+        self.stdout.write(
+            "Serving {} at http://<subdomain>.{}:{}/".format(
+                settings.HOST_PATH, settings.ROOT_URL, options["port"]
+            )
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,13 @@
+""" Deletes all blobs in the deduplicated file store that aren't linked into any version tree """
+
+from django.core.management.base import BaseCommand
+
+from serversite.blobs import BLOB_STORE
+
+
+class Command(BaseCommand):
+    help = "Deletes unreferenced blobs from the deduplicated file store"
+
+    def handle(self, *args, **options):
+        (freed_count, freed_bytes) = BLOB_STORE.sweep()
+        self.stdout.write("Deleted {} blobs, freeing {:,} bytes".format(freed_count, freed_bytes))
@@ -0,0 +1,13 @@
+""" Regenerates the rewrite maps used by the web server from the database """
+
+from django.core.management.base import BaseCommand
+
+from serversite.rewrite_maps import write_not_found_map, not_found_map_path
+
+
+class Command(BaseCommand):
+    help = "Writes the map of deployments' not found documents used by the web server"
+
+    def handle(self, *args, **options):
+        entry_count = write_not_found_map()
+        self.stdout.write("Wrote {} entries to {}".format(entry_count, not_found_map_path()))
@@ -0,0 +1,106 @@
+"""
+Per-version manifests listing the SHA-256 digest and size of every file in a hosted version tree.
+They're stored outside of the hosting directories, under `HOST_PATH/.manifests/<subdomain>/`, as
+`<version>.json` documents of the form `{"files": {"<relative path>": {"sha256", "size"}}}`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from django.conf import settings
+
+
+MANIFEST_DIR = os.path.join(settings.HOST_PATH, ".manifests")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def build_manifest(dir_path: str) -> dict:
+    """ Hashes all regular files in `dir_path`, building up the files listed in its manifest.
+    Symlinks are skipped. """
+
+    files = {}
+    for (parent_dir, _, file_names) in os.walk(dir_path):
+        for file_name in file_names:
+            path = os.path.join(parent_dir, file_name)
+            if os.path.islink(path):
+                continue
+
+            files[os.path.relpath(path, dir_path)] = {
+                "sha256": hash_file(path),
+                "size": os.path.getsize(path),
+            }
+
+    return files
+
+
+def manifest_path(subdomain: str, version: str) -> str:
+    return os.path.join(MANIFEST_DIR, subdomain, "{}.json".format(version))
+
+
+def save_manifest(subdomain: str, version: str, files: dict):
+    """ Writes the manifest of a version, replacing the existing one atomically """
+
+    path = manifest_path(subdomain, version)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"files": files}, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(subdomain: str, version: str):
+    """ Returns the files listed in the manifest of a version, or `None` if it has none """
+
+    try:
+        with open(manifest_path(subdomain, version), "r") as f:
+            return json.load(f)["files"]
+    except FileNotFoundError:
+        return None
+
+
+def load_deployment_manifests(subdomain: str) -> list:
+    """ Returns the files listed in the manifests of all versions of a deployment """
+
+    try:
+        file_names = os.listdir(os.path.join(MANIFEST_DIR, subdomain))
+    except FileNotFoundError:
+        return []
+
+    manifests = []
+    for file_name in file_names:
+        if file_name.endswith(".json"):
+            manifest = load_manifest(subdomain, file_name[: -len(".json")])
+            if manifest is not None:
+                manifests.append(manifest)
+
+    return manifests
+
+
+def delete_manifests(subdomain: str, version=None):
+    """ Deletes the manifest of a single version, or of all versions if `version` isn't given """
+
+    if version is None:
+        shutil.rmtree(os.path.join(MANIFEST_DIR, subdomain), ignore_errors=True)
+        return
+
+    try:
+        os.unlink(manifest_path(subdomain, version))
+    except FileNotFoundError:
+        pass
+
+
+def manifest_digests(*manifests) -> set:
+    return {entry["sha256"] for files in manifests for entry in files.values()}
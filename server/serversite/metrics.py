@@ -0,0 +1,346 @@
+"""
+Prometheus metrics for the management API, exposed in the text format at `/metrics/`.
+
+Every server process records metrics into its own in-memory registry.  Apache runs several
+mod_wsgi processes and a scrape only reaches one of them, so each process periodically writes a
+snapshot of its registry to `HOST_PATH/.metrics/<pid>-<token>.json` and the endpoint sums up the
+snapshots of all processes.  Snapshots of processes that have exited are folded into a single
+archive so that counters keep increasing across process restarts instead of resetting.
+"""
+
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection
+
+
+METRICS_DIR_NAME = ".metrics"
+ARCHIVE_FILE_NAME = "archived.json"
+
+# Seconds between writes of each process's snapshot
+FLUSH_INTERVAL = 5
+
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+# 1 KB to 1 GB in steps of 4x
+SIZE_BUCKETS = [1024 * 4 ** i for i in range(11)]
+QUERY_COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+# Type, help text and bucket upper bounds (for histograms) of every metric
+METRICS = {
+    "phost_http_requests_total": ("counter", "Requests handled, by view, method and status", None),
+    "phost_http_request_duration_seconds": (
+        "histogram",
+        "Time taken to handle requests by view, not including streaming the response body",
+        DURATION_BUCKETS,
+    ),
+    "phost_http_request_db_queries": (
+        "histogram",
+        "Database queries run while handling requests, by view",
+        QUERY_COUNT_BUCKETS,
+    ),
+    "phost_unhandled_exceptions_total": (
+        "counter",
+        "Unexpected exceptions that requests failed with, by exception type",
+        None,
+    ),
+    "phost_upload_bytes": ("histogram", "Sizes of uploaded archives", SIZE_BUCKETS),
+    "phost_extraction_duration_seconds": (
+        "histogram",
+        "Time taken to extract archives into staging directories",
+        DURATION_BUCKETS,
+    ),
+    "phost_extracted_bytes_total": ("counter", "Bytes of files extracted from archives", None),
+    "phost_symlink_update_duration_seconds": (
+        "histogram",
+        "Time taken to point `latest` at a new version",
+        DURATION_BUCKETS,
+    ),
+    "phost_proxy_reloads_total": (
+        "counter",
+        "Times that the proxy server was told to reload its configuration, by trigger",
+        None,
+    ),
+}
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for (name, value) in labels.items()))
+
+
+class Registry(object):
+    """ Counters and histograms, keyed by metric name and label values.  Histograms store the
+    number of observations in each bucket (not cumulative, with a final `+Inf` bucket) followed by
+    the sum of all observations. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.dirty = False
+
+    def increment(self, name: str, amount, labels: dict):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            self.dirty = True
+
+    def observe(self, name: str, value, labels: dict):
+        buckets = METRICS[name][2]
+        key = (name, label_key(labels))
+        with self.lock:
+            entry = self.histograms.get(key)
+            if entry is None:
+                entry = self.histograms[key] = [0] * (len(buckets) + 1) + [0]
+            entry[bisect_left(buckets, value)] += 1
+            entry[-1] += value
+            self.dirty = True
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.dirty = False
+            return {
+                "counters": [
+                    [name, list(labels), value] for ((name, labels), value) in self.counters.items()
+                ],
+                "histograms": [
+                    [name, list(labels), list(entry)]
+                    for ((name, labels), entry) in self.histograms.items()
+                ],
+            }
+
+    def merge(self, snapshot: dict):
+        """ Adds the values of a snapshot taken by `snapshot()` to this registry """
+
+        with self.lock:
+            for (name, labels, value) in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (name, labels, entry) in snapshot["histograms"]:
+                # Skip histograms whose buckets have changed since the snapshot was written
+                if name not in METRICS or len(entry) != len(METRICS[name][2]) + 2:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                existing = self.histograms.setdefault(key, [0] * len(entry))
+                for (i, value) in enumerate(entry):
+                    existing[i] += value
+
+
+REGISTRY = Registry()
+REGISTRY_LOCK = threading.Lock()
+# Identifies this process's snapshot file; reset whenever the process is forked
+PROCESS = {"pid": None, "token": None}
+
+
+def get_registry() -> Registry:
+    global REGISTRY
+
+    if PROCESS["pid"] != os.getpid():
+        with REGISTRY_LOCK:
+            if PROCESS["pid"] != os.getpid():
+                # Forked children would otherwise report their parent's metrics a second time
+                REGISTRY = Registry()
+                PROCESS["pid"] = os.getpid()
+                PROCESS["token"] = uuid.uuid4().hex[:8]
+                threading.Thread(target=run_flusher, daemon=True).start()
+                atexit.register(flush)
+
+    return REGISTRY
+
+
+def increment(name: str, amount=1, **labels):
+    get_registry().increment(name, amount, labels)
+
+
+def observe(name: str, value, **labels):
+    get_registry().observe(name, value, labels)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """ Observes the time taken by the body of the `with` statement in the histogram `name` """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def metrics_dir() -> str:
+    return os.path.join(settings.HOST_PATH, METRICS_DIR_NAME)
+
+
+def write_json(path: str, data: dict):
+    tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def flush():
+    """ Writes this process's snapshot if anything has been recorded since the last write """
+
+    registry = get_registry()
+    if not registry.dirty:
+        return
+
+    os.makedirs(metrics_dir(), exist_ok=True)
+    file_name = "{}-{}.json".format(PROCESS["pid"], PROCESS["token"])
+    write_json(os.path.join(metrics_dir(), file_name), registry.snapshot())
+
+
+def run_flusher():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError as e:
+            print("Error writing metrics snapshot: {}".format(e))
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def collect() -> Registry:
+    """ Sums up the snapshots of all server processes, folding those of processes that have exited
+    into the archive """
+
+    flush()
+    dir_path = metrics_dir()
+    os.makedirs(dir_path, exist_ok=True)
+    archive_path = os.path.join(dir_path, ARCHIVE_FILE_NAME)
+
+    total = Registry()
+    with open(os.path.join(dir_path, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            archive = Registry()
+            if os.path.exists(archive_path):
+                with open(archive_path, "r") as f:
+                    archive.merge(json.load(f))
+
+            exited_paths = []
+            for file_name in os.listdir(dir_path):
+                if not file_name.endswith(".json") or file_name == ARCHIVE_FILE_NAME:
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    with open(path, "r") as f:
+                        snapshot = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    continue
+
+                if is_process_alive(int(file_name.split("-")[0])):
+                    total.merge(snapshot)
+                else:
+                    archive.merge(snapshot)
+                    exited_paths.append(path)
+
+            if exited_paths:
+                write_json(archive_path, archive.snapshot())
+                for path in exited_paths:
+                    os.remove(path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    total.merge(archive.snapshot())
+    return total
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+
+    escaped = [
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        for (name, value) in labels
+    ]
+    return "{{{}}}".format(",".join(escaped))
+
+
+def render(registry: Registry) -> str:
+    """ Renders all metrics in `registry` in the Prometheus text exposition format """
+
+    lines = []
+    for (name, (kind, help_text, buckets)) in METRICS.items():
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+
+        if kind == "counter":
+            for ((metric, labels), value) in sorted(registry.counters.items()):
+                if metric == name:
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+            continue
+
+        for ((metric, labels), entry) in sorted(registry.histograms.items()):
+            if metric != name:
+                continue
+
+            count = 0
+            for (bound, bucket_count) in zip([*map(str, buckets), "+Inf"], entry[:-1]):
+                count += bucket_count
+                bucket_labels = format_labels((*labels, ("le", bound)))
+                lines.append("{}_bucket{} {}".format(name, bucket_labels, count))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), entry[-1]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+
+    return "\n".join(lines) + "\n"
+
+
+class QueryCounter(object):
+    """ Database execute wrapper that counts the queries run through it """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware(object):
+    """ Records the status, latency and number of database queries of every request, labelled
+    with the name of the view that handled it """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        query_counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(query_counter):
+            response = self.get_response(req)
+        duration = time.perf_counter() - start
+
+        view = getattr(req, "metrics_view", "unresolved")
+        increment(
+            "phost_http_requests_total",
+            view=view,
+            method=req.method,
+            status=response.status_code,
+        )
+        observe("phost_http_request_duration_seconds", duration, view=view)
+        observe("phost_http_request_db_queries", query_counter.count, view=view)
+        return response
+
+    def process_view(self, req, view_func, _view_args, _view_kwargs):
+        view_class = getattr(view_func, "view_class", None)
+        req.metrics_view = view_func.__name__ if view_class is None else view_class.__name__
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('serversite', '0005_proxydeployment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeployJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('create', 'Create deployment'), ('version', 'Push version')], max_length=16)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], db_index=True, default='pending', max_length=16)),
+                ('stage', models.CharField(blank=True, default='', max_length=32)),
+                ('subdomain', models.SlugField(max_length=255)),
+                ('version', models.CharField(max_length=32)),
+                ('params', models.TextField()),
+                ('result', models.TextField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('file_count', models.IntegerField(blank=True, null=True)),
+                ('total_bytes', models.BigIntegerField(blank=True, null=True)),
+                ('precompressed_count', models.IntegerField(blank=True, null=True)),
+                ('timings', models.TextField(default='{}')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('started_on', models.DateTimeField(blank=True, null=True)),
+                ('finished_on', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created_on'],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('serversite', '0006_deployjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='staticdeployment',
+            name='retain_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='staticdeployment',
+            name='retain_versions',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('serversite', '0007_staticdeployment_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='deploymentversion',
+            name='file_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='deploymentversion',
+            name='total_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
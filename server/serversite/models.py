@@ -15,6 +15,10 @@ class StaticDeployment(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
     categories = models.ManyToManyField(DeploymentCategory)
     not_found_document = models.TextField(null=True, blank=True)
+    # Retention policy for old versions, overriding `settings.VERSION_RETENTION_COUNT` and
+    # `settings.VERSION_RETENTION_DAYS` unless unset; see `retention.py`
+    retain_versions = models.PositiveIntegerField(null=True, blank=True)
+    retain_days = models.PositiveIntegerField(null=True, blank=True)
 
     def get_url(self) -> str:
         return "{}://{}.{}/".format(settings.PROTOCOL, self.subdomain, settings.ROOT_URL)
@@ -35,6 +39,12 @@ class DeploymentVersion(models.Model):
     created_on = models.DateTimeField(auto_now_add=True)
     deployment = models.ForeignKey(StaticDeployment, on_delete=models.CASCADE)
     active = models.BooleanField(default=False)
+    # Recorded when the version is deployed; `None` for versions deployed before that was done
+    # until `manage.py backfill_version_usage` is run.  `total_bytes` is the logical size of the
+    # version's files: files shared with other versions through hardlinks (delta uploads and
+    # deduplication) are counted once per version that contains them.
+    file_count = models.PositiveIntegerField(null=True, blank=True)
+    total_bytes = models.BigIntegerField(null=True, blank=True)
 
     def save(self, *args, **kwargs):  # pylint: disable=W0221
         self.version = self.version.lower()
@@ -57,3 +67,46 @@ class ProxyDeployment(models.Model):
 
     def get_url(self) -> str:
         return "{}://{}.{}/".format(settings.PROTOCOL, self.subdomain, settings.ROOT_URL)
+
+
+class DeployJob(models.Model):
+    """ A deployment or version upload whose extraction, post-processing and activation is run in
+    the background by a deploy job worker rather than in the request that uploaded it """
+
+    CREATE = "create"
+    VERSION = "version"
+    KIND_CHOICES = [(CREATE, "Create deployment"), (VERSION, "Push version")]
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATE_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default=PENDING, db_index=True)
+    # The step of the job that is currently running
+    stage = models.CharField(max_length=32, blank=True, default="")
+    subdomain = models.SlugField(max_length=255)
+    version = models.CharField(max_length=32)
+    # JSON-encoded inputs of the job, and the response body of the equivalent synchronous request
+    # once it has succeeded
+    params = models.TextField()
+    result = models.TextField(null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    file_count = models.IntegerField(null=True, blank=True)
+    total_bytes = models.BigIntegerField(null=True, blank=True)
+    precompressed_count = models.IntegerField(null=True, blank=True)
+    # JSON-encoded mapping of each stage to the number of seconds that it took
+    timings = models.TextField(default="{}")
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(null=True, blank=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_on"]
@@ -0,0 +1,98 @@
+""" Keyset pagination for the deployment list, ordered by `(created_on, id)` """
+
+import base64
+from datetime import datetime
+import uuid
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .validation import BadInputException
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+ORDERING = ("created_on", "id")
+
+
+def encode_cursor(created_on: datetime, pk) -> str:
+    raw = "{}|{}".format(created_on.isoformat(), pk)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        (created_on, pk) = raw.split("|", 1)
+        created_on = parse_datetime(created_on)
+        pk = uuid.UUID(pk)
+    except ValueError:
+        created_on = None
+
+    if created_on is None:
+        raise BadInputException("The supplied `cursor` is invalid")
+
+    return (created_on, pk)
+
+
+def parse_limit(limit) -> int:
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise BadInputException("`limit` must be an integer")
+
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise BadInputException("`limit` must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    return limit
+
+
+def parse_date_param(name: str, value: str) -> datetime:
+    """ Parses a filter date supplied either as a full ISO-8601 datetime or as a plain date.
+    Naive values are interpreted in the server's time zone. """
+
+    parsed = None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            date = parse_date(value)
+            if date is not None:
+                parsed = datetime(date.year, date.month, date.day)
+    except ValueError:
+        pass
+
+    if parsed is None:
+        raise BadInputException("`{}` must be an ISO-8601 date or datetime".format(name))
+
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def paginate(queryset, cursor=None, limit=None):
+    """ Applies keyset pagination to `queryset`.  Returns the queryset for the requested page
+    along with a function that, given the serialized rows of that page, returns the cursor for
+    the next page or `None` if this is the last one.  One extra row is fetched in order to
+    determine whether there are more pages; it is dropped by the returned function. """
+
+    queryset = queryset.order_by(*ORDERING)
+    if cursor is not None:
+        (created_on, pk) = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(created_on__gt=created_on) | Q(created_on=created_on, id__gt=pk)
+        )
+
+    if limit is None:
+        return (queryset, lambda rows: None)
+
+    def next_cursor(rows: list):
+        if len(rows) <= limit:
+            return None
+
+        del rows[limit:]
+        last = rows[-1]
+        return encode_cursor(last["created_on"], last["id"])
+
+    return (queryset[: limit + 1], next_cursor)
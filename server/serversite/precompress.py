@@ -0,0 +1,82 @@
+"""
+Stores gzipped copies of deployed text assets next to the originals (`app.js.gz` next to
+`app.js`) so that the web server can send them to clients that accept gzip without compressing
+them on every request.  See the `.gz` rules in `apache-config-inner.conf`.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+import shutil
+
+from django.conf import settings
+
+
+# Only files with these extensions are precompressed; everything else is either already
+# compressed or rarely benefits from it.  Keep this in sync with the Apache config.
+PRECOMPRESSED_EXTENSIONS = {
+    ".html",
+    ".css",
+    ".js",
+    ".mjs",
+    ".json",
+    ".svg",
+    ".xml",
+    ".txt",
+    ".map",
+    ".wasm",
+}
+
+# Files smaller than this fit in a packet or two either way, so they aren't worth compressing
+MIN_PRECOMPRESS_SIZE = 1024
+
+# Compressed copies that don't shrink the file by at least this much are thrown away
+MAX_COMPRESSION_RATIO = 0.9
+
+
+def should_precompress(path: str) -> bool:
+    if os.path.splitext(path)[1].lower() not in PRECOMPRESSED_EXTENSIONS:
+        return False
+    if os.path.islink(path) or os.path.lexists(path + ".gz"):
+        return False
+
+    return os.path.getsize(path) >= MIN_PRECOMPRESS_SIZE
+
+
+def precompress_file(path: str) -> bool:
+    """ Writes a gzipped copy of the file at `path` to `path.gz`, returning whether it was kept """
+
+    gz_path = path + ".gz"
+    tmp_path = gz_path + ".tmp"
+    with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+        # A fixed mtime in the header keeps the output identical for identical files
+        with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=9, mtime=0) as gz:
+            shutil.copyfileobj(src, gz)
+
+    stat = os.stat(path)
+    if os.path.getsize(tmp_path) > stat.st_size * MAX_COMPRESSION_RATIO:
+        os.unlink(tmp_path)
+        return False
+
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.replace(tmp_path, gz_path)
+    return True
+
+
+def precompress_dir(dir_path: str, workers=None) -> int:
+    """ Precompresses all eligible files in `dir_path` with a pool of `workers` threads
+    (`settings.EXTRACTION_WORKERS` by default), returning the number of compressed copies that
+    were written. """
+
+    if workers is None:
+        workers = settings.EXTRACTION_WORKERS
+
+    paths = [
+        os.path.join(parent_dir, file_name)
+        for (parent_dir, _, file_names) in os.walk(dir_path)
+        for file_name in file_names
+    ]
+    paths = [path for path in paths if should_precompress(path)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(precompress_file, paths))
@@ -0,0 +1,229 @@
+"""
+Opt-in profiling of individual requests.  Logged-in users can run a request under `cProfile` by
+sending an `X-Phost-Profile: 1` header or a `profile=1` query parameter.  The time taken by the
+main phases of a deploy (parsing the form, staging the upload, the database transaction and
+swapping `latest`) is recorded as spans alongside the profile.
+
+Profiles are stored in `HOST_PATH/.profiles`, which is kept under `settings.PROFILE_DIR_SIZE`
+bytes by deleting the oldest ones, and are listed and downloaded through `/profiles/`.
+`cProfile` only sees the thread that handles the request, so work done on other threads (such
+as extracting streamed uploads) only shows up in the spans that wait for it.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import io
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+
+PROFILE_DIR_NAME = ".profiles"
+PROFILE_ID_RGX = re.compile("^[0-9a-f]{32}$")
+
+# Number of functions included in text renderings of profiles
+TEXT_STATS_LIMIT = 60
+
+# The profile of the request being handled by the current thread, if it's being profiled
+ACTIVE = threading.local()
+
+
+class RequestProfile(object):
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.start = time.perf_counter()
+        self.spans = []
+        self.depth = 0
+        self.profiler = cProfile.Profile()
+
+
+@contextmanager
+def span(name: str):
+    """ Records the time taken by the body of the `with` statement if the current request is being
+    profiled """
+
+    profile = getattr(ACTIVE, "profile", None)
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    profile.depth += 1
+    try:
+        yield
+    finally:
+        profile.depth -= 1
+        profile.spans.append(
+            {
+                "name": name,
+                "start": start - profile.start,
+                "duration": time.perf_counter() - start,
+                "depth": profile.depth,
+            }
+        )
+
+
+def profile_dir() -> str:
+    return os.path.join(settings.HOST_PATH, PROFILE_DIR_NAME)
+
+
+def get_profile_paths(profile_id: str):
+    """ Returns the paths of the stats and metadata files of a stored profile, or `None` if there
+    is no such profile """
+
+    if PROFILE_ID_RGX.match(profile_id) is None:
+        return None
+
+    base_path = os.path.join(profile_dir(), profile_id)
+    if not os.path.exists(base_path + ".json"):
+        return None
+    return (base_path + ".prof", base_path + ".json")
+
+
+def list_profiles() -> list:
+    """ Returns the metadata of all stored profiles, most recent first """
+
+    profiles = []
+    try:
+        file_names = os.listdir(profile_dir())
+    except FileNotFoundError:
+        return []
+
+    for file_name in file_names:
+        if not file_name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(profile_dir(), file_name), "r") as f:
+                profiles.append(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+
+    profiles.sort(key=lambda profile: profile["created_on"], reverse=True)
+    return profiles
+
+
+def enforce_size_limit(max_bytes: int):
+    """ Deletes the oldest profiles until all of them take up at most `max_bytes`.  The most recent
+    profile is always kept. """
+
+    profiles = {}
+    for file_name in os.listdir(profile_dir()):
+        path = os.path.join(profile_dir(), file_name)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            continue
+        (mtime, size, paths) = profiles.get(os.path.splitext(file_name)[0], (0, 0, []))
+        profiles[os.path.splitext(file_name)[0]] = (
+            max(mtime, stat_result.st_mtime),
+            size + stat_result.st_size,
+            [*paths, path],
+        )
+
+    total = sum(size for (_, size, _) in profiles.values())
+    for (_, size, paths) in sorted(profiles.values())[:-1]:
+        if total <= max_bytes:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def save_profile(profile: RequestProfile, req, response, duration: float):
+    os.makedirs(profile_dir(), exist_ok=True)
+    base_path = os.path.join(profile_dir(), profile.id)
+
+    profile.profiler.dump_stats(base_path + ".prof")
+    metadata = {
+        "id": profile.id,
+        "created_on": timezone.now().isoformat(),
+        "method": req.method,
+        "path": req.get_full_path(),
+        "status": response.status_code,
+        "user": req.user.get_username(),
+        "duration": duration,
+        "spans": sorted(profile.spans, key=lambda span: span["start"]),
+    }
+    # The metadata is written last, since profiles are only listed once it exists
+    tmp_path = "{}.json.tmp".format(base_path)
+    with open(tmp_path, "w") as f:
+        json.dump(metadata, f)
+    os.replace(tmp_path, base_path + ".json")
+
+    enforce_size_limit(settings.PROFILE_DIR_SIZE)
+
+
+def format_profile(stats_path: str, metadata_path: str) -> str:
+    """ Renders the spans of a profile followed by its slowest functions as text """
+
+    with open(metadata_path, "r") as f:
+        metadata = json.load(f)
+
+    output = io.StringIO()
+    output.write(
+        "{method} {path} -> {status} in {duration:.3f}s\n\nSpans:\n".format(**metadata)
+    )
+    for span_data in metadata["spans"]:
+        output.write(
+            "  {:>9.3f}s {:>9.3f}s  {}{}\n".format(
+                span_data["start"],
+                span_data["duration"],
+                "  " * span_data["depth"],
+                span_data["name"],
+            )
+        )
+    output.write("\n")
+
+    stats = pstats.Stats(stats_path, stream=output)
+    stats.sort_stats("cumulative").print_stats(TEXT_STATS_LIMIT)
+    return output.getvalue()
+
+
+def wants_profile(req) -> bool:
+    # The user is only loaded when asked for, since that takes a query for the session and one
+    # for the user itself
+    if req.META.get("HTTP_X_PHOST_PROFILE") != "1" and req.GET.get("profile") != "1":
+        return False
+    return req.user.is_authenticated
+
+
+class ProfilingMiddleware(object):
+    """ Profiles requests that ask for it (see `wants_profile`).  The ID of the stored profile is
+    returned in the `X-Phost-Profile-Id` response header.  Must come after Django's
+    `AuthenticationMiddleware`. """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, req):
+        if not wants_profile(req):
+            return self.get_response(req)
+
+        profile = RequestProfile()
+        ACTIVE.profile = profile
+        profile.profiler.enable()
+        try:
+            response = self.get_response(req)
+        finally:
+            profile.profiler.disable()
+            ACTIVE.profile = None
+        duration = time.perf_counter() - profile.start
+
+        try:
+            save_profile(profile, req, response, duration)
+        except OSError as e:
+            print("Error saving profile of {} {}: {}".format(req.method, req.path, e))
+            return response
+
+        response["X-Phost-Profile-Id"] = profile.id
+        return response
@@ -6,6 +6,8 @@ import os
 
 from django.conf import settings
 
+from . import metrics
+
 
 CHILD_PID = None
 
@@ -22,7 +24,11 @@ def spawn_proxy_server():
     CHILD_PID = handle.pid
 
 
-def trigger_proxy_server_update():
+def trigger_proxy_server_update(trigger: str):
+    """ Tells the proxy server to reload its configuration after a proxy has been changed by
+    `trigger` (`"create"` or `"delete"`) """
+
+    metrics.increment("phost_proxy_reloads_total", trigger=trigger)
     if CHILD_PID is None:
         print("Error: tried to trigger update of child proxy server before it's been spawned")
         return
@@ -0,0 +1,170 @@
+"""
+Retention policies for old versions of deployments.  A version is kept if it's the active
+version, if it's one of the `retain_versions` most recent versions of its deployment or if it was
+created within the last `retain_days` days; everything else is expired.  Deployments that don't
+set a limit of their own fall back to `settings.VERSION_RETENTION_COUNT` and
+`settings.VERSION_RETENTION_DAYS`, and a limit of 0 disables that rule.  Versions are only ever
+expired if at least one rule is enabled.
+
+Expired versions are collected by `manage.py gc_versions` and, if
+`settings.VERSION_GC_INTERVAL` is set, periodically in the background after new versions are
+pushed.
+"""
+
+from datetime import timedelta
+import os
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .background import run_throttled
+from .models import StaticDeployment, DeploymentVersion
+from .upload import delete_hosted_version
+
+
+def get_retention_policy(deployment: StaticDeployment) -> tuple:
+    """ Returns the number of versions and days for which versions of `deployment` are kept """
+
+    retain_versions = deployment.retain_versions
+    if retain_versions is None:
+        retain_versions = settings.VERSION_RETENTION_COUNT
+    retain_days = deployment.retain_days
+    if retain_days is None:
+        retain_days = settings.VERSION_RETENTION_DAYS
+
+    return (retain_versions, retain_days)
+
+
+def find_expired_versions(deployment: StaticDeployment, versions: list, now=None) -> list:
+    """ Returns the versions out of `versions`, all of which belong to `deployment`, that are
+    expired by its retention policy """
+
+    (retain_versions, retain_days) = get_retention_policy(deployment)
+    if not retain_versions and not retain_days:
+        return []
+
+    cutoff = None
+    if retain_days:
+        cutoff = (now or timezone.now()) - timedelta(days=retain_days)
+
+    expired = []
+    newest_first = sorted(versions, key=lambda version: version.created_on, reverse=True)
+    for (i, version) in enumerate(newest_first):
+        if version.active:
+            continue
+        if retain_versions and i < retain_versions:
+            continue
+        if cutoff is not None and version.created_on >= cutoff:
+            continue
+        expired.append(version)
+
+    return expired
+
+
+def iter_expired_versions(deployments=None, batch_size=100):
+    """ Yields `(deployment, expired_versions)` for all deployments in the `deployments` queryset
+    (all deployments by default) that have expired versions, loading `batch_size` deployments
+    and their versions at a time """
+
+    if deployments is None:
+        deployments = StaticDeployment.objects.all()
+
+    now = timezone.now()
+    deployments = deployments.order_by("pk")
+    last_pk = None
+    while True:
+        batch = deployments if last_pk is None else deployments.filter(pk__gt=last_pk)
+        batch = list(batch.prefetch_related("deploymentversion_set")[:batch_size])
+        if not batch:
+            return
+
+        for deployment in batch:
+            expired = find_expired_versions(
+                deployment, list(deployment.deploymentversion_set.all()), now
+            )
+            if expired:
+                yield (deployment, expired)
+        last_pk = batch[-1].pk
+
+
+def reclaimable_bytes(subdomain: str, version: str) -> int:
+    """ Returns the number of bytes that deleting a version would free.  Files that are hardlinked
+    elsewhere, such as deduplicated files shared with other versions, aren't counted. """
+
+    # Deduplicated files are always linked into the blob store as well
+    max_links = 2 if settings.DEDUPLICATE_DEPLOYMENTS else 1
+
+    total = 0
+    version_dir = os.path.join(settings.HOST_PATH, subdomain, version)
+    for (parent_dir, _, file_names) in os.walk(version_dir):
+        for file_name in file_names:
+            try:
+                stat = os.lstat(os.path.join(parent_dir, file_name))
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink <= max_links:
+                total += stat.st_size
+
+    return total
+
+
+def delete_expired_versions(deployment: StaticDeployment, versions: list) -> list:
+    """ Deletes expired `versions` of `deployment`, skipping any that have been activated in the
+    meantime, and returns the names of the versions that were deleted """
+
+    with transaction.atomic():
+        expired = DeploymentVersion.objects.select_for_update().filter(
+            pk__in=[version.pk for version in versions], active=False
+        )
+        deleted = list(expired.values_list("version", flat=True))
+        expired.delete()
+
+        for version in deleted:
+            delete_hosted_version(deployment.subdomain, version)
+
+    return deleted
+
+
+def collect_expired_versions(deployments=None, dry_run=False, batch_size=100) -> list:
+    """ Deletes all expired versions, one deployment at a time, and returns a report listing the
+    `deployment`, `version`, `created_on` and reclaimable `bytes` of each of them.  If `dry_run`
+    is set, nothing is deleted. """
+
+    report = []
+    for (deployment, expired) in iter_expired_versions(deployments, batch_size):
+        entries = [
+            {
+                "deployment": deployment.name,
+                "subdomain": deployment.subdomain,
+                "version": version.version,
+                "created_on": version.created_on,
+                "bytes": reclaimable_bytes(deployment.subdomain, version.version),
+            }
+            for version in expired
+        ]
+
+        if not dry_run:
+            deleted = delete_expired_versions(deployment, expired)
+            entries = [entry for entry in entries if entry["version"] in deleted]
+        report.extend(entries)
+
+    return report
+
+
+def run_version_gc():
+    try:
+        report = collect_expired_versions()
+        if report:
+            print("Deleted {} expired versions".format(len(report)))
+    finally:
+        # The background thread's connection would otherwise be left open
+        connection.close()
+
+
+def schedule_version_gc():
+    """ Collects expired versions in the background unless that has been done within the last
+    `settings.VERSION_GC_INTERVAL` seconds or periodic collection is disabled """
+
+    if settings.VERSION_GC_INTERVAL > 0:
+        run_throttled("collect_expired_versions", settings.VERSION_GC_INTERVAL, run_version_gc)
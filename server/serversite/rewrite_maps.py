@@ -0,0 +1,118 @@
+"""
+Maps that let the web server handle requests without going through Django.
+
+The not found map lists the 404 document (usually an SPA's `index.html`) of every deployment that
+has one, and is used as an Apache `RewriteMap` so that missed paths are served the document
+directly.  Django's `/404/` handler is only hit for deployments that aren't in the map.  The map
+is regenerated from the database whenever a deployment is created, deleted or has its 404
+document changed.
+
+Apache re-reads `txt:` maps whenever their modification time changes, so the map is written to a
+temporary file which is then renamed over the old one and no reload is needed.
+"""
+
+import fcntl
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import StaticDeployment
+
+
+REWRITE_MAP_DIR_NAME = ".rewrite-maps"
+NOT_FOUND_MAP_NAME = "not-found.txt"
+
+# Map values are separated by whitespace and can't contain any themselves
+WHITESPACE_RGX = re.compile(r"\s")
+
+
+def not_found_map_path() -> str:
+    return os.path.join(settings.HOST_PATH, REWRITE_MAP_DIR_NAME, NOT_FOUND_MAP_NAME)
+
+
+def normalize_not_found_document(not_found_document: str):
+    """ Returns the path of a 404 document relative to the deployment's `latest` directory, or
+    `None` if it can't be served by the web server directly.  Documents outside of the deployment
+    are left to Django, which rejects them. """
+
+    if not not_found_document or WHITESPACE_RGX.search(not_found_document):
+        return None
+    if posixpath.isabs(not_found_document):
+        return None
+
+    document = posixpath.normpath(not_found_document)
+    if document == "." or document == ".." or document.startswith("../"):
+        return None
+
+    return document
+
+
+def write_not_found_map() -> int:
+    """ Regenerates the not found map from the database, returning the number of entries in it.
+    A lock file serializes concurrent writers so that a map built from older data can never
+    replace a newer one. """
+
+    path = not_found_map_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            deployments = (
+                StaticDeployment.objects.exclude(not_found_document=None)
+                .exclude(not_found_document="")
+                .order_by("subdomain")
+                .values_list("subdomain", "not_found_document")
+            )
+            entries = []
+            for (subdomain, not_found_document) in deployments:
+                document = normalize_not_found_document(not_found_document)
+                if document is not None:
+                    entries.append("{} {}\n".format(subdomain, document))
+
+            tmp_path = "{}.{}".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                f.write("# Generated by phost; changes will be overwritten\n")
+                f.writelines(entries)
+            os.replace(tmp_path, path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return len(entries)
+
+
+def read_not_found_map(path: str) -> dict:
+    """ Parses a not found map into a mapping of subdomain to 404 document """
+
+    entries = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and not parts[0].startswith("#"):
+                entries[parts[0]] = parts[1]
+
+    return entries
+
+
+def write_not_found_map_after_commit():
+    try:
+        write_not_found_map()
+    except OSError as e:
+        # Django's 404 handler still serves the documents, just more slowly
+        print("Error writing the not found map: {}".format(e))
+
+
+@receiver(post_save, sender=StaticDeployment)
+def update_not_found_map_on_save(created=False, update_fields=None, **_kwargs):
+    if created or update_fields is None or "not_found_document" in update_fields:
+        transaction.on_commit(write_not_found_map_after_commit)
+
+
+@receiver(post_delete, sender=StaticDeployment)
+def update_not_found_map_on_delete(**_kwargs):
+    transaction.on_commit(write_not_found_map_after_commit)
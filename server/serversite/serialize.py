@@ -1,17 +1,333 @@
-from functools import partial
+"""
+Serializes models into plain dicts.  The output matches that of Django's `python` serializer
+flattened into `{"id": pk, **fields}`, but is built directly out of `values()` projections rather
+than constructing a full serializer pipeline for every row.
+"""
 
-from django.core import serializers
-from django.db.models import QuerySet
+from collections import defaultdict
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import QuerySet, Sum
 from django.http import JsonResponse
+from django.utils.encoding import is_protected_type
+
+from .models import StaticDeployment, DeploymentVersion, DeploymentCategory, ProxyDeployment
+
+
+# The concrete fields of each model that are included in its serialized form, in the order in
+# which they're declared on the model.
+SERIALIZED_FIELDS = {
+    StaticDeployment: [
+        "name",
+        "subdomain",
+        "created_on",
+        "not_found_document",
+        "retain_versions",
+        "retain_days",
+    ],
+    DeploymentVersion: [
+        "version",
+        "created_on",
+        "deployment",
+        "active",
+        "file_count",
+        "total_bytes",
+    ],
+    DeploymentCategory: ["category"],
+    ProxyDeployment: ["name", "subdomain", "use_cors_headers", "destination_address", "created_on"],
+}
+
+# Many-to-many fields are serialized as lists of primary keys after all concrete fields
+SERIALIZED_M2M_FIELDS = {StaticDeployment: ["categories"]}
+
+# Fields that can be requested from the deployment list and detail endpoints, in output order
+DEPLOYMENT_FIELDS = [
+    "id",
+    *SERIALIZED_FIELDS[StaticDeployment],
+    *SERIALIZED_M2M_FIELDS[StaticDeployment],
+    "versions",
+    "active_version",
+    "total_bytes",
+]
+
+# Fields included in the deployment list when no fields are explicitly requested
+DEFAULT_DEPLOYMENT_LIST_FIELDS = [
+    field for field in DEPLOYMENT_FIELDS if field not in ["active_version", "total_bytes"]
+]
+
+# Maximum number of primary keys included in a single `__in` lookup
+BATCH_SIZE = 500
+
+# Number of rows fetched and serialized at a time when streaming out serialized rows
+STREAM_CHUNK_SIZE = 500
+
+
+def to_serializable(value):
+    """ Mirrors the conversion done by Django's serializers: primitive types are passed through
+    as-is while everything else (UUIDs, for example) is converted to a string. """
+
+    return value if is_protected_type(value) else str(value)
+
+
+def batched(items: list, batch_size=BATCH_SIZE):
+    for i in range(0, len(items), batch_size):
+        yield items[i : i + batch_size]
+
+
+def iter_pk_lookups(pks):
+    """ Yields the values to filter `__in` lookups by in order to select the rows related to
+    `pks`, which is either a list of primary keys or a queryset.  Querysets are used as a single
+    subquery so that the number of queries doesn't grow with the number of rows, while lists are
+    split into batches. """
+
+    if isinstance(pks, QuerySet):
+        yield pks.values("pk")
+    else:
+        yield from batched(pks)
+
+
+def get_pk_source(queryset, rows: list):
+    """ Returns what the related rows of `rows`, the serialized rows of `queryset`, should be
+    looked up by (see `iter_pk_lookups`).  Sliced querysets can't be used as subqueries since
+    MySQL doesn't support `LIMIT` in them, so their rows' primary keys are used instead. """
+
+    if queryset is not None and queryset.query.can_filter():
+        return queryset
+    return [row["id"] for row in rows]
+
+
+def serialize_m2m_ids(Model, field_name: str, pks) -> dict:
+    """ Returns a mapping of primary key to the list of related primary keys for the many-to-many
+    field `field_name` of all `pks` (see `iter_pk_lookups`). """
+
+    field = Model._meta.get_field(field_name)
+    through = field.remote_field.through
+    (source_name, target_name) = (field.m2m_field_name(), field.m2m_reverse_field_name())
+
+    related_ids = defaultdict(list)
+    for pk_lookup in iter_pk_lookups(pks):
+        rows = (
+            through.objects.filter(**{"{}__in".format(source_name): pk_lookup})
+            .order_by(target_name)
+            .values_list(source_name, target_name)
+        )
+        for (source_id, target_id) in rows:
+            related_ids[to_serializable(source_id)].append(to_serializable(target_id))
+
+    return related_ids
+
+
+def project(queryset: QuerySet, fields=None) -> tuple:
+    """ Builds the `values()` projection of `queryset` containing its primary key and all of the
+    concrete fields in `fields` (all serialized fields if not supplied).  Returns it along with
+    the list of many-to-many fields that need to be attached to the projected rows. """
+
+    Model = queryset.model
+    concrete_fields = SERIALIZED_FIELDS[Model]
+    m2m_fields = SERIALIZED_M2M_FIELDS.get(Model, [])
+    if fields is not None:
+        concrete_fields = [field for field in concrete_fields if field in fields]
+        m2m_fields = [field for field in m2m_fields if field in fields]
+
+    return (queryset.prefetch_related(None).values("id", *concrete_fields), m2m_fields)
+
+
+def serialize_rows(Model, rows, m2m_fields: list, queryset=None) -> list:
+    """ Serializes projected rows and attaches their many-to-many fields.  If the rows are those of
+    `queryset`, it is used to look up the related rows with a fixed number of queries. """
+
+    serialized_rows = [
+        {key: to_serializable(value) for (key, value) in row.items()} for row in rows
+    ]
+
+    if m2m_fields:
+        pks = get_pk_source(queryset, serialized_rows)
+        for field_name in m2m_fields:
+            related_ids = serialize_m2m_ids(Model, field_name, pks)
+            for row in serialized_rows:
+                row[field_name] = related_ids.get(row["id"], [])
+
+    return serialized_rows
+
+
+def serialize_queryset(queryset: QuerySet, fields=None) -> list:
+    """ Serializes all rows of `queryset`.  If `fields` is supplied, only the columns and
+    many-to-many fields in it are selected; the primary key is always included. """
+
+    (rows, m2m_fields) = project(queryset, fields)
+    return serialize_rows(queryset.model, rows, m2m_fields, queryset=queryset)
+
+
+def iter_serialized_chunks(queryset: QuerySet, fields=None, chunk_size=STREAM_CHUNK_SIZE):
+    """ Like `serialize_queryset`, but lazily yields the serialized rows in lists of at most
+    `chunk_size` rows so that only one chunk needs to be held in memory at a time. """
+
+    (rows, m2m_fields) = project(queryset, fields)
+    chunk = []
+    for row in rows.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield serialize_rows(queryset.model, chunk, m2m_fields)
+            chunk = []
+
+    if chunk:
+        yield serialize_rows(queryset.model, chunk, m2m_fields)
+
+
+def serialize_instance(model) -> dict:
+    Model = type(model)
+    serialized = {"id": to_serializable(model.pk)}
+    for field_name in SERIALIZED_FIELDS[Model]:
+        field = Model._meta.get_field(field_name)
+        serialized[field_name] = to_serializable(field.value_from_object(model))
+
+    for field_name in SERIALIZED_M2M_FIELDS.get(Model, []):
+        prefetched = getattr(model, "_prefetched_objects_cache", {}).get(field_name)
+        if prefetched is not None:
+            related_pks = sorted(related.pk for related in prefetched)
+        else:
+            related_pks = getattr(model, field_name).order_by("pk").values_list("pk", flat=True)
+        serialized[field_name] = [to_serializable(pk) for pk in related_pks]
+
+    return serialized
+
+
+def serialize_children(Model, parent_field: str, parent_ids) -> dict:
+    """ Serializes all instances of `Model` whose `parent_field` foreign key points to one of
+    `parent_ids` (see `iter_pk_lookups`), returning them grouped by parent ID.  Instances are kept
+    in `Model`'s default ordering within each group. """
+
+    children = defaultdict(list)
+    for id_lookup in iter_pk_lookups(parent_ids):
+        queryset = Model.objects.filter(**{"{}__in".format(parent_field): id_lookup})
+        for child in serialize_queryset(queryset):
+            children[child[parent_field]].append(child)
+
+    return children
+
+
+def get_active_versions(deployment_ids) -> dict:
+    """ Returns a mapping of deployment ID to the name of its active version """
+
+    active_versions = {}
+    for id_lookup in iter_pk_lookups(deployment_ids):
+        rows = DeploymentVersion.objects.filter(deployment__in=id_lookup, active=True).values_list(
+            "deployment", "version"
+        )
+        for (deployment_id, version) in rows:
+            active_versions[to_serializable(deployment_id)] = version
+
+    return active_versions
+
+
+def sum_version_bytes(versions: list) -> int:
+    """ Sums up the sizes of serialized versions; versions of unknown size are skipped """
+
+    return sum(version["total_bytes"] or 0 for version in versions)
+
+
+def get_total_bytes(deployment_ids) -> dict:
+    """ Returns a mapping of deployment ID to the total size of all of its versions """
+
+    total_bytes = {}
+    for id_lookup in iter_pk_lookups(deployment_ids):
+        rows = (
+            DeploymentVersion.objects.filter(deployment__in=id_lookup)
+            .order_by()
+            .values_list("deployment")
+            .annotate(Sum("total_bytes"))
+        )
+        for (deployment_id, deployment_bytes) in rows:
+            total_bytes[to_serializable(deployment_id)] = deployment_bytes or 0
+
+    return total_bytes
+
+
+def with_deployment_relations(deployments_data: list, fields=None, queryset=None) -> list:
+    """ Attaches the full serialized versions and categories to a list of serialized deployments
+    and trims each of them down to `fields` (`DEFAULT_DEPLOYMENT_LIST_FIELDS` if not supplied).
+    Related rows are only queried if they were requested, using one query for each of `versions`
+    (which `active_version` and `total_bytes` are then derived from), `active_version`,
+    `total_bytes` and `categories`.  If the deployments are the rows of an unsliced `queryset`,
+    this holds no matter how many there are; otherwise one query is run per batch of
+    `BATCH_SIZE` deployments. """
+
+    if fields is None:
+        fields = DEFAULT_DEPLOYMENT_LIST_FIELDS
+
+    deployment_ids = get_pk_source(queryset, deployments_data)
+    relations = {}
+
+    if "versions" in fields:
+        versions_by_deployment = serialize_children(DeploymentVersion, "deployment", deployment_ids)
+        relations["versions"] = lambda datum: versions_by_deployment.get(datum["id"], [])
+
+    if "active_version" in fields:
+        if "versions" in fields:
+            active_versions = {
+                deployment_id: version["version"]
+                for (deployment_id, versions) in versions_by_deployment.items()
+                for version in versions
+                if version["active"]
+            }
+        else:
+            active_versions = get_active_versions(deployment_ids)
+        relations["active_version"] = lambda datum: active_versions.get(datum["id"])
+
+    if "total_bytes" in fields:
+        if "versions" in fields:
+            total_bytes = {
+                deployment_id: sum_version_bytes(versions)
+                for (deployment_id, versions) in versions_by_deployment.items()
+            }
+        else:
+            total_bytes = get_total_bytes(deployment_ids)
+        relations["total_bytes"] = lambda datum: total_bytes.get(datum["id"], 0)
+
+    if "categories" in fields:
+        category_ids = {
+            category_id for datum in deployments_data for category_id in datum["categories"]
+        }
+        categories = DeploymentCategory.objects.filter(id__in=category_ids)
+        categories_by_id = {
+            category["id"]: category for category in serialize_queryset(categories)
+        }
+        relations["categories"] = lambda datum: [
+            categories_by_id[pk] for pk in datum["categories"]
+        ]
+
+    return [
+        {
+            field: relations[field](datum) if field in relations else datum[field]
+            for field in DEPLOYMENT_FIELDS
+            if field in fields
+        }
+        for datum in deployments_data
+    ]
+
+
+def iter_ndjson_deployments(deployment_chunks, fields=None):
+    """ Yields one line of JSON for each deployment in `deployment_chunks`, an iterable of lists of
+    serialized deployments.  Relations are attached one chunk at a time. """
+
+    for deployments_data in deployment_chunks:
+        for datum in with_deployment_relations(deployments_data, fields):
+            yield json.dumps(datum, cls=DjangoJSONEncoder) + "\n"
+
+
+def serialize_deployments(queryset: QuerySet) -> list:
+    return with_deployment_relations(serialize_queryset(queryset), queryset=queryset)
 
 
 def serialize(model, json=True):
     serialized = None
-    if isinstance(model, list) or isinstance(model, QuerySet):
-        serialized = list(map(partial(serialize, json=False), model))
+    if isinstance(model, QuerySet):
+        serialized = serialize_queryset(model)
+    elif isinstance(model, list):
+        serialized = list(map(serialize_instance, model))
     else:
-        data = serializers.serialize("python", [model])[0]
-        serialized = {"id": data["pk"], **data["fields"]}
+        serialized = serialize_instance(model)
 
     if json:
         return JsonResponse(serialized, safe=False)
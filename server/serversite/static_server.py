@@ -0,0 +1,389 @@
+"""
+Standalone WSGI application that serves hosted deployments straight out of `HOST_PATH`, for
+running without Apache (local development, tests and small nodes).  It mirrors what the Apache
+config does: `<subdomain>.<ROOT_URL>/path` is served from the deployment's `latest` version and
+`<subdomain>.<ROOT_URL>/v/<version>/path` from a specific one, gzipped copies of text assets are
+sent to clients that accept them and missed paths get the deployment's 404 document.
+
+It never touches the database; the `latest` symlinks and the not found map (see
+`rewrite_maps.py`) already describe everything that's needed.  Small files are kept in a bounded
+in-memory cache, and everything else is handed to the WSGI server's `wsgi.file_wrapper` so that
+servers which support it send the file with `sendfile`.  `manage.py serve_deployments` runs the
+application with a server that does.
+"""
+
+from collections import OrderedDict
+import mimetypes
+import os
+import re
+import socket
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import quote
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from django.conf import settings
+from django.utils.http import http_date, parse_http_date_safe
+
+from .files import make_etag, parse_range, if_range_matches, RangeNotSatisfiable
+from .precompress import PRECOMPRESSED_EXTENSIONS
+from .rewrite_maps import REWRITE_MAP_DIR_NAME, NOT_FOUND_MAP_NAME, read_not_found_map
+from .validation import DEPLOYMENT_SUBDOMAIN_RGX
+
+
+VERSION_PATH_RGX = re.compile("^/v/([^/]+)(/.*)?$")
+
+FILE_BLOCK_SIZE = 64 * 1024
+
+
+class FileCache(object):
+    """ Bounded LRU cache of the contents of small files.  Entries are keyed by the identity of
+    the file rather than its path; files in the hosting directory are never modified in place, so
+    they can't go stale. """
+
+    def __init__(self, max_bytes: int, max_file_size: int):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data: bytes):
+        if len(data) > self.max_file_size:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class NotFoundMap(object):
+    """ The not found map written by `rewrite_maps.py`, re-read whenever it changes just like
+    Apache does """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = None
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, subdomain: str):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.entries = read_not_found_map(self.path)
+                    self.mtime = mtime
+
+        return self.entries.get(subdomain)
+
+
+class FileRange(object):
+    """ File-like object that reads at most `length` bytes from the current position of `file`.
+    WSGI servers that send file wrappers with `sendfile` start at the position of `fileno()` and
+    send `Content-Length` bytes; others read them through `read()`. """
+
+    def __init__(self, file, length: int):
+        self.file = file
+        self.remaining = length
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def read(self, size=-1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def decode_path(path_info: str):
+    """ Decodes the WSGI `PATH_INFO`, returning `None` if it isn't valid UTF-8 or tries to escape
+    the directory that it's served from """
+
+    try:
+        path = path_info.encode("latin-1").decode("utf-8")
+    except UnicodeError:
+        return None
+
+    if "\0" in path or ".." in path.split("/"):
+        return None
+    return path
+
+
+def file_identity(stat_result) -> tuple:
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def accepts_gzip(environ: dict) -> bool:
+    accept_encoding = environ.get("HTTP_ACCEPT_ENCODING", "")
+    return any(
+        encoding.split(";")[0].strip() == "gzip" for encoding in accept_encoding.split(",")
+    )
+
+
+def is_not_modified(environ: dict, etag: str, last_modified: int) -> bool:
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in etags or etag in etags or "W/" + etag in etags
+
+    if_modified_since = parse_http_date_safe(environ.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def simple_response(start_response, status: str, headers=None, body=b""):
+    start_response(
+        status,
+        [("Content-Type", "text/plain"), ("Content-Length", str(len(body))), *(headers or [])],
+    )
+    return [body]
+
+
+class StaticServer(object):
+    def __init__(self, host_path=None, root_url=None):
+        self.host_path = host_path or settings.HOST_PATH
+        self.root_url = (root_url or settings.ROOT_URL).lower()
+        self.not_found_map = NotFoundMap(
+            os.path.join(self.host_path, REWRITE_MAP_DIR_NAME, NOT_FOUND_MAP_NAME)
+        )
+        self.cache = FileCache(settings.STATIC_CACHE_SIZE, settings.STATIC_CACHE_MAX_FILE_SIZE)
+
+    def get_subdomain(self, environ: dict):
+        host = (environ.get("HTTP_HOST") or environ.get("SERVER_NAME", "")).lower()
+        host = host.split(":")[0]
+        if not host.endswith("." + self.root_url):
+            return None
+
+        subdomain = host[: -len(self.root_url) - 1]
+        if DEPLOYMENT_SUBDOMAIN_RGX.match(subdomain) is None:
+            return None
+        return subdomain
+
+    def __call__(self, environ: dict, start_response):
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return simple_response(
+                start_response, "405 Method Not Allowed", [("Allow", "GET, HEAD")]
+            )
+
+        subdomain = self.get_subdomain(environ)
+        path = decode_path(environ.get("PATH_INFO") or "/")
+        if subdomain is None or path is None:
+            return simple_response(start_response, "404 Not Found", body=b"Not Found")
+
+        version = "latest"
+        match = VERSION_PATH_RGX.match(path)
+        if match is not None:
+            (version, path) = (match[1], match[2])
+            if path is None:
+                return self.redirect_to_directory(environ, start_response, "/v/" + version)
+
+        deployment_dir = os.path.join(self.host_path, subdomain)
+        file_path = os.path.join(deployment_dir, version, path.lstrip("/"))
+        if path.endswith("/"):
+            file_path = os.path.join(file_path, "index.html")
+
+        if os.path.isdir(file_path):
+            return self.redirect_to_directory(environ, start_response, path)
+        if os.path.isfile(file_path):
+            return self.serve(environ, start_response, file_path)
+
+        # Only the active version has a fallback, the same as with Apache
+        not_found_document = self.not_found_map.get(subdomain) if version == "latest" else None
+        if not_found_document is not None:
+            document_path = os.path.join(deployment_dir, "latest", not_found_document)
+            if os.path.isfile(document_path):
+                return self.serve(environ, start_response, document_path)
+
+        return simple_response(start_response, "404 Not Found", body=b"Not Found")
+
+    def redirect_to_directory(self, environ: dict, start_response, path: str):
+        location = quote(path + "/")
+        if environ.get("QUERY_STRING"):
+            location += "?" + environ["QUERY_STRING"]
+        return simple_response(start_response, "301 Moved Permanently", [("Location", location)])
+
+    def serve(self, environ: dict, start_response, path: str):
+        (content_type, _encoding) = mimetypes.guess_type(path)
+        headers = [("Content-Type", content_type or "application/octet-stream")]
+
+        # Send the precompressed copy (see `precompress.py`) to clients that accept it
+        if os.path.splitext(path)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+            headers.append(("Vary", "Accept-Encoding"))
+            if accepts_gzip(environ) and os.path.isfile(path + ".gz"):
+                path += ".gz"
+                headers.append(("Content-Encoding", "gzip"))
+
+        (data, file) = (None, None)
+        stat_result = os.stat(path)
+        if stat_result.st_size <= self.cache.max_file_size:
+            data = self.cache.get(file_identity(stat_result))
+        if data is None:
+            file = open(path, "rb")
+            stat_result = os.fstat(file.fileno())
+            if stat_result.st_size <= self.cache.max_file_size:
+                with file:
+                    data = file.read()
+                file = None
+                self.cache.put(file_identity(stat_result), data)
+
+        try:
+            size = stat_result.st_size
+            etag = make_etag(stat_result)
+            last_modified = int(stat_result.st_mtime)
+            headers.extend(
+                [
+                    ("ETag", etag),
+                    ("Last-Modified", http_date(last_modified)),
+                    ("Accept-Ranges", "bytes"),
+                ]
+            )
+
+            if is_not_modified(environ, etag, last_modified):
+                start_response("304 Not Modified", headers)
+                return []
+
+            (status, start, end) = ("200 OK", 0, size - 1)
+            range_header = environ.get("HTTP_RANGE")
+            if_range = environ.get("HTTP_IF_RANGE")
+            if range_header and if_range_matches(if_range, etag, last_modified):
+                try:
+                    byte_range = parse_range(range_header, size)
+                except RangeNotSatisfiable:
+                    return simple_response(
+                        start_response,
+                        "416 Range Not Satisfiable",
+                        [("Content-Range", "bytes */{}".format(size))],
+                    )
+                if byte_range is not None:
+                    (status, (start, end)) = ("206 Partial Content", byte_range)
+                    headers.append(("Content-Range", "bytes {}-{}/{}".format(start, end, size)))
+
+            headers.append(("Content-Length", str(end - start + 1)))
+            start_response(status, headers)
+            if environ["REQUEST_METHOD"] == "HEAD":
+                return []
+            if data is not None:
+                return [data[start : end + 1]]
+
+            file.seek(start)
+            body = FileRange(file, end - start + 1)
+            file = None
+            file_wrapper = environ.get("wsgi.file_wrapper")
+            if file_wrapper is not None:
+                return file_wrapper(body, FILE_BLOCK_SIZE)
+            return iter_file_range(body)
+        finally:
+            if file is not None:
+                file.close()
+
+
+def iter_file_range(body: FileRange):
+    try:
+        while True:
+            chunk = body.read(FILE_BLOCK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        body.close()
+
+
+class SendfileHandler(ServerHandler):
+    """ `wsgiref` handler that sends file wrappers with `socket.sendfile` rather than copying them
+    through Python """
+
+    def __init__(self, connection: socket.socket, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection = connection
+
+    def sendfile(self) -> bool:
+        filelike = self.result.filelike
+        content_length = self.headers.get("Content-Length")
+        if not hasattr(filelike, "fileno") or content_length is None:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+
+        file = getattr(filelike, "file", filelike)
+        offset = os.lseek(file.fileno(), 0, os.SEEK_CUR)
+        self.bytes_sent += self.connection.sendfile(file, offset, int(content_length))
+        return True
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+
+        handler = SendfileHandler(
+            self.connection,
+            self.rfile,
+            self.wfile,
+            self.get_stderr(),
+            self.get_environ(),
+            multithread=True,
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+    def log_request(self, *args, **kwargs):
+        if self.server.log_requests:
+            super().log_request(*args, **kwargs)
+
+
+class ThreadingStaticServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    log_requests = False
+
+
+def make_static_server(host: str, port: int, app=None, log_requests=False):
+    """ Creates a threaded HTTP server that serves `app` (a `StaticServer` for the configured
+    hosting directory by default) on `host:port` """
+
+    server = ThreadingStaticServer((host, port), SendfileRequestHandler)
+    server.log_requests = log_requests
+    server.set_app(app or StaticServer())
+    return server
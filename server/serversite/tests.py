@@ -1,8 +1,82 @@
-from django.test import TestCase
-from django.db import transaction
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
+from wsgiref.util import setup_testing_defaults
 
-from .models import StaticDeployment
-from .views import get_or_none
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.exceptions import RequestDataTooBig
+from django.core.signals import request_started, request_finished
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import (
+    StaticDeployment,
+    DeploymentVersion,
+    DeploymentCategory,
+    DeployJob,
+    ProxyDeployment,
+)
+from .views import get_or_none, not_found
+from .files import parse_range, RangeNotSatisfiable
+from .serialize import serialize
+from .deploy import create_deployment, create_version
+from .upload import (
+    StreamingArchiveUploadHandler,
+    install_streaming_upload_handler,
+    handle_uploaded_static_archive,
+    stage_uploaded_archive,
+    update_symlink,
+    create_staging_dir,
+    sweep_staging_dirs,
+    delete_hosted_version,
+    delete_hosted_deployment,
+    StagedVersion,
+    HOST_DIR,
+    STAGING_DIR,
+)
+from .background import wait_for_background_tasks
+from .blobs import BLOB_STORE
+from .manifest import load_manifest
+from .delta import Delta, parse_manifest, find_missing
+from .upload_sessions import UploadSession
+from .validation import BadInputException, NotFound
+from .extract import extract_archive, UnsafeArchiveMember
+from .jobs import run_pending_jobs
+from .metrics import METRICS_DIR_NAME, ARCHIVE_FILE_NAME
+from .precompress import precompress_dir
+from .retention import collect_expired_versions
+from .rewrite_maps import write_not_found_map, not_found_map_path
+from .static_server import StaticServer
+from .trash import TRASH_DIR, move_to_trash, reap_trash, trash_stats
+from . import cache
+
+
+@contextmanager
+def keeping_db_connection():
+    """ Keeps Django from closing the database connection that the test case runs in when a
+    request that isn't made through the test client starts or finishes, like the test client
+    does for its own requests """
+
+    request_started.disconnect(close_old_connections)
+    request_finished.disconnect(close_old_connections)
+    try:
+        yield
+    finally:
+        request_started.connect(close_old_connections)
+        request_finished.connect(close_old_connections)
 
 
 class DummyException(Exception):
@@ -29,3 +103,1265 @@ class TestAtomicTransactionGenericErrorHandling(TestCase):
 class EmptyQuery(TestCase):
     def test_empty_falsey(self):
         assert not StaticDeployment.objects.filter(name="__non-existant-name")
+
+
+class ParseRange(TestCase):
+    def test_ranges(self):
+        assert parse_range("bytes=0-9", 100) == (0, 9)
+        assert parse_range("bytes=90-", 100) == (90, 99)
+        assert parse_range("bytes=-10", 100) == (90, 99)
+        assert parse_range("bytes=50-500", 100) == (50, 99)
+
+    def test_ignored(self):
+        assert parse_range("bytes=0-1,5-6", 100) is None
+        assert parse_range("lines=0-1", 100) is None
+        assert parse_range("bytes=9-0", 100) is None
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range("bytes=100-", 100)
+
+
+class NotFoundDocument(TestCase):
+    """ Verify that custom 404 documents are streamed with validators and range support. """
+
+    def setUp(self):
+        self.host_dir = tempfile.TemporaryDirectory()
+        latest_dir = os.path.join(self.host_dir.name, TEST_SUBDOMAIN, "latest")
+        os.makedirs(latest_dir)
+        with open(os.path.join(latest_dir, "index.html"), "wb") as f:
+            f.write(b"0123456789")
+
+        StaticDeployment(
+            name="Test Deployment", subdomain=TEST_SUBDOMAIN, not_found_document="index.html"
+        ).save()
+
+    def tearDown(self):
+        self.host_dir.cleanup()
+
+    def request(self, **headers):
+        req = RequestFactory().get(
+            "/404/", REDIRECT_URL="/__HOSTED/{}/missing/route".format(TEST_SUBDOMAIN), **headers
+        )
+        with override_settings(HOST_PATH=self.host_dir.name):
+            return not_found(req)
+
+    def test_full_and_conditional(self):
+        res = self.request()
+        assert res.status_code == 200
+        assert b"".join(res.streaming_content) == b"0123456789"
+        with keeping_db_connection():
+            res.close()
+
+        res = self.request(HTTP_IF_NONE_MATCH=res["ETag"])
+        assert res.status_code == 304
+
+    def test_range(self):
+        res = self.request(HTTP_RANGE="bytes=2-4")
+        assert res.status_code == 206
+        assert res["Content-Range"] == "bytes 2-4/10"
+        assert b"".join(res.streaming_content) == b"234"
+
+
+class NotFoundMap(TestCase):
+    """ Verify that the web server's not found map only lists documents inside deployments """
+
+    def test_entries(self):
+        for (subdomain, document) in [
+            ("spa", "./index.html"),
+            ("nested", "errors/404.html"),
+            ("none", None),
+            ("escape", "../other/latest/index.html"),
+            ("absolute", "/etc/passwd"),
+            ("spaces", "not found.html"),
+        ]:
+            StaticDeployment.objects.create(
+                name=subdomain, subdomain=subdomain, not_found_document=document
+            )
+
+        with tempfile.TemporaryDirectory() as host_dir, override_settings(HOST_PATH=host_dir):
+            assert write_not_found_map() == 2
+            with open(not_found_map_path(), "r") as f:
+                entries = [line for line in f.read().splitlines() if not line.startswith("#")]
+
+        assert entries == ["nested errors/404.html", "spa index.html"]
+
+
+class StaticServing(TestCase):
+    """ Verify that the built-in static file server resolves deployments like Apache does """
+
+    def setUp(self):
+        self.host_dir = tempfile.TemporaryDirectory()
+        version_dir = os.path.join(self.host_dir.name, "spa", "1")
+        os.makedirs(os.path.join(version_dir, "docs"))
+        files = {"index.html": b"<html></html>", "app.js": b"0123456789", "docs/index.html": b""}
+        for (name, data) in files.items():
+            with open(os.path.join(version_dir, name), "wb") as f:
+                f.write(data)
+        with gzip.open(os.path.join(version_dir, "app.js.gz"), "wb") as f:
+            f.write(b"0123456789")
+        os.symlink(version_dir, os.path.join(self.host_dir.name, "spa", "latest"))
+
+        map_dir = os.path.join(self.host_dir.name, ".rewrite-maps")
+        os.makedirs(map_dir)
+        with open(os.path.join(map_dir, "not-found.txt"), "w") as f:
+            f.write("spa index.html\n")
+
+        self.app = StaticServer(host_path=self.host_dir.name, root_url="localhost")
+
+    def tearDown(self):
+        self.host_dir.cleanup()
+
+    def request(self, path: str, host="spa.localhost", **headers) -> tuple:
+        environ = {"PATH_INFO": path, "HTTP_HOST": host, **headers}
+        setup_testing_defaults(environ)
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = int(status.split()[0])
+            response["headers"] = dict(headers)
+
+        body = b"".join(self.app(environ, start_response))
+        return (response["status"], response["headers"], body)
+
+    def test_files(self):
+        assert self.request("/app.js")[2] == b"0123456789"
+        assert self.request("/v/1/app.js")[2] == b"0123456789"
+
+        (status, headers, body) = self.request("/app.js", HTTP_ACCEPT_ENCODING="gzip, br")
+        assert headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(body) == b"0123456789"
+
+        (status, headers, body) = self.request("/app.js", HTTP_RANGE="bytes=2-4")
+        assert (status, headers["Content-Range"], body) == (206, "bytes 2-4/10", b"234")
+        assert self.request("/app.js", HTTP_IF_NONE_MATCH=headers["ETag"])[0] == 304
+
+        (status, headers, body) = self.request("/docs")
+        assert (status, headers["Location"]) == (301, "/docs/")
+
+    def test_not_found(self):
+        assert self.request("/deep/link")[2] == b"<html></html>"
+        assert self.request("/v/1/deep/link")[0] == 404
+        assert self.request("/../spa/latest/app.js")[0] == 404
+        assert self.request("/app.js", host=".rewrite-maps.localhost")[0] == 404
+        assert self.request("/app.js", host="other.localhost")[0] == 404
+
+
+class DeploymentCacheLookups(TestCase):
+    def setUp(self):
+        self.deployment = StaticDeployment(name="Test Deployment", subdomain=TEST_SUBDOMAIN)
+        self.deployment.save()
+        DeploymentVersion(version="0.1.0", deployment=self.deployment, active=True).save()
+
+    def test_steady_state_queries(self):
+        cache.get_deployment("subdomain", TEST_SUBDOMAIN)
+        with self.assertNumQueries(0):
+            deployment = cache.get_deployment("subdomain", TEST_SUBDOMAIN)
+
+        assert deployment.active_version["version"] == "0.1.0"
+
+    def test_missing_deployments_cached(self):
+        with self.assertRaises(cache.NotFound):
+            cache.get_deployment("subdomain", "__missing")
+        with self.assertNumQueries(0):
+            with self.assertRaises(cache.NotFound):
+                cache.get_deployment("subdomain", "__missing")
+
+    def test_missing_deployments_kept_apart(self):
+        lookups = cache.DeploymentCache(max_size=1, max_missing_size=2)
+        lookups.get("subdomain", TEST_SUBDOMAIN)
+        for i in range(5):
+            with self.assertRaises(cache.NotFound):
+                lookups.get("subdomain", "__missing-{}".format(i))
+
+        with self.assertNumQueries(0):
+            assert lookups.get("subdomain", TEST_SUBDOMAIN).subdomain == TEST_SUBDOMAIN
+        stats = lookups.stats()
+        assert (stats["size"], stats["missing_size"], stats["evictions"]) == (1, 2, 0)
+
+    def test_invalidated_on_save(self):
+        cache.get_deployment("subdomain", TEST_SUBDOMAIN)
+        DeploymentVersion(version="0.2.0", deployment=self.deployment).save()
+
+        deployment = cache.get_deployment("subdomain", TEST_SUBDOMAIN)
+        assert [v["version"] for v in deployment.versions] == ["0.1.0", "0.2.0"]
+
+
+class ProjectionSerializer(TestCase):
+    """ Verify that the projection serializer produces the same output as Django's serializers """
+
+    @staticmethod
+    def reference_serialize(model) -> dict:
+        data = serializers.serialize("python", [model])[0]
+        return {"id": data["pk"], **data["fields"]}
+
+    def setUp(self):
+        deployment = StaticDeployment(name="Test Deployment", subdomain=TEST_SUBDOMAIN)
+        deployment.save()
+        for category in ["b", "a"]:
+            deployment.categories.add(DeploymentCategory.objects.create(category=category))
+        DeploymentVersion(version="0.1.0", deployment=deployment, active=True).save()
+        ProxyDeployment(name="Test Proxy", subdomain=TEST_SUBDOMAIN, destination_address="x").save()
+
+    def test_identical_output(self):
+        for Model in [StaticDeployment, DeploymentVersion, DeploymentCategory, ProxyDeployment]:
+            models = list(Model.objects.all())
+            expected = [self.reference_serialize(model) for model in models]
+
+            assert serialize(Model.objects.all(), json=False) == expected
+            assert serialize(models, json=False) == expected
+            assert list(serialize(models[0], json=False).items()) == list(expected[0].items())
+
+
+class DeploymentListPagination(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+        category = DeploymentCategory.objects.create(category="even")
+        for i in range(5):
+            deployment = StaticDeployment(name="Test {}".format(i), subdomain="test-{}".format(i))
+            deployment.save()
+            if i % 2 == 0:
+                deployment.categories.add(category)
+
+    def list_names(self, **params) -> list:
+        names = []
+        cursor = None
+        while True:
+            if cursor is not None:
+                params["cursor"] = cursor
+            res = self.client.get("/deployments/", params)
+            assert res.status_code == 200
+            names.extend(datum["name"] for datum in res.json())
+            cursor = res.get("X-Next-Cursor")
+            if cursor is None:
+                return names
+
+    def test_pages(self):
+        assert self.list_names(limit=2) == ["Test {}".format(i) for i in range(5)]
+        assert self.list_names() == ["Test {}".format(i) for i in range(5)]
+
+    def test_filters(self):
+        assert self.list_names(limit=1, category="even") == ["Test 0", "Test 2", "Test 4"]
+        assert self.list_names(name_prefix="Test 3") == ["Test 3"]
+        assert self.list_names(created_before="2000-01-01") == []
+
+    def test_sparse_fields(self):
+        res = self.client.get("/deployments/", {"fields": "name,active_version", "limit": 2})
+        assert res.json() == [
+            {"name": "Test 0", "active_version": None},
+            {"name": "Test 1", "active_version": None},
+        ]
+        assert res.get("X-Next-Cursor") is not None
+
+    def test_ndjson(self):
+        res = self.client.get("/deployments/", {"format": "ndjson", "fields": "name"})
+        lines = b"".join(res.streaming_content).decode("utf-8").splitlines()
+        assert lines == ['{{"name": "Test {}"}}'.format(i) for i in range(5)]
+
+    def test_invalid_params(self):
+        assert self.client.get("/deployments/", {"format": "xml"}).status_code == 400
+        assert self.client.get("/deployments/", {"fields": "password"}).status_code == 400
+        assert self.client.get("/deployments/", {"limit": 0}).status_code == 400
+        assert self.client.get("/deployments/", {"cursor": "garbage"}).status_code == 400
+
+
+class GenerationETags(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+
+    def test_not_modified(self):
+        res = self.client.get("/deployments/")
+        etag = res["ETag"]
+
+        res = self.client.get("/deployments/", HTTP_IF_NONE_MATCH=etag)
+        assert res.status_code == 304
+        assert res["ETag"] == etag
+
+        # Query strings are part of the ETag
+        assert self.client.get("/deployments/?limit=1", HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    def test_changes_bump_etag(self):
+        etag = self.client.get("/deployments/")["ETag"]
+        StaticDeployment(name="Test Deployment", subdomain=TEST_SUBDOMAIN).save()
+
+        res = self.client.get("/deployments/", HTTP_IF_NONE_MATCH=etag)
+        assert res.status_code == 200
+        assert res["ETag"] != etag
+
+
+def build_archive(files: dict, mode="w:gz") -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=mode) as t:
+        for (name, content) in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            t.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+class StreamingArchiveUpload(TestCase):
+    """ Verify that archives are extracted as their chunks are received """
+
+    def upload(self, data: bytes):
+        handler = StreamingArchiveUploadHandler()
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file("file", "directory.tgz", "application/octet-stream", len(data))
+
+        for start in range(0, len(data), 7):
+            assert handler.receive_data_chunk(data[start : start + 7], start) is None
+        return handler.file_complete(len(data))
+
+    def test_extracts_while_streaming(self):
+        files = {"index.html": b"<html></html>", "js/app.js": b"console.log(1);" * 100}
+        staged = self.upload(build_archive(files))
+        assert staged.error is None
+        assert staged.size > 0
+
+        for (name, content) in files.items():
+            with open(os.path.join(staged.staging_dir, name), "rb") as f:
+                assert f.read() == content
+
+        staging_dir = staged.staging_dir
+        staged.close()
+        wait_for_background_tasks()
+        assert not os.path.exists(staging_dir)
+
+    def test_invalid_archive(self):
+        staged = self.upload(b"this is not a tar archive" * 1000)
+        assert staged.error is not None
+        staged.close()
+
+    def multipart_request(self, body_length=None):
+        """ Builds a request uploading an archive whose body is cut off after `body_length`
+        bytes """
+
+        body = encode_multipart(
+            BOUNDARY,
+            {"file": SimpleUploadedFile("directory.tgz", build_archive({"a": os.urandom(9000)}))},
+        )
+        return RequestFactory().generic(
+            "POST",
+            "/deployments/",
+            data=body[:body_length],
+            content_type=MULTIPART_CONTENT,
+        )
+
+    def staging_dir_names(self) -> set:
+        wait_for_background_tasks()
+        return set(os.listdir(STAGING_DIR)) if os.path.exists(STAGING_DIR) else set()
+
+    def test_truncated_body(self):
+        existing_dirs = self.staging_dir_names()
+        req = self.multipart_request(5000)
+        install_streaming_upload_handler(req)
+        assert "file" not in req.FILES
+        assert self.staging_dir_names() == existing_dirs
+
+    def test_failed_read(self):
+        class FailingStream(io.BytesIO):
+            def read(self, size=-1):
+                if self.tell() > 5000:
+                    raise OSError("Connection reset")
+                return super(FailingStream, self).read(min(size, 1024))
+
+        existing_dirs = self.staging_dir_names()
+        req = self.multipart_request()
+        req._stream = FailingStream(req._stream.read())
+        with self.assertRaises(OSError):
+            install_streaming_upload_handler(req)
+        assert self.staging_dir_names() == existing_dirs
+
+    def test_other_fields_passed_through(self):
+        handler = StreamingArchiveUploadHandler()
+        handler.new_file("other", "other.txt", "text/plain", 3)
+        assert handler.receive_data_chunk(b"abc", 0) == b"abc"
+        assert handler.file_complete(3) is None
+
+
+class ParallelExtraction(TestCase):
+    """ Verify that the extraction engine writes out every member correctly """
+
+    def test_many_small_files(self):
+        files = {
+            "dir-{}/file-{}.txt".format(i % 7, i): str(i).encode("ascii") * (i % 50)
+            for i in range(1000)
+        }
+        archive = build_archive(files)
+
+        with tempfile.TemporaryDirectory() as dst_dir:
+            stats = extract_archive(io.BytesIO(archive), dst_dir, workers=4)
+            assert stats.file_count == len(files)
+            assert stats.dir_count == 7
+            assert stats.total_bytes == sum(len(content) for content in files.values())
+
+            for (name, content) in files.items():
+                with open(os.path.join(dst_dir, name), "rb") as f:
+                    assert f.read() == content
+
+    def test_duplicate_members(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as t:
+            for content in (b"first", b"second"):
+                info = tarfile.TarInfo("index.html")
+                info.size = len(content)
+                t.addfile(info, io.BytesIO(content))
+
+        with tempfile.TemporaryDirectory() as dst_dir:
+            extract_archive(io.BytesIO(buf.getvalue()), dst_dir, workers=4)
+            with open(os.path.join(dst_dir, "index.html"), "rb") as f:
+                assert f.read() == b"second"
+
+    def test_unsafe_members(self):
+        for name in ("../escaped.txt", "/etc/escaped.txt", "a/../../escaped.txt"):
+            with tempfile.TemporaryDirectory() as dst_dir:
+                with self.assertRaises(UnsafeArchiveMember):
+                    extract_archive(io.BytesIO(build_archive({name: b"x"})), dst_dir)
+
+    def test_writes_through_symlinks(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w") as t:
+            for (name, link_target) in (("a", "."), ("a/b", "../victim")):
+                info = tarfile.TarInfo(name)
+                (info.type, info.linkname) = (tarfile.SYMTYPE, link_target)
+                t.addfile(info)
+            info = tarfile.TarInfo("b/pwned.txt")
+            info.size = 1
+            t.addfile(info, io.BytesIO(b"x"))
+
+        with tempfile.TemporaryDirectory() as parent_dir:
+            dst_dir = os.path.join(parent_dir, "dst")
+            os.makedirs(dst_dir)
+            os.makedirs(os.path.join(parent_dir, "victim"))
+            with self.assertRaises(UnsafeArchiveMember):
+                extract_archive(io.BytesIO(buf.getvalue()), dst_dir)
+            assert os.listdir(os.path.join(parent_dir, "victim")) == []
+
+    def test_links_resolved_outside(self):
+        # Each link is fine on its own, but `c` escapes once `a` points at the root
+        for links in ((("c", "a/.."), ("a", ".")), (("a", "."), ("c", "a/.."))):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w") as t:
+                for (name, link_target) in links:
+                    info = tarfile.TarInfo(name)
+                    (info.type, info.linkname) = (tarfile.SYMTYPE, link_target)
+                    t.addfile(info)
+
+            with tempfile.TemporaryDirectory() as dst_dir:
+                with self.assertRaises(UnsafeArchiveMember):
+                    extract_archive(io.BytesIO(buf.getvalue()), dst_dir)
+
+
+@override_settings(DEDUPLICATE_DEPLOYMENTS=True)
+class DeduplicatedStorage(TestCase):
+    """ Verify that identical files are stored once and freed once no version references them """
+
+    def test_versions_share_blobs(self):
+        shared = os.urandom(32).hex().encode("ascii")
+        changed = [os.urandom(32).hex().encode("ascii") for _ in range(2)]
+        shared_digest = hashlib.sha256(shared).hexdigest()
+
+        for (version, content) in zip(["0.1.0", "0.2.0"], changed):
+            archive = build_archive({"vendor.js": shared, "index.html": content})
+            handle_uploaded_static_archive(
+                io.BytesIO(archive), TEST_SUBDOMAIN, version, init=version == "0.1.0"
+            )
+
+        paths = [os.path.join(HOST_DIR, TEST_SUBDOMAIN, v, "vendor.js") for v in ["0.1.0", "0.2.0"]]
+        assert os.stat(paths[0]).st_ino == os.stat(paths[1]).st_ino
+        assert os.stat(BLOB_STORE.path(shared_digest)).st_nlink == 3
+        assert load_manifest(TEST_SUBDOMAIN, "0.2.0")["vendor.js"] == {
+            "sha256": shared_digest,
+            "size": len(shared),
+        }
+
+        changed_digest = hashlib.sha256(changed[0]).hexdigest()
+        delete_hosted_version(TEST_SUBDOMAIN, "0.1.0")
+        reap_trash()
+        assert not os.path.exists(BLOB_STORE.path(changed_digest))
+        assert os.stat(BLOB_STORE.path(shared_digest)).st_nlink == 2
+        assert load_manifest(TEST_SUBDOMAIN, "0.1.0") is None
+
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+        reap_trash()
+        assert not os.path.exists(BLOB_STORE.path(shared_digest))
+
+
+def manifest_entry(content: bytes) -> dict:
+    return {"sha256": hashlib.sha256(content).hexdigest(), "size": len(content)}
+
+
+class DeltaUploads(TestCase):
+    """ Verify that versions are built from the previous version plus the uploaded delta """
+
+    def setUp(self):
+        self.files = {"index.html": b"<html></html>", "css/app.css": b"body {}", "old.js": b"1"}
+        handle_uploaded_static_archive(io.BytesIO(build_archive(self.files)), TEST_SUBDOMAIN, "1")
+
+    def tearDown(self):
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def test_apply_delta(self):
+        new_files = {"index.html": b"<html>new</html>", "css/app.css": b"body {}", "a.js": b"1"}
+        files = {path: manifest_entry(content) for (path, content) in new_files.items()}
+
+        missing = find_missing(TEST_SUBDOMAIN, "1", files)
+        assert missing == [files["index.html"]["sha256"]]
+
+        delta_archive = build_archive({"index.html": new_files["index.html"]})
+        version_dir = handle_uploaded_static_archive(
+            io.BytesIO(delta_archive), TEST_SUBDOMAIN, "2", init=False, delta=Delta("1", files)
+        )
+
+        for (path, content) in new_files.items():
+            with open(os.path.join(version_dir, path), "rb") as f:
+                assert f.read() == content
+        assert not os.path.exists(os.path.join(version_dir, "old.js"))
+        assert load_manifest(TEST_SUBDOMAIN, "2") == files
+
+    def test_missing_file(self):
+        delta = Delta("1", {"index.html": manifest_entry(b"never uploaded")})
+        with self.assertRaises(BadInputException):
+            handle_uploaded_static_archive(
+                io.BytesIO(build_archive({})), TEST_SUBDOMAIN, "2", init=False, delta=delta
+            )
+        assert not os.path.exists(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "2"))
+
+    def test_wrong_sizes(self):
+        for (path, content) in [("css/app.css", self.files["css/app.css"]), ("a.js", b"new")]:
+            files = {path: dict(manifest_entry(content), size=10 ** 12)}
+            with self.assertRaises(BadInputException):
+                handle_uploaded_static_archive(
+                    io.BytesIO(build_archive({"a.js": b"new"})),
+                    TEST_SUBDOMAIN,
+                    "2",
+                    init=False,
+                    delta=Delta("1", files),
+                )
+            assert not os.path.exists(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "2"))
+
+    def test_invalid_manifest(self):
+        for raw in ["nope", '{"files": []}', '{"files": {"../x": {"sha256": "", "size": 1}}}']:
+            with self.assertRaises(BadInputException):
+                parse_manifest(raw)
+
+        entry = manifest_entry(b"x")
+        with self.assertRaises(BadInputException):
+            parse_manifest('{"files": {"../x": {"sha256": "%s", "size": 1}}}' % entry["sha256"])
+
+
+class ChunkedRequests(TestCase):
+    """ Verify that the bodies of chunked requests, which have no `Content-Length`, are read """
+
+    def request(self, method: str, path: str, body: bytes, **environ):
+        from server.wsgi import application
+
+        environ = {
+            **RequestFactory()._base_environ(),  # pylint: disable=W0212
+            "REQUEST_METHOD": method,
+            "PATH_INFO": path,
+            "HTTP_TRANSFER_ENCODING": "chunked",
+            "wsgi.input": io.BytesIO(body),
+            **environ,
+        }
+
+        statuses = []
+        with keeping_db_connection():
+            response = application(environ, lambda status, _headers: statuses.append(status))
+            content = b"".join(response)
+            response.close()
+        return (statuses[0], content)
+
+    def test_chunked_multipart_body(self):
+        body = (
+            '--x\r\nContent-Disposition: form-data; name="username"\r\n\r\nnobody\r\n'
+            '--x\r\nContent-Disposition: form-data; name="password"\r\n\r\nwrong\r\n'
+            "--x--\r\n"
+        ).encode("utf-8")
+        (status, content) = self.request(
+            "POST", "/login/", body, CONTENT_TYPE="multipart/form-data; boundary=x"
+        )
+        # The credentials were parsed out of the body and rejected rather than found missing
+        assert status == "403 Forbidden"
+        assert b"Invalid username or password" in content
+
+    def test_chunked_body(self):
+        from server.wsgi import ChunkedWSGIRequest
+
+        environ = {
+            **RequestFactory()._base_environ(),  # pylint: disable=W0212
+            "REQUEST_METHOD": "PATCH",
+            "HTTP_TRANSFER_ENCODING": "chunked",
+            "wsgi.input": io.BytesIO(b"x" * 100),
+        }
+        assert ChunkedWSGIRequest(environ).body == b"x" * 100
+
+        environ["wsgi.input"] = io.BytesIO(b"x" * 100)
+        with override_settings(DATA_UPLOAD_MAX_MEMORY_SIZE=10):
+            with self.assertRaises(RequestDataTooBig):
+                ChunkedWSGIRequest(environ).body  # pylint: disable=W0106
+
+    def test_chunked_upload_chunk(self):
+        # Chunks of resumable uploads need their length up front, so they can't be sent chunked
+        self.client.force_login(User.objects.create_user("test-user"))
+        session = UploadSession.create(10)
+        try:
+            (status, content) = self.request(
+                "PUT",
+                "/uploads/{}/0/".format(session.id),
+                b"x" * 10,
+                QUERY_STRING="offset=0",
+                HTTP_X_CONTENT_SHA256=hashlib.sha256(b"x" * 10).hexdigest(),
+                HTTP_COOKIE="sessionid={}".format(self.client.cookies["sessionid"].value),
+            )
+        finally:
+            session.delete()
+        assert status == "400 Bad Request"
+        assert b"Content-Length" in content
+
+
+class ResumableUploadSessions(TestCase):
+    """ Verify that archives can be uploaded in chunks, in any order, and then deployed """
+
+    def setUp(self):
+        self.archive = build_archive({"index.html": b"<html></html>", "app.js": b"1" * 5000})
+        self.session = UploadSession.create(len(self.archive))
+
+    def tearDown(self):
+        self.session.delete()
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def write_chunk(self, index: int, offset: int, data: bytes, checksum=None):
+        checksum = checksum or hashlib.sha256(data).hexdigest()
+        self.session.write_chunk(index, offset, len(data), checksum, io.BytesIO(data))
+
+    def test_upload_chunks(self):
+        split = len(self.archive) // 2
+        self.write_chunk(1, split, self.archive[split:])
+        with self.assertRaises(BadInputException):
+            self.session.finalize()
+
+        with self.assertRaises(BadInputException):
+            self.write_chunk(0, 0, self.archive[:split], checksum="0" * 64)
+        assert self.session.status()["received"] == [[split, len(self.archive)]]
+
+        self.write_chunk(0, 0, self.archive[:split])
+        assert self.session.finalize()["received"] == [[0, len(self.archive)]]
+
+        with self.session.open_archive() as archive:
+            version_dir = handle_uploaded_static_archive(archive, TEST_SUBDOMAIN, "1")
+        with open(os.path.join(version_dir, "index.html"), "rb") as f:
+            assert f.read() == b"<html></html>"
+
+    def test_expired_session(self):
+        with override_settings(UPLOAD_SESSION_TTL=-1):
+            with self.assertRaises(NotFound):
+                UploadSession.get(self.session.id)
+        assert not os.path.exists(self.session.dir)
+
+
+class StagedVersions(TestCase):
+    """ Verify that staged versions are moved into place and that failed ones are cleaned up """
+
+    def tearDown(self):
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def test_failed_extraction(self):
+        staging_dirs = set(os.listdir(STAGING_DIR))
+        with self.assertRaises(tarfile.TarError):
+            stage_uploaded_archive(io.BytesIO(b"not an archive" * 100), TEST_SUBDOMAIN)
+
+        wait_for_background_tasks()
+        assert set(os.listdir(STAGING_DIR)) == staging_dirs
+
+    def test_discard_installed_version(self):
+        staged = stage_uploaded_archive(io.BytesIO(build_archive({"a.txt": b"a"})), TEST_SUBDOMAIN)
+        version_dir = staged.install(TEST_SUBDOMAIN, "1")
+        with open(os.path.join(version_dir, "a.txt"), "rb") as f:
+            assert f.read() == b"a"
+
+        staged.discard()
+        wait_for_background_tasks()
+        assert not os.path.exists(version_dir)
+        assert not os.path.exists(staged.staging_dir)
+
+    def test_sweep_stale_staging_dirs(self):
+        (stale_dir, fresh_dir) = (create_staging_dir(), create_staging_dir())
+        os.utime(stale_dir, (0, 0))
+
+        sweep_staging_dirs(max_age=60)
+        assert not os.path.exists(stale_dir)
+        assert os.path.exists(fresh_dir)
+        os.rmdir(fresh_dir)
+
+
+class VersionCreation(TestCase):
+    """ Verify that new versions never replace existing ones and that failed ones are rolled
+    back """
+
+    def setUp(self):
+        self.deployment = StaticDeployment.objects.create(name="test", subdomain=TEST_SUBDOMAIN)
+        for (version, content) in (("1.0.1", b"old"), ("1.0.0", b"active")):
+            DeploymentVersion.objects.create(deployment=self.deployment, version=version)
+            handle_uploaded_static_archive(
+                io.BytesIO(build_archive({"v": content})), TEST_SUBDOMAIN, version, init=False
+            )
+        DeploymentVersion.objects.filter(version="1.0.0").update(active=True)
+        update_symlink(TEST_SUBDOMAIN, "1.0.0")
+
+    def tearDown(self):
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def stage(self) -> StagedVersion:
+        return stage_uploaded_archive(io.BytesIO(build_archive({"v": b"new"})), TEST_SUBDOMAIN)
+
+    def read_version(self, version: str) -> bytes:
+        with open(os.path.join(HOST_DIR, TEST_SUBDOMAIN, version, "v"), "rb") as f:
+            return f.read()
+
+    def test_bump_to_existing_version(self):
+        with self.assertRaises(BadInputException):
+            create_version(self.stage(), self.deployment, "patch")
+
+        assert DeploymentVersion.objects.filter(version="1.0.1").count() == 1
+        assert self.read_version("1.0.1") == b"old"
+        assert self.read_version("latest") == b"active"
+
+    def test_upload_existing_version(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+        with mock.patch("serversite.views.install_streaming_upload_handler") as install_handler:
+            res = self.client.post(
+                "/deployments/{}/1.0.1/?lookupField=subdomain".format(TEST_SUBDOMAIN),
+                {"file": SimpleUploadedFile("directory.tgz", build_archive({"v": b"new"}))},
+            )
+
+        assert res.status_code == 400
+        # The upload is rejected before any of it is extracted
+        install_handler.assert_not_called()
+        assert self.read_version("1.0.1") == b"old"
+
+    def test_failed_commit(self):
+        # Fails after `latest` has been updated, like a failed commit would
+        def update_then_fail(subdomain, version):
+            update_symlink(subdomain, version)
+            raise DummyException()
+
+        with mock.patch("serversite.deploy.update_symlink", update_then_fail):
+            with self.assertRaises(DummyException):
+                create_version(self.stage(), self.deployment, "2.0.0")
+
+        assert self.read_version("latest") == b"active"
+        assert not DeploymentVersion.objects.filter(version="2.0.0").exists()
+        assert not os.path.exists(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "2.0.0"))
+
+
+class VersionActivation(TestCase):
+    """ Verify that switching the active version repoints `latest` without re-uploading """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+        deployment = StaticDeployment.objects.create(name="test", subdomain=TEST_SUBDOMAIN)
+        DeploymentVersion.objects.create(deployment=deployment, version="1", active=False)
+        DeploymentVersion.objects.create(deployment=deployment, version="2", active=True)
+
+        handle_uploaded_static_archive(io.BytesIO(build_archive({"v": b"1"})), TEST_SUBDOMAIN, "1")
+        handle_uploaded_static_archive(
+            io.BytesIO(build_archive({"v": b"2"})), TEST_SUBDOMAIN, "2", init=False
+        )
+        update_symlink(TEST_SUBDOMAIN, "2")
+
+    def tearDown(self):
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def activate(self, version: str):
+        return self.client.post(
+            "/deployments/{}/{}/activate/?lookupField=subdomain".format(TEST_SUBDOMAIN, version)
+        )
+
+    def test_activate(self):
+        assert self.activate("1").status_code == 200
+        assert DeploymentVersion.objects.get(active=True).version == "1"
+        with open(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "latest", "v"), "rb") as f:
+            assert f.read() == b"1"
+        # No temporary links are left behind
+        assert sorted(os.listdir(os.path.join(HOST_DIR, TEST_SUBDOMAIN))) == ["1", "2", "latest"]
+
+    def test_missing_version(self):
+        assert self.activate("3").status_code == 404
+        assert DeploymentVersion.objects.get(active=True).version == "2"
+
+    def test_version_case(self):
+        deployment = StaticDeployment.objects.get(subdomain=TEST_SUBDOMAIN)
+        DeploymentVersion.objects.create(deployment=deployment, version="RC")
+        handle_uploaded_static_archive(
+            io.BytesIO(build_archive({"v": b"rc"})), TEST_SUBDOMAIN, "rc", init=False
+        )
+
+        assert self.activate("RC").json()["version"] == "rc"
+        with open(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "latest", "v"), "rb") as f:
+            assert f.read() == b"rc"
+
+
+JOB_TEST_SUBDOMAIN = "test-job-subdomain"
+
+
+@override_settings(DEPLOY_JOB_WORKERS=0)
+class DeployJobs(TestCase):
+    """ Verify that asynchronous uploads are deployed by jobs that report their progress """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+
+    def tearDown(self):
+        delete_hosted_deployment(JOB_TEST_SUBDOMAIN)
+
+    def create(self, archive: bytes):
+        return self.client.post(
+            "/deployments/",
+            {
+                "name": "test",
+                "subdomain": JOB_TEST_SUBDOMAIN,
+                "version": "1",
+                "categories": "",
+                "file": SimpleUploadedFile("directory.tgz", archive),
+            },
+            HTTP_PREFER="respond-async",
+        )
+
+    def test_job_deploys_archive(self):
+        res = self.create(build_archive({"app.js": b"console.log(1);\n" * 100}))
+        assert res.status_code == 202, res.content
+        job_id = res.json()["id"]
+        assert res.json()["state"] == "pending"
+        assert not StaticDeployment.objects.exists()
+
+        assert run_pending_jobs() == 1
+        job = self.client.get("/jobs/{}/".format(job_id)).json()
+        assert job["state"] == "succeeded"
+        assert job["result"]["subdomain"] == JOB_TEST_SUBDOMAIN
+        assert job["file_count"] == 1
+        assert job["precompressed_count"] == 1
+        assert set(job["timings"]) >= {"queued", "extracting", "precompressing", "total"}
+
+        latest_dir = os.path.join(HOST_DIR, JOB_TEST_SUBDOMAIN, "latest")
+        with gzip.open(os.path.join(latest_dir, "app.js.gz"), "rb") as f:
+            assert f.read() == b"console.log(1);\n" * 100
+
+    def test_failed_job(self):
+        res = self.create(build_archive({"index.html": b"<html></html>"}))
+        StaticDeployment.objects.create(name="other", subdomain=JOB_TEST_SUBDOMAIN)
+
+        run_pending_jobs()
+        job = self.client.get("/jobs/{}/".format(res.json()["id"])).json()
+        assert job["state"] == "failed"
+        assert job["error"]
+        assert not os.path.exists(os.path.join(HOST_DIR, JOB_TEST_SUBDOMAIN, "1"))
+
+    def test_deleted_deployment(self):
+        self.create(build_archive({"index.html": b"<html></html>"}))
+        run_pending_jobs()
+        deployment = StaticDeployment.objects.get(subdomain=JOB_TEST_SUBDOMAIN)
+
+        wait_for_background_tasks()
+        staging_dirs = set(os.listdir(STAGING_DIR))
+        res = self.client.post(
+            "/deployments/{}/2/".format(deployment.id),
+            {"file": SimpleUploadedFile("directory.tgz", build_archive({"a.html": b"a"}))},
+            HTTP_PREFER="respond-async",
+        )
+        assert res.status_code == 202, res.content
+        StaticDeployment.objects.filter(id=deployment.id).delete()
+
+        run_pending_jobs()
+        job = self.client.get("/jobs/{}/".format(res.json()["id"])).json()
+        assert job["state"] == "failed"
+        wait_for_background_tasks()
+        assert set(os.listdir(STAGING_DIR)) == staging_dirs
+
+    def test_interrupted_job(self):
+        # The job is marked as failed while it's activating, as if it had taken too long
+        def interrupt_then_create(*args):
+            DeployJob.objects.update(state=DeployJob.FAILED, error="The job was interrupted")
+            return create_deployment(*args)
+
+        res = self.create(build_archive({"index.html": b"<html></html>"}))
+        with mock.patch("serversite.jobs.create_deployment", interrupt_then_create):
+            run_pending_jobs()
+
+        job = self.client.get("/jobs/{}/".format(res.json()["id"])).json()
+        assert job["state"] == "failed"
+        assert job["error"] == "The job was interrupted"
+
+
+class Precompression(TestCase):
+    def test_only_compressible_files(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            for (name, content) in [
+                ("app.js", b"let x = 1;\n" * 200),
+                ("small.css", b"a{}"),
+                ("image.png", b"\x89PNG" * 1000),
+                ("random.json", os.urandom(4096)),
+            ]:
+                with open(os.path.join(dir_path, name), "wb") as f:
+                    f.write(content)
+
+            assert precompress_dir(dir_path, workers=2) == 1
+            assert sorted(os.listdir(dir_path)) == [
+                "app.js",
+                "app.js.gz",
+                "image.png",
+                "random.json",
+                "small.css",
+            ]
+
+
+class Trash(TestCase):
+    """ Verify that trashed trees are reported until they're reaped """
+
+    def test_reap(self):
+        reap_trash(rate=0)
+        tree_dir = tempfile.mkdtemp(dir=HOST_DIR)
+        os.makedirs(os.path.join(tree_dir, "a", "b"))
+        for name in ["x", "a/y", "a/b/z"]:
+            with open(os.path.join(tree_dir, name), "wb") as f:
+                f.write(b"12345")
+        os.symlink(os.path.join(tree_dir, "a"), os.path.join(tree_dir, "link"))
+
+        # Hold the reaper off while the backlog is checked
+        with open(os.path.join(TRASH_DIR, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            assert move_to_trash(tree_dir)
+            assert not os.path.exists(tree_dir)
+            assert trash_stats()["unmeasured_entry_count"] == 1
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        reap_trash(rate=0)
+        assert trash_stats() == {
+            "entry_count": 0,
+            "unmeasured_entry_count": 0,
+            "bytes": 0,
+            "inodes": 0,
+        }
+        assert not move_to_trash(tree_dir)
+
+
+class VersionRetention(TestCase):
+    """ Verify that retention policies expire old versions but never the active one """
+
+    def setUp(self):
+        self.deployment = StaticDeployment.objects.create(name="test", subdomain=TEST_SUBDOMAIN)
+        now = timezone.now()
+        for (i, version) in enumerate(["1", "2", "3", "4"]):
+            version_model = DeploymentVersion.objects.create(
+                deployment=self.deployment, version=version, active=version == "1"
+            )
+            # Version 1 is 40 days old, version 4 is 10 days old
+            DeploymentVersion.objects.filter(pk=version_model.pk).update(
+                created_on=now - timedelta(days=40 - i * 10)
+            )
+            handle_uploaded_static_archive(
+                io.BytesIO(build_archive({"v": version.encode("ascii")})),
+                TEST_SUBDOMAIN,
+                version,
+                init=version == "1",
+            )
+
+    def tearDown(self):
+        delete_hosted_deployment(TEST_SUBDOMAIN)
+
+    def expired(self) -> list:
+        return [entry["version"] for entry in collect_expired_versions(dry_run=True)]
+
+    def test_policies(self):
+        assert self.expired() == []
+
+        with override_settings(VERSION_RETENTION_COUNT=1):
+            assert self.expired() == ["3", "2"]
+        with override_settings(VERSION_RETENTION_DAYS=25):
+            assert self.expired() == ["2"]
+        with override_settings(VERSION_RETENTION_COUNT=1, VERSION_RETENTION_DAYS=25):
+            assert self.expired() == ["2"]
+
+        # Deployments override the global policy, and 0 disables a rule
+        self.deployment.retain_versions = 0
+        self.deployment.save()
+        with override_settings(VERSION_RETENTION_COUNT=1):
+            assert self.expired() == []
+
+    def test_collect(self):
+        self.deployment.retain_versions = 2
+        self.deployment.save()
+
+        report = collect_expired_versions()
+        assert [entry["version"] for entry in report] == ["2"]
+        assert report[0]["bytes"] == 1
+        assert sorted(DeploymentVersion.objects.values_list("version", flat=True)) == [
+            "1",
+            "3",
+            "4",
+        ]
+        assert not os.path.exists(os.path.join(HOST_DIR, TEST_SUBDOMAIN, "2"))
+        assert collect_expired_versions() == []
+
+    def test_set_policy(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+        url = "/deployments/{}/?lookupField=subdomain".format(TEST_SUBDOMAIN)
+
+        res = self.client.patch(url, {"retain_versions": 3}, content_type="application/json")
+        assert res.json()["retain_versions"] == 3
+        assert res.json()["retain_days"] is None
+
+        res = self.client.patch(url, {"retain_days": -1}, content_type="application/json")
+        assert res.status_code == 400
+        res = self.client.patch(url, {"name": "other"}, content_type="application/json")
+        assert res.status_code == 400
+
+
+class VersionUsage(TestCase):
+    """ Verify that the file counts and sizes of deployed versions are recorded and summed up """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+
+    def tearDown(self):
+        delete_hosted_deployment(JOB_TEST_SUBDOMAIN)
+
+    def test_usage(self):
+        res = self.client.post(
+            "/deployments/",
+            {
+                "name": "test",
+                "subdomain": JOB_TEST_SUBDOMAIN,
+                "version": "1",
+                "categories": "",
+                "file": SimpleUploadedFile(
+                    "directory.tgz", build_archive({"a.txt": b"a" * 10, "b/c.txt": b"c" * 5})
+                ),
+            },
+        )
+        assert res.status_code == 200, res.content
+
+        version = DeploymentVersion.objects.get(deployment__subdomain=JOB_TEST_SUBDOMAIN)
+        assert (version.file_count, version.total_bytes) == (2, 15)
+
+        # Versions deployed before sizes were recorded don't count towards the total
+        DeploymentVersion.objects.create(deployment=version.deployment, version="0")
+        res = self.client.get("/deployments/", {"fields": "name,total_bytes"})
+        assert res.json() == [{"name": "test", "total_bytes": 15}]
+        res = self.client.get("/deployments/", {"fields": "versions,total_bytes"})
+        assert res.json()[0]["total_bytes"] == 15
+
+
+class Metrics(TestCase):
+    """ Verify that metrics are labelled by view and summed up across server processes """
+
+    def setUp(self):
+        self.host_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(HOST_PATH=self.host_dir.name)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.host_dir.cleanup()
+
+    def test_requests_and_exited_processes(self):
+        self.client.get("/capabilities/")
+        self.client.force_login(User.objects.create_user("test-user"))
+
+        # A snapshot left behind by a process that has exited
+        metrics_dir = os.path.join(self.host_dir.name, METRICS_DIR_NAME)
+        os.makedirs(metrics_dir)
+        snapshot = {
+            "counters": [["phost_proxy_reloads_total", [["trigger", "create"]], 2]],
+            "histograms": [],
+        }
+        with open(os.path.join(metrics_dir, "99999999-exited.json"), "w") as f:
+            json.dump(snapshot, f)
+
+        body = self.client.get("/metrics/").content.decode("utf-8")
+        assert 'phost_http_requests_total{method="GET",status="200",view="Capabilities"}' in body
+        assert 'phost_http_request_db_queries_count{view="Capabilities"}' in body
+        assert 'phost_proxy_reloads_total{trigger="create"} 2' in body
+        assert os.listdir(metrics_dir).count(ARCHIVE_FILE_NAME) == 1
+        assert not os.path.exists(os.path.join(metrics_dir, "99999999-exited.json"))
+
+        # Folded snapshots are still counted by later scrapes
+        body = self.client.get("/metrics/").content.decode("utf-8")
+        assert 'phost_proxy_reloads_total{trigger="create"} 2' in body
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        assert self.client.get("/metrics/").status_code == 403
+        res = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer secret")
+        assert res.status_code == 200
+
+    @override_settings(METRICS_TOKEN="")
+    def test_unauthenticated(self):
+        assert self.client.get("/metrics/").status_code == 403
+        assert self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer ").status_code == 403
+
+
+@override_settings(PROFILE_DIR_SIZE=64 * 1024 * 1024)
+class RequestProfiling(TestCase):
+    """ Verify that logged-in users can profile requests and download the profiles """
+
+    def setUp(self):
+        self.host_dir = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(HOST_PATH=self.host_dir.name)
+        self.settings_override.enable()
+        self.client.force_login(User.objects.create_user("test-user"))
+
+    def tearDown(self):
+        delete_hosted_deployment(JOB_TEST_SUBDOMAIN)
+        self.settings_override.disable()
+        self.host_dir.cleanup()
+
+    def test_profile_deploy(self):
+        res = self.client.post(
+            "/deployments/?profile=1",
+            {
+                "name": "test",
+                "subdomain": JOB_TEST_SUBDOMAIN,
+                "version": "1",
+                "categories": "",
+                "file": SimpleUploadedFile("directory.tgz", build_archive({"a.txt": b"a"})),
+            },
+        )
+        assert res.status_code == 200, res.content
+        profile_id = res["X-Phost-Profile-Id"]
+
+        [profile] = self.client.get("/profiles/").json()
+        assert profile["id"] == profile_id
+        span_names = {span["name"] for span in profile["spans"]}
+        assert span_names >= {"get_validated_form", "transaction.atomic", "update_symlink"}
+
+        res = self.client.get("/profiles/{}/".format(profile_id), {"format": "text"})
+        assert b"function calls" in res.content
+        res = self.client.get("/profiles/{}/".format(profile_id))
+        assert b"".join(res.streaming_content)
+        assert self.client.get("/profiles/../").status_code == 404
+
+    def test_opt_in(self):
+        assert "X-Phost-Profile-Id" not in self.client.get("/capabilities/")
+        assert "X-Phost-Profile-Id" in self.client.get("/capabilities/", HTTP_X_PHOST_PROFILE="1")
+
+        self.client.logout()
+        assert "X-Phost-Profile-Id" not in self.client.get("/capabilities/?profile=1")
+
+    def test_size_limit(self):
+        with override_settings(PROFILE_DIR_SIZE=1):
+            for _ in range(3):
+                latest_id = self.client.get("/capabilities/?profile=1")["X-Phost-Profile-Id"]
+
+        assert [profile["id"] for profile in self.client.get("/profiles/").json()] == [latest_id]
+
+
+# Queries taken to load the session and user of requests made by logged-in users
+AUTH_QUERIES = 2
+
+
+class QueryBudgets(TestCase):
+    """ Verify that the number of queries run by each endpoint doesn't grow with the number of
+    deployments """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_user("test-user"))
+        self.category = DeploymentCategory.objects.create(category="existing")
+
+    def tearDown(self):
+        delete_hosted_deployment(JOB_TEST_SUBDOMAIN)
+
+    def add_deployments(self, count: int):
+        """ Bulk creates deployments, each with an inactive and an active version and a category,
+        until there are `count` of them """
+
+        existing = StaticDeployment.objects.count()
+        deployments = StaticDeployment.objects.bulk_create(
+            [
+                StaticDeployment(name="Test {}".format(i), subdomain="test-{}".format(i))
+                for i in range(existing, count)
+            ]
+        )
+        DeploymentVersion.objects.bulk_create(
+            [
+                DeploymentVersion(deployment=deployment, version=version, active=version == "2")
+                for deployment in deployments
+                for version in ["1", "2"]
+            ]
+        )
+        StaticDeployment.categories.through.objects.bulk_create(
+            [
+                StaticDeployment.categories.through(
+                    staticdeployment=deployment, deploymentcategory=self.category
+                )
+                for deployment in deployments
+            ]
+        )
+
+    def check_budgets(self):
+        deployment_count = StaticDeployment.objects.count()
+        # The deployments, their category IDs, their versions and the categories themselves
+        with self.assertNumQueries(AUTH_QUERIES + 4):
+            res = self.client.get("/deployments/")
+        assert len(res.json()) == deployment_count
+        with self.assertNumQueries(AUTH_QUERIES + 3):
+            res = self.client.get("/deployments/", {"fields": "active_version,total_bytes"})
+        assert {(datum["active_version"], datum["total_bytes"]) for datum in res.json()} == {
+            ("2", 0)
+        }
+        with self.assertNumQueries(AUTH_QUERIES + 4):
+            res = self.client.get("/deployments/", {"limit": 100})
+        assert len(res.json()) == min(deployment_count, 100)
+
+        # The deployment joined onto its versions and its categories, then nothing once cached
+        cache.invalidate()
+        url = "/deployments/{}/".format(StaticDeployment.objects.first().id)
+        with self.assertNumQueries(2):
+            assert self.client.get(url).json()["versions"] == ["1", "2"]
+        with self.assertNumQueries(0):
+            assert self.client.get(url).status_code == 200
+
+        # The uniqueness check, a savepoint, the deployment, four for the categories, the version
+        # and releasing the savepoint
+        with self.assertNumQueries(AUTH_QUERIES + 9):
+            res = self.client.post(
+                "/deployments/",
+                {
+                    "name": "test",
+                    "subdomain": JOB_TEST_SUBDOMAIN,
+                    "version": "1.0.0",
+                    "categories": "existing,new,other",
+                    "file": SimpleUploadedFile("directory.tgz", build_archive({"a": b"a"})),
+                },
+            )
+        assert res.status_code == 200, res.content
+        deployment = StaticDeployment.objects.get(subdomain=JOB_TEST_SUBDOMAIN)
+        assert deployment.categories.count() == 3
+
+        url = "/deployments/{}/".format(JOB_TEST_SUBDOMAIN)
+        lookup = "?lookupField=subdomain"
+        # Locking the deployment, looking up the active version to bump (which other versions
+        # skip), checking that the new version is unique, deactivating the old one and inserting
+        # the new one, plus the deployment itself and a savepoint
+        with self.assertNumQueries(AUTH_QUERIES + 8):
+            res = self.client.post(
+                url + "patch/" + lookup,
+                {"file": SimpleUploadedFile("directory.tgz", build_archive({"a": b"b"}))},
+            )
+        assert res.json()["version"] == "1.0.1"
+        with self.assertNumQueries(AUTH_QUERIES + 5):
+            assert self.client.post(url + "1.0.0/activate/" + lookup).status_code == 200
+        assert [version.active for version in deployment.deploymentversion_set.all()] == [
+            True,
+            False,
+        ]
+        with self.assertNumQueries(AUTH_QUERIES + 6):
+            assert self.client.delete(url + "1.0.1/" + lookup).status_code == 200
+        with self.assertNumQueries(AUTH_QUERIES + 7):
+            assert self.client.delete(url + lookup).status_code == 200
+        assert StaticDeployment.objects.count() == deployment_count
+
+    def test_budgets(self):
+        for deployment_count in [1, 100, 10000]:
+            self.add_deployments(deployment_count)
+            with self.subTest(deployments=deployment_count):
+                self.check_budgets()
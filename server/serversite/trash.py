@@ -0,0 +1,264 @@
+"""
+Deleted versions and deployments are moved into `HOST_PATH/.trash/` with a single rename, which is
+instant no matter how many files they contain, and their files are then deleted by a background
+reaper thread at a limited rate (`settings.TRASH_REAP_RATE`) so that large deletions don't starve
+the disk.  Blobs that were only referenced by trashed trees are released once the trees are gone.
+
+Each trash entry is a directory containing the trashed `tree`, the `digests.json` of the blobs to
+release and, once the reaper has measured it, the `usage.json` of the space it still takes up.
+Entries are assembled under a temporary name and renamed into place, so the reaper never sees a
+partial entry.  A lock file makes sure that only one server process reaps at a time.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+
+from .blobs import BLOB_STORE
+
+
+TRASH_DIR = os.path.join(settings.HOST_PATH, ".trash")
+
+# Suffix of trash entries that are still being assembled
+PENDING_ENTRY_SUFFIX = ".pending"
+
+# Number of files deleted between checks of the reap rate and updates of the remaining usage
+REAP_BATCH_SIZE = 256
+
+# Number of seconds that the reaper waits between checks for entries trashed by other processes
+REAPER_POLL_INTERVAL = 60.0
+
+REAPER_LOCK = threading.Lock()
+REAPER = None
+REAPER_WAKEUP = threading.Event()
+
+
+def write_json(path: str, data):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def move_to_trash(path: str, digests=None) -> bool:
+    """ Moves the directory at `path` into the trash to be deleted in the background, releasing
+    the blobs with the given `digests` once it's gone.  Returns `False` if `path` doesn't exist. """
+
+    if not os.path.lexists(path):
+        return False
+
+    entry_id = uuid.uuid4().hex
+    pending_entry_dir = os.path.join(TRASH_DIR, entry_id + PENDING_ENTRY_SUFFIX)
+    os.makedirs(pending_entry_dir)
+    write_json(os.path.join(pending_entry_dir, "digests.json"), sorted(digests or []))
+    try:
+        os.rename(path, os.path.join(pending_entry_dir, "tree"))
+    except FileNotFoundError:
+        # Deleted concurrently
+        os.unlink(os.path.join(pending_entry_dir, "digests.json"))
+        os.rmdir(pending_entry_dir)
+        return False
+
+    os.rename(pending_entry_dir, os.path.join(TRASH_DIR, entry_id))
+    wake_reaper()
+    return True
+
+
+def list_trash_entries() -> list:
+    """ Returns the paths of all complete trash entries, oldest first """
+
+    try:
+        entries = [entry for entry in os.scandir(TRASH_DIR) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+    def trashed_on(entry) -> float:
+        try:
+            return entry.stat().st_mtime
+        except FileNotFoundError:
+            return 0
+
+    entries = [entry for entry in entries if not entry.name.endswith(PENDING_ENTRY_SUFFIX)]
+    entries.sort(key=trashed_on)
+    return [entry.path for entry in entries]
+
+
+def measure_tree(path: str) -> dict:
+    """ Returns the number of bytes in regular files and the number of inodes under `path` """
+
+    usage = {"bytes": 0, "inodes": 1}
+    for (parent_dir, dir_names, file_names) in os.walk(path):
+        usage["inodes"] += len(dir_names) + len(file_names)
+        for file_name in file_names:
+            try:
+                usage["bytes"] += os.lstat(os.path.join(parent_dir, file_name)).st_size
+            except FileNotFoundError:
+                pass
+
+    return usage
+
+
+class RateLimiter(object):
+    """ Sleeps as needed to keep operations below `rate` per second; a `rate` of 0 is unlimited """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.count = 0
+
+    def add(self, count: int):
+        self.count += count
+        if self.rate <= 0:
+            return
+
+        ahead = self.count / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def delete_tree(path: str, usage: dict, usage_path: str, limiter: RateLimiter):
+    """ Deletes the tree at `path` bottom-up, keeping `usage` and the file at `usage_path` up to
+    date with the space that it still takes up """
+
+    batch = 0
+
+    def deleted(delete_func, path: str, size=0):
+        nonlocal batch
+
+        try:
+            delete_func(path)
+        except FileNotFoundError:
+            return
+        usage["inodes"] -= 1
+        usage["bytes"] -= size
+        batch += 1
+        if batch >= REAP_BATCH_SIZE:
+            write_json(usage_path, usage)
+            limiter.add(batch)
+            batch = 0
+
+    if os.path.islink(path) or not os.path.isdir(path):
+        deleted(os.unlink, path)
+        return
+
+    for (parent_dir, dir_names, file_names) in os.walk(path, topdown=False):
+        for file_name in file_names:
+            file_path = os.path.join(parent_dir, file_name)
+            try:
+                size = os.lstat(file_path).st_size
+            except FileNotFoundError:
+                continue
+            deleted(os.unlink, file_path, size)
+        for dir_name in dir_names:
+            dir_path = os.path.join(parent_dir, dir_name)
+            # Symlinks to directories are listed as directories
+            deleted(os.unlink if os.path.islink(dir_path) else os.rmdir, dir_path)
+    deleted(os.rmdir, path)
+    limiter.add(batch)
+
+
+def reap_entry(entry_dir: str, limiter: RateLimiter):
+    usage_path = os.path.join(entry_dir, "usage.json")
+    tree_path = os.path.join(entry_dir, "tree")
+    usage = read_json(usage_path) or measure_tree(tree_path)
+
+    delete_tree(tree_path, usage, usage_path, limiter)
+
+    # Blobs are only released once the trees linking to them are gone
+    digests = read_json(os.path.join(entry_dir, "digests.json"))
+    if digests:
+        BLOB_STORE.release(digests)
+
+    for file_name in os.listdir(entry_dir):
+        os.unlink(os.path.join(entry_dir, file_name))
+    os.rmdir(entry_dir)
+
+
+def reap_trash(rate=None, blocking=True) -> int:
+    """ Deletes everything in the trash at a rate of at most `rate` files per second
+    (`settings.TRASH_REAP_RATE` by default), returning the number of entries deleted.  If
+    `blocking` isn't set and another process is already reaping, nothing is done. """
+
+    if rate is None:
+        rate = settings.TRASH_REAP_RATE
+
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    with open(os.path.join(TRASH_DIR, ".lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return 0
+
+        try:
+            entries = list_trash_entries()
+
+            # Everything is measured first so that the backlog is reported in full
+            for entry_dir in entries:
+                usage_path = os.path.join(entry_dir, "usage.json")
+                if not os.path.exists(usage_path):
+                    write_json(usage_path, measure_tree(os.path.join(entry_dir, "tree")))
+
+            limiter = RateLimiter(rate)
+            for entry_dir in entries:
+                reap_entry(entry_dir, limiter)
+
+            return len(entries)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_reaper():
+    while True:
+        REAPER_WAKEUP.wait(timeout=REAPER_POLL_INTERVAL)
+        REAPER_WAKEUP.clear()
+        try:
+            # Keep going until entries trashed while reaping have been reaped as well
+            while reap_trash(blocking=False):
+                pass
+        except Exception as e:
+            print("Error while emptying the trash: {}".format(e))
+            traceback.print_exc()
+
+
+def wake_reaper():
+    """ Wakes up this process's reaper thread, starting it if it isn't running yet """
+
+    global REAPER
+
+    with REAPER_LOCK:
+        if REAPER is None:
+            REAPER = threading.Thread(target=run_reaper, name="phost-trash-reaper", daemon=True)
+            REAPER.start()
+
+    REAPER_WAKEUP.set()
+
+
+def trash_stats() -> dict:
+    """ Reports the backlog of space waiting to be reclaimed from the trash.  Entries that haven't
+    been measured by the reaper yet are only counted in `unmeasured_entry_count`. """
+
+    stats = {"entry_count": 0, "unmeasured_entry_count": 0, "bytes": 0, "inodes": 0}
+    for entry_dir in list_trash_entries():
+        stats["entry_count"] += 1
+        usage = read_json(os.path.join(entry_dir, "usage.json"))
+        if usage is None:
+            stats["unmeasured_entry_count"] += 1
+        else:
+            stats["bytes"] += usage["bytes"]
+            stats["inodes"] += usage["inodes"]
+
+    return stats
@@ -2,69 +2,495 @@
 Utilities for dealing with uploaded deployment archives
 """
 
+import importlib.util
 import os
 import pathlib
+import queue
 import shutil
 import tarfile
+import threading
+import time
+import uuid
 
 from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from . import cache, metrics
+from .background import run_in_background, run_throttled
+from .blobs import BLOB_STORE
+from .extract import ExtractionStats, extract_archive
+from .precompress import precompress_dir
+from .profiling import span
+from .trash import move_to_trash
+from .manifest import (
+    save_manifest,
+    load_manifest,
+    load_deployment_manifests,
+    delete_manifests,
+    manifest_digests,
+)
 
 
 HOST_DIR = settings.HOST_PATH
 
+# Uploaded archives are extracted here before being moved into place
+STAGING_DIR = os.path.join(HOST_DIR, ".staging")
+
+# Minimum number of seconds between sweeps for staging directories abandoned by crashed processes
+STAGING_SWEEP_INTERVAL = 10 * 60
 
-def delete_dir_if_exists(dir_path: str):
-    if os.path.exists(dir_path):
-        shutil.rmtree(dir_path)
+# Maximum number of request body chunks buffered between the upload and the extraction thread
+PIPE_QUEUE_SIZE = 16
+
+# Compression codecs that clients may use for uploaded archives, mapped to the `tarfile` method
+# that reads them and the module that it depends on
+COMPRESSION_CODECS = {
+    "none": ("tar", None),
+    "gzip": ("gz", "zlib"),
+    "bz2": ("bz2", "bz2"),
+    "xz": ("xz", "lzma"),
+    "zstd": ("zst", "compression.zstd"),
+}
 
 
 def delete_hosted_version(deployment_subdomain: str, version: str):
+    """ Moves the directory of a version into the trash, from where it is deleted in the
+    background along with any blobs that only it referenced """
+
+    manifest = load_manifest(deployment_subdomain, version)
     version_dir = os.path.join(HOST_DIR, deployment_subdomain, version)
-    delete_dir_if_exists(version_dir)
+    move_to_trash(version_dir, manifest_digests(manifest) if manifest is not None else None)
+
+    if manifest is not None:
+        delete_manifests(deployment_subdomain, version)
 
 
 def delete_hosted_deployment(deployment_subdomain: str):
+    """ Moves the directory of a deployment into the trash, from where it is deleted in the
+    background along with any blobs that only it referenced """
+
+    manifests = load_deployment_manifests(deployment_subdomain)
     deployment_dir = os.path.join(HOST_DIR, deployment_subdomain)
-    delete_dir_if_exists(deployment_dir)
+    move_to_trash(deployment_dir, manifest_digests(*manifests) if manifests else None)
+
+    delete_manifests(deployment_subdomain)
 
 
 def update_symlink(deployment_subdomain: str, new_version: str):
     """ Updates the directory that `latest` is symlinked to in the given host directory.  This
-    should be called after a new version is pushed. """
+    should be called after a new version is pushed or activated.  The new link is created under
+    a temporary name and renamed over the old one, so `latest` always resolves to either the old
+    or the new version and requests never see it missing. """
 
     link_path = os.path.join(HOST_DIR, deployment_subdomain, "latest")
+    tmp_link_path = "{}.{}.tmp".format(link_path, uuid.uuid4().hex)
+    with metrics.timed("phost_symlink_update_duration_seconds"), span("update_symlink"):
+        os.symlink(os.path.join(HOST_DIR, deployment_subdomain, new_version), tmp_link_path)
+        try:
+            os.replace(tmp_link_path, link_path)
+        except OSError:
+            os.unlink(tmp_link_path)
+            raise
+
+    cache.invalidate()
+
+
+class UploadCancelled(Exception):
+    pass
+
+
+def get_linked_version(deployment_subdomain: str):
+    """ Returns the name of the version that `latest` points to, or `None` if there is none """
+
+    try:
+        return os.path.basename(os.readlink(os.path.join(HOST_DIR, deployment_subdomain, "latest")))
+    except OSError:
+        return None
+
+
+def restore_symlink(deployment_subdomain: str, version):
+    """ Points `latest` back at `version` (as returned by `get_linked_version`) after a failed
+    deploy, removing it if there was no previous version """
+
+    if version is not None:
+        update_symlink(deployment_subdomain, version)
+        return
+
     try:
-        os.unlink(link_path)
+        os.unlink(os.path.join(HOST_DIR, deployment_subdomain, "latest"))
     except FileNotFoundError:
         pass
+    cache.invalidate()
 
-    os.symlink(os.path.join(HOST_DIR, deployment_subdomain, new_version), link_path)
 
+class ChunkPipe(object):
+    """ Minimal file-like object that hands chunks of data written on one thread to a reader on
+    another.  The queue between them is bounded, so a slow reader applies backpressure to the
+    writer.  If the reader stops early, any further written data is discarded.  If the writer
+    stops early without closing the pipe, it cancels it so that the reader fails rather than
+    waiting for data forever. """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=PIPE_QUEUE_SIZE)
+        self.buffer = bytearray()
+        self.eof = False
+        self.reader_done = False
+        self.cancelled = False
+
+    def _put(self, item):
+        while not self.reader_done and not self.cancelled:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, data: bytes):
+        self._put(data)
+
+    def close(self):
+        self._put(None)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def read(self, size=-1) -> bytes:
+        while (size < 0 or len(self.buffer) < size) and not self.eof:
+            try:
+                chunk = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.cancelled:
+                    raise UploadCancelled("The upload was interrupted")
+                continue
+
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer += chunk
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+class StagedArchive(UploadedFile):
+    """ Stands in for an uploaded archive that was extracted into a staging directory while it was
+    being uploaded.  If the staging directory hasn't been taken over by a staged version by the
+    time the request finishes, it is deleted in the background when Django closes the request's
+    uploaded files. """
+
+    def __init__(self, staging_dir: str, stats, error, name: str, content_type: str, size: int):
+        super(StagedArchive, self).__init__(
+            file=None, name=name, content_type=content_type, size=size
+        )
+        self.staging_dir = staging_dir
+        self.stats = stats
+        self.error = error
+
+    def close(self):
+        if self.staging_dir is not None and os.path.exists(self.staging_dir):
+            discard_staging_dir(self.staging_dir, self.stats.manifest if self.stats else None)
+
+
+class StreamingArchiveUploadHandler(FileUploadHandler):
+    """ Upload handler that feeds the uploaded archive in the `file` field into a streaming tar
+    reader as it arrives, extracting it into a staging directory on a separate thread.  This
+    overlaps network transfer with decompression and disk writes and avoids spooling the archive
+    to memory or a temporary file.  Other file fields are passed on to the default handlers. """
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingArchiveUploadHandler, self).__init__(*args, **kwargs)
+        self.active = False
+        self.staged_archive = None
+
+    def new_file(self, field_name, *args, **kwargs):  # pylint: disable=W0221
+        super(StreamingArchiveUploadHandler, self).new_file(field_name, *args, **kwargs)
+        if field_name != "file":
+            self.active = False
+            return
+
+        self.active = True
+        self.pipe = ChunkPipe()
+        self.staging_dir = create_staging_dir()
+        self.stats = None
+        self.error = None
+        self.thread = threading.Thread(target=self.extract, daemon=True)
+        self.thread.start()
+        raise StopFutureHandlers()
+
+    def extract(self):
+        try:
+            self.stats = extract_archive_stream(self.pipe, self.staging_dir)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.pipe.reader_done = True
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.pipe.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+
+        self.active = False
+        self.pipe.close()
+        self.thread.join()
+        metrics.observe("phost_upload_bytes", file_size, source="stream")
+        self.staged_archive = StagedArchive(
+            self.staging_dir,
+            self.stats,
+            self.error,
+            self.file_name,
+            self.content_type,
+            file_size,
+        )
+        return self.staged_archive
+
+    def upload_interrupted(self):
+        if self.active:
+            self.active = False
+            self.pipe.cancel()
+            self.thread.join()
+            discard_staging_dir(self.staging_dir, self.stats.manifest if self.stats else None)
+
+    def cancel(self):
+        """ Stops extraction and deletes the staging directory, whether or not the archive has
+        been received completely.  Called when parsing the request fails, in which case Django
+        neither interrupts the upload nor closes the uploaded files. """
+
+        if self.active:
+            self.upload_interrupted()
+        elif self.staged_archive is not None:
+            self.staged_archive.close()
+
+
+def supported_compression() -> list:
+    """ Returns the compression codecs that uploaded archives can be compressed with, which
+    depends on the compression modules available to `tarfile` at runtime """
+
+    codecs = []
+    for (codec, (method, module_name)) in COMPRESSION_CODECS.items():
+        if method not in tarfile.TarFile.OPEN_METH:
+            continue
+
+        try:
+            if module_name is None or importlib.util.find_spec(module_name) is not None:
+                codecs.append(codec)
+        except ImportError:
+            pass
+
+    return codecs
+
+
+def create_staging_dir() -> str:
+    run_throttled("sweep_staging_dirs", STAGING_SWEEP_INTERVAL, sweep_staging_dirs)
+
+    staging_dir = os.path.join(STAGING_DIR, uuid.uuid4().hex)
+    pathlib.Path(staging_dir).mkdir(parents=True)
+    return staging_dir
+
+
+def delete_staging_dir(staging_dir: str, manifests: list):
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    # Blobs are only released once the staged files linking to them are gone
+    manifests = [manifest for manifest in manifests if manifest is not None]
+    if manifests:
+        BLOB_STORE.release(manifest_digests(*manifests))
 
-def handle_uploaded_static_archive(file, subdomain: str, version: str, init=True) -> str:
-    """
-    Writes the archive to a temporary file and attempts to extract it to the project directory.
-    Raises an exception if the extraction process was unsuccessful.
-    """
 
+def discard_staging_dir(staging_dir: str, *manifests):
+    """ Deletes a staging directory in the background, along with any blobs that were only
+    referenced by the files listed in `manifests`. """
+
+    run_in_background(delete_staging_dir, staging_dir, list(manifests))
+
+
+def sweep_staging_dirs(max_age=None):
+    """ Deletes staging directories that haven't been modified in `max_age` seconds
+    (`settings.STALE_STAGING_DIR_AGE` by default), which are left behind by server processes that
+    died while extracting an upload. """
+
+    if max_age is None:
+        max_age = settings.STALE_STAGING_DIR_AGE
+
+    try:
+        dir_names = os.listdir(STAGING_DIR)
+    except FileNotFoundError:
+        return
+
+    now = time.time()
+    for dir_name in dir_names:
+        staging_dir = os.path.join(STAGING_DIR, dir_name)
+        try:
+            if now - os.stat(staging_dir).st_mtime > max_age:
+                delete_staging_dir(staging_dir, [])
+        except FileNotFoundError:
+            pass
+
+
+def extract_archive_stream(fileobj, dst_dir: str) -> ExtractionStats:
+    """ Extracts a (possibly compressed) tar archive from a non-seekable stream into `dst_dir` """
+
+    return extract_archive(fileobj, dst_dir, mode="r|*")
+
+
+def install_streaming_upload_handler(req):
+    """ Makes uploaded archives in `req` get extracted while they're being received and parses
+    the request's body.  Must be called before the request's POST data or files are accessed.  If
+    the body can't be read or parsed, the extraction is cancelled before the error is raised. """
+
+    handler = StreamingArchiveUploadHandler(req)
+    req.upload_handlers.insert(0, handler)
     try:
+        req.POST  # pylint: disable=W0104
+    except Exception as e:
+        handler.cancel()
+        raise e
+
+
+class StagedVersion(object):
+    """ The files of a new version, extracted into a staging directory where they wait to be moved
+    into place.  Staging happens outside of any database transaction, so that a slow upload never
+    holds row locks; installing the staged version is a single rename. """
+
+    def __init__(self, staging_dir: str, manifest, extracted_manifest=None, stats=None):
+        self.staging_dir = staging_dir
+        self.manifest = manifest
+        # The manifest of the files that were extracted from the archive itself, which differs
+        # from `manifest` for delta uploads
+        self.extracted_manifest = extracted_manifest
+        self.stats = stats
+        self.subdomain = None
+        self.version = None
+
+    def usage(self) -> tuple:
+        """ Returns the number of files in the staged version and their total size in bytes, or
+        `(None, None)` if they aren't known.  The size is the logical size of the version: files
+        that are hardlinked to other versions or to the blob store are counted in full by every
+        version that contains them, so it overstates how much disk space the version uses. """
+
+        # Delta uploads only contain some of the files of the version, all of which are listed in
+        # its manifest, whose sizes `Delta.apply` has checked against the files
+        if self.manifest is not None:
+            return (len(self.manifest), sum(entry["size"] for entry in self.manifest.values()))
+        if self.stats is not None:
+            return (self.stats.file_count, self.stats.total_bytes)
+
+        return (None, None)
+
+    def precompress(self) -> int:
+        """ Stores gzipped copies of the staged text assets next to them if
+        `settings.PRECOMPRESS_DEPLOYMENTS` is set, returning how many were written """
+
+        if not settings.PRECOMPRESS_DEPLOYMENTS:
+            return 0
+
+        return precompress_dir(self.staging_dir)
+
+    def install(self, subdomain: str, version: str) -> str:
+        """ Moves the staged files into place as `version` of the deployment at `subdomain` """
+
         dst_dir = os.path.join(HOST_DIR, subdomain, version)
-        pathlib.Path(dst_dir).mkdir(parents=True, exist_ok=True)
-        if init:
-            if version != "latest":
-                os.symlink(dst_dir, os.path.join(HOST_DIR, subdomain, "latest"))
+        pathlib.Path(os.path.dirname(dst_dir)).mkdir(parents=True, exist_ok=True)
+        # Existing files are never replaced, since they may belong to a live version
+        if os.path.lexists(dst_dir):
+            raise FileExistsError("The files of version {} already exist".format(version))
 
-        # Extract the archive into the hosting directory
-        t = tarfile.open(mode="r:*", fileobj=file)
-        t.extractall(dst_dir)
-        t.close()
+        os.rename(self.staging_dir, dst_dir)
+        (self.subdomain, self.version) = (subdomain, version)
+        if self.manifest is not None:
+            save_manifest(subdomain, version, self.manifest)
 
         return dst_dir
+
+    def discard(self):
+        """ Deletes the staged files in the background, moving them back out of the hosting
+        directory first if they were already installed. """
+
+        if self.version is not None:
+            os.rename(os.path.join(HOST_DIR, self.subdomain, self.version), self.staging_dir)
+            delete_manifests(self.subdomain, self.version)
+            (self.subdomain, self.version) = (None, None)
+
+        discard_staging_dir(self.staging_dir, self.manifest, self.extracted_manifest)
+
+
+def stage_uploaded_archive(file, subdomain: str, delta=None) -> StagedVersion:
+    """
+    Extracts an uploaded archive into a staging directory, or takes over the staging directory of
+    an archive that was extracted during upload.  If `delta` is supplied, the archive only
+    contains part of the new version and the rest of it is filled in by applying the delta.
+    Raises an exception, after discarding the staged files, if the archive couldn't be staged.
+    """
+
+    stats = None
+    staging_dir = None
+    try:
+        if isinstance(file, StagedArchive):
+            # The staging directory is owned by the staged version from here on
+            (staging_dir, file.staging_dir) = (file.staging_dir, None)
+            stats = file.stats
+            if file.error is not None:
+                raise file.error
+        else:
+            staging_dir = create_staging_dir()
+            stats = extract_archive(file, staging_dir, mode="r:*")
+    except Exception as e:
+        print("Error while extracting uploaded tar archive:")
+        print(e)
+
+        if staging_dir is not None:
+            discard_staging_dir(staging_dir, stats.manifest if stats else None)
+        raise e
+
+    return stage_extracted_archive(staging_dir, subdomain, delta, stats)
+
+
+def stage_extracted_archive(staging_dir: str, subdomain: str, delta=None, stats=None):
+    """ Stages an archive that has already been extracted into `staging_dir`, applying `delta` if
+    it is supplied.  `stats` are the `ExtractionStats` of the extraction, if known. """
+
+    extracted_manifest = stats.manifest if stats else None
+    try:
+        if delta is not None:
+            delta.apply(staging_dir, subdomain)
     except Exception as e:
-        print("Error while creating deployment from tar archive:")
+        print("Error while applying uploaded delta:")
         print(e)
 
-        directory_to_delete = os.path.join(HOST_DIR, subdomain) if init else dst_dir
-        print(f"Deleting {directory_to_delete}...")
-        shutil.rmtree(directory_to_delete)
+        discard_staging_dir(staging_dir, extracted_manifest, delta.files)
+        raise e
+
+    manifest = delta.files if delta is not None else extracted_manifest
+    return StagedVersion(staging_dir, manifest, extracted_manifest, stats)
+
+
+def handle_uploaded_static_archive(
+    file, subdomain: str, version: str, init=True, delta=None
+) -> str:
+    """
+    Stages an uploaded archive (see `stage_uploaded_archive`) and moves it into place as
+    `version` of the deployment at `subdomain`, pointing its `latest` symlink at it if `init` is
+    set.  Raises an exception if the extraction process was unsuccessful.
+    """
+
+    with span("handle_uploaded_static_archive"):
+        staged = stage_uploaded_archive(file, subdomain, delta)
+    try:
+        dst_dir = staged.install(subdomain, version)
+        if init and version != "latest":
+            os.symlink(dst_dir, os.path.join(HOST_DIR, subdomain, "latest"))
+
+        return dst_dir
+    except Exception as e:
+        staged.discard()
         raise e
@@ -0,0 +1,255 @@
+"""
+Resumable upload sessions for large deployment archives.
+
+A session is created with `POST uploads/`, after which the archive is uploaded in numbered chunks
+with `PUT uploads/<id>/<index>/?offset=<offset>`, each of which carries the SHA-256 digest of its
+contents in the `X-Content-SHA256` header.  Chunks can be sent in any order and re-sent as many
+times as needed; `GET uploads/<id>/` reports the byte ranges that have been received so far so
+that interrupted uploads can pick up where they left off.  Once all chunks have been received,
+`POST uploads/<id>/finalize/` verifies the archive, after which it can be deployed by passing the
+session's ID as the `upload_id` field to the deployment endpoints in place of a `file`.
+
+Sessions live in `HOST_PATH/.uploads/<id>/` and expire `settings.UPLOAD_SESSION_TTL` seconds after
+they were last written to.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+from . import metrics
+from .background import run_throttled
+from .validation import BadInputException, NotFound
+
+
+UPLOADS_DIR = os.path.join(settings.HOST_PATH, ".uploads")
+
+SESSION_ID_RGX = re.compile("^[0-9a-f]{32}$")
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# Minimum number of seconds between sweeps for expired sessions
+SESSION_SWEEP_INTERVAL = 10 * 60
+
+
+def merge_ranges(ranges: list) -> list:
+    """ Merges a list of `[start, end)` ranges into a sorted list of disjoint ranges """
+
+    merged = []
+    for (start, end) in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+class UploadSession(object):
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.dir = os.path.join(UPLOADS_DIR, session_id)
+        self.data_path = os.path.join(self.dir, "data")
+        self.chunks_dir = os.path.join(self.dir, "chunks")
+
+    @staticmethod
+    def create(size=None, sha256=None):
+        """ Creates a new session for an archive of `size` bytes (if known up front).  If `sha256`
+        is supplied, the digest of the complete archive is verified when it's finalized. """
+
+        if size is not None and (not isinstance(size, int) or size < 0):
+            raise BadInputException("`size` must be a non-negative integer")
+        if sha256 is not None and not isinstance(sha256, str):
+            raise BadInputException("`sha256` must be a hex-encoded SHA-256 digest")
+
+        run_throttled("delete_expired_sessions", SESSION_SWEEP_INTERVAL, delete_expired_sessions)
+
+        session = UploadSession(uuid.uuid4().hex)
+        os.makedirs(session.chunks_dir)
+        with open(session.data_path, "wb"):
+            pass
+        session.save_meta({"size": size, "sha256": sha256, "finalized": False})
+
+        return session
+
+    @staticmethod
+    def get(session_id: str):
+        """ Returns the session with the given ID, raising `NotFound` if it doesn't exist or has
+        expired. """
+
+        if not SESSION_ID_RGX.match(session_id):
+            raise NotFound()
+
+        session = UploadSession(session_id)
+        try:
+            expired = session.expires_at() < time.time()
+        except FileNotFoundError:
+            raise NotFound()
+
+        if expired:
+            session.delete()
+            raise NotFound()
+
+        return session
+
+    def expires_at(self) -> float:
+        return os.stat(self.dir).st_mtime + settings.UPLOAD_SESSION_TTL
+
+    def touch(self):
+        os.utime(self.dir)
+
+    def load_meta(self) -> dict:
+        with open(os.path.join(self.dir, "meta.json"), "r") as f:
+            return json.load(f)
+
+    def save_meta(self, meta: dict):
+        path = os.path.join(self.dir, "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+
+    def chunk_record_path(self, index: int) -> str:
+        return os.path.join(self.chunks_dir, "{}.json".format(index))
+
+    def load_chunks(self) -> dict:
+        """ Returns the records of all chunks that have been received, keyed by index """
+
+        chunks = {}
+        for file_name in os.listdir(self.chunks_dir):
+            if not file_name.endswith(".json"):
+                continue
+
+            with open(os.path.join(self.chunks_dir, file_name), "r") as f:
+                chunks[int(file_name[: -len(".json")])] = json.load(f)
+
+        return chunks
+
+    def received_ranges(self) -> list:
+        chunks = self.load_chunks().values()
+        return merge_ranges([[c["offset"], c["offset"] + c["size"]] for c in chunks])
+
+    def write_chunk(self, index: int, offset: int, size: int, checksum: str, stream):
+        """ Writes `size` bytes read from `stream` to the archive at `offset`, verifying that
+        their SHA-256 digest matches `checksum`. """
+
+        meta = self.load_meta()
+        if meta["finalized"]:
+            raise BadInputException("This upload has already been finalized")
+        if offset < 0 or index < 0:
+            raise BadInputException("Chunk indices and offsets must be non-negative")
+        if size > settings.MAX_UPLOAD_CHUNK_SIZE:
+            raise BadInputException(
+                "Chunks can't be larger than {} bytes".format(settings.MAX_UPLOAD_CHUNK_SIZE)
+            )
+        if meta["size"] is not None and offset + size > meta["size"]:
+            raise BadInputException("The chunk extends past the end of the upload")
+
+        for (other_index, chunk) in self.load_chunks().items():
+            overlaps = offset < chunk["offset"] + chunk["size"] and chunk["offset"] < offset + size
+            if other_index != index and overlaps:
+                raise BadInputException("The chunk overlaps chunk {}".format(other_index))
+
+        # The chunk is only recorded as received once all of it has been written and verified
+        record_path = self.chunk_record_path(index)
+        if os.path.exists(record_path):
+            os.unlink(record_path)
+
+        chunk_hash = hashlib.sha256()
+        written = 0
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            while written < size:
+                data = stream.read(min(READ_CHUNK_SIZE, size - written))
+                if not data:
+                    break
+
+                chunk_hash.update(data)
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+        finally:
+            os.close(fd)
+
+        if written != size:
+            raise BadInputException("Expected {} bytes but received {}".format(size, written))
+        if chunk_hash.hexdigest() != checksum.lower():
+            raise BadInputException("The chunk's contents don't match its checksum")
+
+        with open(record_path + ".tmp", "w") as f:
+            json.dump({"offset": offset, "size": size, "sha256": checksum.lower()}, f)
+        os.replace(record_path + ".tmp", record_path)
+        self.touch()
+
+    def status(self) -> dict:
+        meta = self.load_meta()
+        ranges = self.received_ranges()
+        return {
+            "id": self.id,
+            "size": meta["size"],
+            "finalized": meta["finalized"],
+            "received": ranges,
+            "received_bytes": sum(end - start for (start, end) in ranges),
+            "chunks": sorted(self.load_chunks().keys()),
+            "expires_at": self.expires_at(),
+        }
+
+    def finalize(self) -> dict:
+        """ Verifies that the whole archive has been received and marks the session as ready to
+        be deployed. """
+
+        meta = self.load_meta()
+        ranges = self.received_ranges()
+        if meta["size"] is None:
+            if len(ranges) > 1 or (ranges and ranges[0][0] != 0):
+                raise BadInputException("Not all chunks of the upload have been received")
+            meta["size"] = ranges[0][1] if ranges else 0
+        elif meta["size"] > 0 and ranges != [[0, meta["size"]]]:
+            raise BadInputException("Not all chunks of the upload have been received")
+
+        os.truncate(self.data_path, meta["size"])
+
+        if meta["sha256"] is not None:
+            archive_hash = hashlib.sha256()
+            with open(self.data_path, "rb") as f:
+                for data in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                    archive_hash.update(data)
+            if archive_hash.hexdigest() != meta["sha256"].lower():
+                raise BadInputException("The uploaded archive doesn't match its checksum")
+
+        meta["finalized"] = True
+        self.save_meta(meta)
+        metrics.observe("phost_upload_bytes", meta["size"], source="resumable")
+        self.touch()
+        return self.status()
+
+    def open_archive(self):
+        """ Opens the uploaded archive of a finalized session for reading """
+
+        if not self.load_meta()["finalized"]:
+            raise BadInputException("The upload must be finalized before it can be deployed")
+
+        return open(self.data_path, "rb")
+
+    def delete(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def delete_expired_sessions():
+    try:
+        session_ids = os.listdir(UPLOADS_DIR)
+    except FileNotFoundError:
+        return
+
+    now = time.time()
+    for session_id in session_ids:
+        session = UploadSession(session_id)
+        try:
+            if session.expires_at() < now:
+                session.delete()
+        except FileNotFoundError:
+            pass
@@ -11,9 +11,39 @@ urlpatterns = [
         views.DeploymentVersionView.as_view(),
         name="deployment_version",
     ),
+    path(
+        "deployments/<str:deployment_id>/<str:version>/activate/",
+        views.DeploymentVersionActivate.as_view(),
+        name="deployment_version_activate",
+    ),
+    path(
+        "deployments/<str:deployment_id>/<str:version>/diff/",
+        views.DeploymentVersionDiff.as_view(),
+        name="deployment_version_diff",
+    ),
+    path("uploads/", views.UploadSessions.as_view(), name="upload_sessions"),
+    path("uploads/<str:upload_id>/", views.UploadSessionView.as_view(), name="upload_session"),
+    path(
+        "uploads/<str:upload_id>/finalize/",
+        views.UploadSessionFinalize.as_view(),
+        name="upload_session_finalize",
+    ),
+    path(
+        "uploads/<str:upload_id>/<int:index>/",
+        views.UploadSessionChunk.as_view(),
+        name="upload_session_chunk",
+    ),
+    path("jobs/<int:job_id>/", views.JobView.as_view(), name="job"),
     path("proxy/<str:deployment_id>/", views.ProxyDeploymentView.as_view(), name="proxy"),
     path("proxy/", views.ProxyDeployments.as_view(), name="proxies"),
     path("login/", views.login_user, name="login"),
+    path("capabilities/", views.Capabilities.as_view(), name="capabilities"),
+    path("cache/", views.DeploymentCacheStats.as_view(), name="cache_stats"),
+    path("storage/", views.StorageStats.as_view(), name="storage_stats"),
+    path("trash/", views.TrashStats.as_view(), name="trash_stats"),
+    path("metrics/", views.Metrics.as_view(), name="metrics"),
+    path("profiles/", views.Profiles.as_view(), name="profiles"),
+    path("profiles/<str:profile_id>/", views.ProfileView.as_view(), name="profile"),
     path("404/", views.not_found),
 ]
 
@@ -3,6 +3,8 @@
 
 import re
 
+from .profiling import span
+
 
 class BadInputException(Exception):
     pass
@@ -41,8 +43,29 @@ def validate_subdomain(subdomain: str):
 
 
 def get_validated_form(FormClass, request):
-    form = FormClass(request.POST, request.FILES)
+    # Accessing the form data parses the request body, which includes receiving any uploads
+    with span("get_validated_form"):
+        form = FormClass(request.POST, request.FILES)
     if not form.is_valid():
         raise BadInputException("Invalid fields provided to the static deployment creation form")
 
     return form
+
+
+def parse_fields(fields_param, allowed_fields: list):
+    """ Parses a comma-separated `fields` query parameter into a list of requested fields,
+    returning `None` if no fields were requested. """
+
+    if fields_param is None:
+        return None
+
+    fields = [field.strip() for field in fields_param.split(",") if field.strip()]
+    invalid_fields = [field for field in fields if field not in allowed_fields]
+    if invalid_fields:
+        raise BadInputException(
+            "Invalid fields requested: {}; valid fields are: {}".format(
+                ", ".join(invalid_fields), ", ".join(allowed_fields)
+            )
+        )
+
+    return fields
@@ -1,35 +1,63 @@
-import mimetypes
+from functools import wraps
+import json
 import os
 import re
 import traceback
+import zlib
 
 from django.http import (
+    FileResponse,
     HttpResponse,
     JsonResponse,
+    StreamingHttpResponse,
     HttpResponseBadRequest,
     HttpResponseServerError,
     HttpResponseNotFound,
     HttpResponseForbidden,
+    HttpResponseNotModified,
 )
 from django.conf import settings
 from django.contrib.auth import authenticate, login
 from django.db import transaction
+from django.db.models import Case, Q, When
 from django.db.utils import IntegrityError
+from django.utils.crypto import constant_time_compare
 from django.utils.datastructures import MultiValueDictKeyError
+from django.utils.http import parse_etags
 from django.http.request import HttpRequest
 from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import TemplateView
-import semver
 
-from .models import StaticDeployment, DeploymentVersion, DeploymentCategory, ProxyDeployment
+from .models import StaticDeployment, DeploymentVersion, ProxyDeployment, DeployJob
 from .forms import StaticDeploymentForm, ProxyDeploymentForm
 from .upload import (
-    handle_uploaded_static_archive,
+    supported_compression,
+    install_streaming_upload_handler,
+    stage_uploaded_archive,
     update_symlink,
     delete_hosted_deployment,
     delete_hosted_version,
 )
-from .serialize import serialize
+from .serialize import (
+    DEPLOYMENT_FIELDS,
+    serialize,
+    serialize_queryset,
+    with_deployment_relations,
+    iter_serialized_chunks,
+    iter_ndjson_deployments,
+    sum_version_bytes,
+)
+from .pagination import DEFAULT_PAGE_SIZE, paginate, parse_limit, parse_date_param
+from .files import serve_file
+from .delta import Delta, parse_manifest, find_missing
+from .blobs import BLOB_STORE
+from .trash import trash_stats
+from .upload_sessions import UploadSession
+from .deploy import create_deployment, create_version, is_version_special
+from .jobs import enqueue_job, serialize_job, wants_async
+from . import cache, metrics
+from .profiling import span, get_profile_paths, list_profiles, format_profile
+from .generation import current_generation, bump_generation
 from .validation import (
     BadInputException,
     validate_deployment_name,
@@ -38,27 +66,20 @@ from .validation import (
     NotAuthenticated,
     InvalidCredentials,
     validate_subdomain,
+    parse_fields,
 )
 from .proxy import trigger_proxy_server_update
 
-# Used to get the name of the deployment into which a given URL points
-REDIRECT_URL_RGX = re.compile("^/__HOSTED/([^/]+)/.*$")
-
-# Taken from https://djangosnippets.org/snippets/101/
-def send_data(path, filename=None, mimetype=None):
-
-    if filename is None:
-        filename = os.path.basename(path)
-
-    if mimetype is None:
-        mimetype, encoding = mimetypes.guess_type(filename)
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
 
-    response = HttpResponse(content_type=mimetype)
-    response.write(open(path, "rb").read())
-    return response
+# Fields of a deployment that can be updated with `PATCH`
+RETENTION_FIELDS = ["retain_versions", "retain_days"]
 
+# Used to get the name of the deployment into which a given URL points
+REDIRECT_URL_RGX = re.compile("^/__HOSTED/([^/]+)/.*$")
 
 def with_caught_exceptions(func):
+    @wraps(func)
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
@@ -73,6 +94,7 @@ def with_caught_exceptions(func):
         except Exception as e:
             print("Uncaught error: {}".format(str(e)))
             traceback.print_exc()
+            metrics.increment("phost_unhandled_exceptions_total", exception=type(e).__name__)
 
             return HttpResponseServerError(
                 "An unhandled error occured while processing the request"
@@ -84,6 +106,7 @@ def with_caught_exceptions(func):
 def with_default_success(func):
     """ Decorator that returns a JSON success message if no errors occur during the request. """
 
+    @wraps(func)
     def wrapper(*args, **kwargs):
         func(*args, **kwargs)
         return JsonResponse({"success": True, "error": False})
@@ -104,6 +127,28 @@ def with_login_required(func):
     return wrapper
 
 
+def with_generation_etag(func):
+    """ Decorator for read views that tags their responses with an ETag derived from the global
+    change generation.  Conditional requests carrying the current ETag are answered with a 304
+    without running the view at all. """
+
+    def wrapper(router: TemplateView, req: HttpRequest, *args, **kwargs):
+        etag = '"{}-{:08x}"'.format(
+            current_generation(), zlib.crc32(req.get_full_path().encode("utf-8"))
+        )
+        if etag in parse_etags(req.META.get("HTTP_IF_NONE_MATCH", "")):
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        response = func(router, req, *args, **kwargs)
+        if response.status_code == 200:
+            response["ETag"] = etag
+        return response
+
+    return wrapper
+
+
 @require_GET
 def index(_req: HttpRequest):
     return HttpResponse("Site is up and running!  Try `GET /deployments`.")
@@ -143,28 +188,88 @@ def get_or_none(Model, do_raise=True, **kwargs):
             return None
 
 
+def filter_deployments(deployments, req: HttpRequest):
+    """ Applies the filters supplied in the query string of a deployment list request """
+
+    category = req.GET.get("category")
+    if category:
+        deployments = deployments.filter(categories__category=category)
+
+    name_prefix = req.GET.get("name_prefix")
+    if name_prefix:
+        deployments = deployments.filter(name__startswith=name_prefix)
+
+    created_after = req.GET.get("created_after")
+    if created_after:
+        deployments = deployments.filter(
+            created_on__gte=parse_date_param("created_after", created_after)
+        )
+
+    created_before = req.GET.get("created_before")
+    if created_before:
+        deployments = deployments.filter(
+            created_on__lt=parse_date_param("created_before", created_before)
+        )
+
+    return deployments
+
+
 class Deployments(TemplateView):
     @with_caught_exceptions
     @with_login_required
+    @with_generation_etag
     def get(self, request: HttpRequest):
-        all_deployments = StaticDeployment.objects.prefetch_related(
-            "deploymentversion_set", "categories"
-        ).all()
-        deployments_data = serialize(all_deployments, json=False)
-        deployments_data_with_versions = [
-            {
-                **datum,
-                "versions": serialize(deployment_model.deploymentversion_set.all(), json=False),
-                "categories": serialize(deployment_model.categories.all(), json=False),
-            }
-            for (datum, deployment_model) in zip(deployments_data, all_deployments)
-        ]
+        """ Lists deployments.  Apart from authentication, JSON responses take one query for the
+        deployments and one for each requested relation (see `with_deployment_relations`) no
+        matter how many deployments there are.  Unpaginated NDJSON is streamed out in chunks of
+        `STREAM_CHUNK_SIZE` deployments, and the relations are queried once per chunk. """
+
+        fields = parse_fields(request.GET.get("fields"), DEPLOYMENT_FIELDS)
+        deployments = filter_deployments(StaticDeployment.objects.all(), request)
+
+        cursor = request.GET.get("cursor")
+        limit = request.GET.get("limit")
+        if limit is not None:
+            limit = parse_limit(limit)
+        elif cursor is not None:
+            limit = DEFAULT_PAGE_SIZE
+        (page, get_next_cursor) = paginate(deployments, cursor=cursor, limit=limit)
+
+        output_format = request.GET.get("format", "json")
+        if output_format not in ["json", "ndjson"]:
+            raise BadInputException("`format` must be one of `json` or `ndjson`")
+
+        # Unpaginated NDJSON output is streamed out one chunk of deployments at a time, keeping
+        # memory usage flat no matter how many deployments exist.
+        if output_format == "ndjson" and limit is None:
+            return StreamingHttpResponse(
+                iter_ndjson_deployments(iter_serialized_chunks(page, fields), fields),
+                content_type=NDJSON_CONTENT_TYPE,
+            )
 
-        return JsonResponse(deployments_data_with_versions, safe=False)
+        # `created_on` is always selected since it's needed to build the cursor for the next page
+        deployments_data = serialize_queryset(
+            page, fields=None if fields is None else [*fields, "created_on"]
+        )
+        next_cursor = get_next_cursor(deployments_data)
+
+        if output_format == "ndjson":
+            response = StreamingHttpResponse(
+                iter_ndjson_deployments([deployments_data], fields),
+                content_type=NDJSON_CONTENT_TYPE,
+            )
+        else:
+            response = JsonResponse(
+                with_deployment_relations(deployments_data, fields, queryset=page), safe=False
+            )
+        if next_cursor is not None:
+            response["X-Next-Cursor"] = next_cursor
+        return response
 
     @with_caught_exceptions
     @with_login_required
     def post(self, request: HttpRequest):
+        install_streaming_upload_handler(request)
         form = get_validated_form(StaticDeploymentForm, request)
 
         deployment_name = form.cleaned_data["name"]
@@ -174,71 +279,113 @@ class Deployments(TemplateView):
         not_found_document = form.cleaned_data["not_found_document"]
         validate_deployment_name(deployment_name)
         validate_subdomain(subdomain)
+        # Checked before anything is staged; the unique constraints catch concurrent creations
+        existing = StaticDeployment.objects.filter(Q(name=deployment_name) | Q(subdomain=subdomain))
+        if existing.exists():
+            raise BadInputException("`name` and `subdomain` must be unique!")
+
+        if wants_async(request):
+            (archive, upload_session) = get_uploaded_archive(request)
+            job = enqueue_job(
+                DeployJob.CREATE,
+                subdomain,
+                version,
+                archive,
+                upload_session,
+                name=deployment_name,
+                categories=categories,
+                not_found_document=not_found_document,
+            )
+            return JsonResponse(serialize_job(job), status=202)
 
-        deployment_descriptor = None
+        (staged, upload_session) = stage_uploaded_files(request, subdomain)
+        deployment_data = create_deployment(
+            staged, deployment_name, subdomain, version, categories, not_found_document
+        )
+
+        if upload_session is not None:
+            upload_session.delete()
+
+        return JsonResponse(deployment_data)
+
+
+def get_uploaded_archive(req: HttpRequest) -> tuple:
+    """ Returns the archive uploaded along with a request to create a deployment or version and
+    the resumable upload session that it was uploaded through, if any. """
+
+    upload_id = req.POST.get("upload_id")
+    if upload_id:
         try:
-            with transaction.atomic():
-                # Create the new deployment descriptor
-                deployment_descriptor = StaticDeployment(
-                    name=deployment_name, subdomain=subdomain, not_found_document=not_found_document
-                )
-                deployment_descriptor.save()
-
-                # Create categories
-                for category in categories:
-                    (category_model, _) = DeploymentCategory.objects.get_or_create(
-                        category=category
-                    )
-                    deployment_descriptor.categories.add(category_model)
-
-                # Create the new version and set it as active
-                version_model = DeploymentVersion(
-                    version=version, deployment=deployment_descriptor, active=True
-                )
-                version_model.save()
-
-                handle_uploaded_static_archive(request.FILES["file"], subdomain, version)
-        except IntegrityError as e:
-            if "Duplicate entry" in str(e):
-                raise BadInputException("`name` and `subdomain` must be unique!")
-            else:
-                raise e
+            upload_session = UploadSession.get(upload_id)
+        except NotFound:
+            raise BadInputException("The upload session doesn't exist or has expired")
 
-        return JsonResponse(
-            {
-                "name": deployment_name,
-                "subdomain": subdomain,
-                "version": version,
-                "url": deployment_descriptor.get_url(),
-            }
+        return (upload_session.open_archive(), upload_session)
+
+    if not req.FILES.get("file"):
+        raise BadInputException(
+            "No multipart file named `file` or `upload_id` found in request; one of these must be "
+            "provided."
         )
 
+    return (req.FILES["file"], None)
 
-def get_query_dict(query_string: str, req: HttpRequest) -> dict:
+
+def stage_uploaded_files(req: HttpRequest, subdomain: str, delta=None) -> tuple:
+    """ Extracts the archive uploaded with a request into a staging directory, returning the
+    staged version and the resumable upload session that it was uploaded through, if any.  This
+    is done outside of any transaction so that slow uploads never hold database locks; the staged
+    version is moved into place at the end of a short transaction once it has been recorded. """
+
+    (archive, upload_session) = get_uploaded_archive(req)
+    try:
+        with span("stage_uploaded_archive"):
+            staged = stage_uploaded_archive(archive, subdomain, delta)
+    finally:
+        if upload_session is not None:
+            archive.close()
+
+    try:
+        with span("precompress"):
+            staged.precompress()
+    except Exception as e:
+        staged.discard()
+        raise e
+
+    return (staged, upload_session)
+
+
+def get_lookup(query_string: str, req: HttpRequest) -> tuple:
     lookup_field = req.GET.get("lookupField", "id")
     if lookup_field not in ["id", "subdomain", "name"]:
         raise BadInputException("The supplied `lookupField` was invalid")
 
-    return {lookup_field: query_string}
+    return (lookup_field, query_string)
+
+
+def get_query_dict(query_string: str, req: HttpRequest) -> dict:
+    (lookup_field, value) = get_lookup(query_string, req)
+    return {lookup_field: value}
 
 
 class Deployment(TemplateView):
     @with_caught_exceptions
+    @with_generation_etag
     def get(self, req: HttpRequest, deployment_id=None):
-        query_dict = get_query_dict(deployment_id, req)
-        deployment = get_or_none(StaticDeployment, **query_dict)
-        versions = DeploymentVersion.objects.filter(deployment=deployment)
-        active_version = next(v for v in versions if v.active)
-
-        deployment_data = serialize(deployment, json=False)
-        versions_data = serialize(versions, json=False)
-        versions_list = list(map(lambda version_datum: version_datum["version"], versions_data))
+        fields = parse_fields(req.GET.get("fields"), DEPLOYMENT_FIELDS)
+        deployment = cache.get_deployment(*get_lookup(deployment_id, req))
+        active_version = deployment.active_version
 
         deployment_data = {
-            **deployment_data,
-            "versions": versions_list,
-            "active_version": serialize(active_version, json=False)["version"],
+            **deployment.data,
+            "versions": [version_datum["version"] for version_datum in deployment.versions],
+            "active_version": active_version["version"] if active_version else None,
+            "total_bytes": sum_version_bytes(deployment.versions),
         }
+        if fields is not None:
+            deployment_data = {
+                field: value for (field, value) in deployment_data.items() if field in fields
+            }
 
         return JsonResponse(deployment_data, safe=False)
 
@@ -249,37 +396,52 @@ class Deployment(TemplateView):
         with transaction.atomic():
             query_dict = get_query_dict(deployment_id, req)
             deployment = get_or_none(StaticDeployment, **query_dict)
-            deployment_data = serialize(deployment, json=False)
             # This will also recursively delete all attached versions
             deployment.delete()
 
-            delete_hosted_deployment(deployment_data["subdomain"])
+            delete_hosted_deployment(deployment.subdomain)
 
+    @with_caught_exceptions
+    @with_login_required
+    def patch(self, req: HttpRequest, deployment_id=None):
+        """ Updates the retention policy of a deployment.  The body is a JSON object containing
+        `retain_versions` and/or `retain_days`; `null` makes the deployment use the global
+        default again. """
+
+        try:
+            params = json.loads(req.body or b"{}")
+        except ValueError:
+            raise BadInputException("The request body must be a JSON object")
+        if not isinstance(params, dict):
+            raise BadInputException("The request body must be a JSON object")
+
+        invalid_fields = [field for field in params if field not in RETENTION_FIELDS]
+        if invalid_fields:
+            raise BadInputException("Invalid fields: {}".format(", ".join(invalid_fields)))
+        for (field, value) in params.items():
+            if value is not None and (type(value) is not int or value < 0):
+                raise BadInputException("`{}` must be a non-negative integer".format(field))
+
+        deployment = get_or_none(StaticDeployment, **get_query_dict(deployment_id, req))
+        for (field, value) in params.items():
+            setattr(deployment, field, value)
+        deployment.save(update_fields=list(params.keys()))
+
+        return serialize(deployment)
 
-class DeploymentVersionView(TemplateView):
-    @staticmethod
-    def is_version_special(version: str) -> bool:
-        return version in ["minor", "m", "patch", "p", "major", "M"]
-
-    @staticmethod
-    def transform_special_version(special_version: str, previous_version: str) -> str:
-        if special_version in ["patch", "p"]:
-            return semver.bump_patch(previous_version)
-        elif special_version in ["minor", "m"]:
-            return semver.bump_minor(previous_version)
-        elif special_version in ["major", "M"]:
-            return semver.bump_major(previous_version)
-        else:
-            raise "Unreachable: `transform_special_version` should never be called with invalid special version"
 
+class DeploymentVersionView(TemplateView):
     @with_caught_exceptions
+    @with_generation_etag
     def get(
         self, req: HttpRequest, *args, deployment_id=None, version=None
     ):  # pylint: disable=W0221
-        query_dict = get_query_dict(deployment_id, req)
-        deployment = get_or_none(StaticDeployment, **query_dict)
-        version_model = get_or_none(DeploymentVersion, deployment=deployment, version=version)
-        return serialize(version_model)
+        deployment = cache.get_deployment(*get_lookup(deployment_id, req))
+        version_data = deployment.get_version(version)
+        if version_data is None:
+            raise NotFound()
+
+        return JsonResponse(version_data, safe=False)
 
     @with_caught_exceptions
     @with_login_required
@@ -287,46 +449,55 @@ class DeploymentVersionView(TemplateView):
         query_dict = get_query_dict(deployment_id, req)
         deployment = get_or_none(StaticDeployment, **query_dict)
 
-        if not req.FILES["file"]:
-            raise BadInputException(
-                "No multipart file named `file` found in request; this must be provided."
-            )
-
         # Assert that the new version is unique among other versions for the same deployment
-        if (not self.is_version_special(version)) and DeploymentVersion.objects.filter(
+        if (not is_version_special(version)) and DeploymentVersion.objects.filter(
             deployment=deployment, version=version
-        ):
+        ).exists():
             raise BadInputException("The new version name must be unique.")
 
-        version_model = None
-        with transaction.atomic():
-            # Set any old active deployment as inactive
-            old_version_model = DeploymentVersion.objects.get(deployment=deployment, active=True)
-            if old_version_model:
-                old_version_model.active = False
-                old_version_model.save()
-
-            # Transform special versions by bumping the previous semver version
-            if self.is_version_special(version):
-                try:
-                    version = self.transform_special_version(version, old_version_model.version)
-                except Exception as e:
-                    raise BadInputException(e)
-
-            # Create the new version and set it active
-            version_model = DeploymentVersion(version=version, deployment=deployment, active=True)
-            version_model.save()
-
-            deployment_data = serialize(deployment, json=False)
-
-            # Extract the supplied archive into the hosting directory
-            handle_uploaded_static_archive(
-                req.FILES["file"], deployment_data["subdomain"], version, init=False
+        # Only start receiving the upload once it's known that it can be deployed
+        install_streaming_upload_handler(req)
+
+        # Delta uploads only contain the files that the server didn't already have; the rest are
+        # taken from the version that the client diffed its files against.
+        delta = None
+        if "manifest" in req.POST:
+            delta = Delta(req.POST.get("base_version"), parse_manifest(req.POST["manifest"]))
+            if delta.base_version is not None and not DeploymentVersion.objects.filter(
+                deployment=deployment, version=delta.base_version
+            ).exists():
+                raise BadInputException("The supplied `base_version` does not exist")
+
+        if delta is not None and delta.base_version is None:
+            delta.base_version = (
+                DeploymentVersion.objects.filter(deployment=deployment, active=True)
+                .values_list("version", flat=True)
+                .first()
             )
-            # Update the `latest` version to point to this new version
-            update_symlink(deployment_data["subdomain"], version)
 
-        return serialize(version_model)
+        if wants_async(req):
+            (archive, upload_session) = get_uploaded_archive(req)
+            delta_params = {}
+            if delta is not None:
+                delta_params = {"manifest": delta.files, "base_version": delta.base_version}
+            job = enqueue_job(
+                DeployJob.VERSION,
+                deployment.subdomain,
+                version,
+                archive,
+                upload_session,
+                deployment_id=str(deployment.id),
+                **delta_params,
+            )
+            return JsonResponse(serialize_job(job), status=202)
+
+        (staged, upload_session) = stage_uploaded_files(req, deployment.subdomain, delta)
+        version_data = create_version(staged, deployment, version)
+
+        if upload_session is not None:
+            upload_session.delete()
+
+        return JsonResponse(version_data, safe=False)
 
     @with_caught_exceptions
     @with_login_required
@@ -335,19 +506,69 @@ class DeploymentVersionView(TemplateView):
         with transaction.atomic():
             query_dict = get_query_dict(deployment_id, req)
             deployment = get_or_none(StaticDeployment, **query_dict)
-            deployment_data = serialize(deployment, json=False)
             # Delete the entry for the deployment version from the database
             DeploymentVersion.objects.filter(deployment=deployment, version=version).delete()
             # If no deployment versions remain for the owning deployment, delete the deployment
             delete_deployment = False
-            if not DeploymentVersion.objects.filter(deployment=deployment):
+            if not DeploymentVersion.objects.filter(deployment=deployment).exists():
                 delete_deployment = True
                 deployment.delete()
 
             if delete_deployment:
-                delete_hosted_deployment(deployment_data["subdomain"])
+                delete_hosted_deployment(deployment.subdomain)
             else:
-                delete_hosted_version(deployment_data["subdomain"], version)
+                delete_hosted_version(deployment.subdomain, version)
+
+
+class DeploymentVersionActivate(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def post(self, req: HttpRequest, deployment_id=None, version=None):
+        """ Makes an existing version of a deployment its active version, pointing `latest` at it
+        without anything being uploaded again. """
+
+        query_dict = get_query_dict(deployment_id, req)
+        deployment = get_or_none(StaticDeployment, **query_dict)
+
+        with transaction.atomic():
+            versions = DeploymentVersion.objects.filter(deployment=deployment)
+            # Versions are stored lowercased, and so are the names of their directories
+            version_model = versions.select_for_update().filter(version=version.lower()).first()
+            if version_model is None:
+                raise NotFound()
+            version = version_model.version
+            if not os.path.isdir(os.path.join(settings.HOST_PATH, deployment.subdomain, version)):
+                raise BadInputException("The files for version {} are missing".format(version))
+
+            # Flips `active` on all versions at once; updates don't send `post_save`, so the
+            # generation is bumped by hand
+            versions.update(active=Case(When(pk=version_model.pk, then=True), default=False))
+            version_model.active = True
+            bump_generation()
+
+            update_symlink(deployment.subdomain, version)
+
+        return serialize(version_model)
+
+
+class DeploymentVersionDiff(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def post(self, req: HttpRequest, deployment_id=None, version=None):
+        """ Diffs the manifest in the request body against the active version of the deployment,
+        returning the digests of all files that need to be included in a delta upload. """
+
+        query_dict = get_query_dict(deployment_id, req)
+        deployment = get_or_none(StaticDeployment, **query_dict)
+        files = parse_manifest(req.body)
+
+        active_version = DeploymentVersion.objects.filter(
+            deployment=deployment, active=True
+        ).first()
+        base_version = None if active_version is None else active_version.version
+        missing = find_missing(deployment.subdomain, base_version, files)
+
+        return JsonResponse({"base_version": base_version, "missing": missing})
 
 
 @with_caught_exceptions
@@ -366,13 +587,13 @@ def not_found(req):
     deployment_subdomain = match[1]
 
     # Check to see if there's a custom 404 handle for the given deployment
-    deployment = get_or_none(StaticDeployment, subdomain=deployment_subdomain)
-    not_found_document = deployment.not_found_document
-
-    if not_found_document is None:
+    try:
+        deployment = cache.get_deployment("subdomain", deployment_subdomain)
+    except NotFound:
         return HttpResponseNotFound()
 
-    if deployment is None:
+    not_found_document = deployment.not_found_document
+    if not not_found_document:
         return HttpResponseNotFound()
 
     # Sandbox the retrieved pathname to be within the deployment's directory, preventing all kinds
@@ -399,19 +620,170 @@ def not_found(req):
             f"The specified 404 document {not_found_document} doesn't exist in this deployment."
         )
 
-    # Since our way of serving this file loads it into memory, we block any files that are >128MB
+    # The document is streamed rather than loaded into memory, but we still don't want every
+    # missed route on a deployment to be able to kick off a multi-gigabyte transfer.
     file_size = os.path.getsize(document_path)
-    if file_size > 1024 * 1024 * 1024 * 128:
+    max_size = settings.MAX_NOT_FOUND_DOCUMENT_SIZE
+    if file_size > max_size:
         return HttpResponseBadRequest(
-            f"Custom not found document is {file_size} bytes, which is more than the 128MB limit."
+            f"Custom not found document is {file_size} bytes, which is more than the {max_size} "
+            "byte limit."
+        )
+
+    return serve_file(req, document_path)
+
+
+class DeploymentCacheStats(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest):
+        return JsonResponse(cache.stats())
+
+
+class Metrics(TemplateView):
+    @with_caught_exceptions
+    def get(self, req: HttpRequest):
+        """ Metrics of all server processes in the Prometheus text format.  Only available to
+        logged-in users and to scrapers that supply `settings.METRICS_TOKEN` (if it's set) as a
+        bearer token. """
+
+        authorization = req.META.get("HTTP_AUTHORIZATION", "")
+        expected = "Bearer {}".format(settings.METRICS_TOKEN)
+        has_token = bool(settings.METRICS_TOKEN) and constant_time_compare(authorization, expected)
+        if not has_token and not req.user.is_authenticated:
+            raise NotAuthenticated()
+
+        return HttpResponse(
+            metrics.render(metrics.collect()), content_type="text/plain; version=0.0.4"
+        )
+
+
+class Profiles(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest):
+        return JsonResponse(list_profiles(), safe=False)
+
+
+class ProfileView(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest, profile_id=None):
+        """ Downloads a stored profile in the `pstats` format, or as a text summary if the
+        `format=text` query parameter is supplied """
+
+        paths = get_profile_paths(profile_id)
+        if paths is None:
+            raise NotFound()
+        (stats_path, metadata_path) = paths
+
+        if req.GET.get("format") == "text":
+            text = format_profile(stats_path, metadata_path)
+            return HttpResponse(text, content_type="text/plain")
+        return FileResponse(
+            open(stats_path, "rb"),
+            as_attachment=True,
+            filename="{}.prof".format(profile_id),
+            content_type="application/octet-stream",
+        )
+
+
+class Capabilities(TemplateView):
+    @with_caught_exceptions
+    def get(self, req: HttpRequest):
+        return JsonResponse(
+            {
+                "compression": supported_compression(),
+                "chunked_uploads": settings.CHUNKED_UPLOADS,
+                "upload_sessions": True,
+                "deploy_jobs": True,
+            }
         )
 
-    return send_data(document_path)
+
+class UploadSessions(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def post(self, req: HttpRequest):
+        """ Creates a resumable upload session.  The body may be a JSON object containing the
+        `size` and `sha256` of the archive that will be uploaded. """
+
+        try:
+            params = json.loads(req.body or b"{}")
+        except ValueError:
+            raise BadInputException("The request body must be a JSON object")
+        if not isinstance(params, dict):
+            raise BadInputException("The request body must be a JSON object")
+
+        upload_session = UploadSession.create(params.get("size"), params.get("sha256"))
+        return JsonResponse({**upload_session.status(), "chunk_size": settings.UPLOAD_CHUNK_SIZE})
+
+
+class UploadSessionView(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest, upload_id=None):
+        return JsonResponse(UploadSession.get(upload_id).status())
+
+    @with_caught_exceptions
+    @with_login_required
+    @with_default_success
+    def delete(self, req: HttpRequest, upload_id=None):
+        UploadSession.get(upload_id).delete()
+
+
+class UploadSessionChunk(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def put(self, req: HttpRequest, upload_id=None, index=None):
+        upload_session = UploadSession.get(upload_id)
+
+        checksum = req.META.get("HTTP_X_CONTENT_SHA256")
+        if not checksum:
+            raise BadInputException("The chunk's digest must be supplied as `X-Content-SHA256`")
+        try:
+            offset = int(req.GET["offset"])
+            size = int(req.META["CONTENT_LENGTH"])
+        except (KeyError, ValueError):
+            raise BadInputException("Chunks require an `offset` and a `Content-Length`")
+
+        # The body is read straight from the request stream rather than buffered into memory
+        upload_session.write_chunk(index, offset, size, checksum, req)
+        return JsonResponse(upload_session.status())
+
+
+class UploadSessionFinalize(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def post(self, req: HttpRequest, upload_id=None):
+        return JsonResponse(UploadSession.get(upload_id).finalize())
+
+
+class JobView(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest, job_id=None):
+        return JsonResponse(serialize_job(get_or_none(DeployJob, id=job_id)))
+
+
+class StorageStats(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest):
+        return JsonResponse(BLOB_STORE.stats())
+
+
+class TrashStats(TemplateView):
+    @with_caught_exceptions
+    @with_login_required
+    def get(self, req: HttpRequest):
+        return JsonResponse(trash_stats())
 
 
 class ProxyDeployments(TemplateView):
     @with_caught_exceptions
     @with_login_required
+    @with_generation_etag
     def get(self, request: HttpRequest):
         all_proxy_deployments = ProxyDeployment.objects.all()
         return serialize(all_proxy_deployments)
@@ -441,7 +813,7 @@ class ProxyDeployments(TemplateView):
             else:
                 raise e
 
-        trigger_proxy_server_update()
+        trigger_proxy_server_update("create")
 
         return JsonResponse(
             {"name": name, "subdomain": subdomain, "url": proxy_deployment_descriptor.get_url()}
@@ -450,6 +822,7 @@ class ProxyDeployments(TemplateView):
 
 class ProxyDeploymentView(TemplateView):
     @with_caught_exceptions
+    @with_generation_etag
     def get(self, req: HttpRequest, deployment_id=None):
         query_dict = get_query_dict(deployment_id, req)
         deployment = get_or_none(StaticDeployment, **query_dict)
@@ -465,4 +838,4 @@ class ProxyDeploymentView(TemplateView):
 
         proxy_deployment.delete()
 
-        trigger_proxy_server_update()
+        trigger_proxy_server_update("delete")